@@ -28,12 +28,13 @@
 
 from ..utils import serializable
 from ..utils import utils
-from ..utils.crypto import Key, RIPEMD160, SHA256
+from ..utils.crypto import Key, hash160
 from ..utils.base58 import decodeBase58Check, encodeBase58Check
 from ..utils.bitcointransaction import Transaction
-from ..utils.bitcoinutils import sendToStandardPubKey
+from ..utils.bitcoinutils import sendToStandardPubKey, reserveInputs
 
 from ..core import messages
+from ..core import log
 
 from plainchannel import PlainChannel, PlainChannel_Deposit, PlainChannel_Withdraw
 
@@ -51,6 +52,52 @@ serializable.registerClass(IOUChannel_WithdrawTransaction)
 
 
 
+def IOUChannel_getNewAddress(bitcoind):
+	"""
+	Return value:
+	str; a new address, whose private key never leaves the wallet
+	"""
+	return bitcoind.getNewAddress()
+messages.registerBitcoinCommand(IOUChannel_getNewAddress)
+
+
+
+def IOUChannel_makeCloseTransaction(bitcoind, amount, address):
+	"""
+	Makes, but does not send, a transaction that transfers amount to address.
+	The inputs of the transaction stay reserved until it is sent with the
+	sendRawTransaction command.
+
+	Return value:
+	str; the serialized transaction
+	"""
+
+	mBTC = 100000 #Satoshi
+	fee = mBTC / 100 #TODO: use configurable fee
+
+	toHash = decodeBase58Check(address, 0) #PUBKEY_ADDRESS = 0
+
+	#Make change address and store it:
+	k = Key()
+	k.makeNewKey(compressed=True)
+	changeHash = hash160(k.getPublicKey())
+	changePrivateKey = encodeBase58Check(k.getPrivateKey(), 128) #PRIVKEY = 128
+	bitcoind.importprivkey(changePrivateKey, 'Amiko Pay IOUChannel change', False)
+
+	tx = sendToStandardPubKey(bitcoind, amount, toHash, changeHash, fee)
+
+	#The transaction is sent later, so make sure that other transactions
+	#don't spend the same outputs in the mean time:
+	reserveInputs(tx)
+
+	return tx.serialize()
+
+#Exclusive, since it selects and reserves unspent outputs from the wallet:
+messages.registerBitcoinCommand(IOUChannel_makeCloseTransaction,
+	isExclusive=True)
+
+
+
 class IOUChannel(PlainChannel):
 	"""
 	Payment channel with only signed IOUs as protection.
@@ -87,25 +134,13 @@ class IOUChannel(PlainChannel):
 			return [PlainChannel_Deposit(amount=self.amountLocal)], []
 
 		elif (self.state, msg.__class__) == (self.states.opening, PlainChannel_Deposit):
-			self.state = self.states.open
 			self.amountRemote = msg.amount
 
-			k = Key()
-			k.makeNewKey(compressed=True)
-			publicKeyHash = RIPEMD160(SHA256(k.getPublicKey()))
-			self.address = encodeBase58Check(publicKeyHash, 0) #PUBKEY_ADDRESS = 0
-
-			privateKey = encodeBase58Check(k.getPrivateKey(), 128) #PRIVKEY = 128
-
-			def importPrivateKey(bitcoind):
-				#We've just created the key and haven't shared it yet, so
-				#it's impossible we've already received bitcoins on it.
-				#Therefore, rescan=False is safe.
-				bitcoind.importprivkey(privateKey, 'Amiko Pay IOUChannel', False)
-				return [], []
-
-			return [IOUChannel_Address(address=self.address)], \
-				[messages.BitcoinCommand(function=importPrivateKey)]
+			#The channel only opens once the wallet has given us an address:
+			return [], \
+				[messages.BitcoinCommand(
+					command='IOUChannel_getNewAddress',
+					arguments=[])]
 
 		elif (self.state, msg.__class__) == (self.states.opening, IOUChannel_Address):
 			if not self.isIssuer:
@@ -148,60 +183,91 @@ class IOUChannel(PlainChannel):
 			self.state = self.states.closed
 			self.withdrawTxID = tx.getTransactionID()[::-1].encode("hex")
 
-			def sendTransaction(bitcoind):
-				bitcoind.sendRawTransaction(msg.transaction)
-				return [], []
-
-			return [], [messages.BitcoinCommand(function=sendTransaction)]
+			return [], \
+				[messages.BitcoinCommand(
+					command='sendRawTransaction',
+					arguments=[msg.transaction])]
 
 		raise Exception("Received unexpected channel message")
 
 
-	def doClose(self):
+	def handleBitcoinReturnValue(self, command, value):
 		"""
 		Return value:
 			tuple(list, list)
 		"""
 
-		if self.isIssuer:
-			self.state = self.states.closed
+		if command == 'IOUChannel_getNewAddress':
+			self.address = value
+			self.state = self.states.open
+			return [IOUChannel_Address(address=self.address)], []
 
-			def makeCloseTransaction(bitcoind):
-				mBTC = 100000 #Satoshi
+		elif command == 'IOUChannel_makeCloseTransaction':
+			tx = Transaction.deserialize(value)
+			self.withdrawTxID = tx.getTransactionID()[::-1].encode("hex")
 
-				amount = self.amountRemote
+			#Send the transaction now that it is stored, and tell the peer
+			#about it:
+			return [IOUChannel_WithdrawTransaction(transaction=value)], \
+				[messages.BitcoinCommand(
+					command='sendRawTransaction',
+					arguments=[value])]
 
-				#In case there is nothing to be sent, don't make a Bitcoin
-				#transaction. Tell the peer we close the channel without a
-				#transaction.
-				if amount == 0:
-					return [IOUChannel_WithdrawTransaction(transaction=None)], []
+		elif command == 'sendRawTransaction':
+			return [], []
 
-				fee = mBTC / 100 #TODO: use configurable fee
+		raise Exception("Received unexpected bitcoin return value")
 
-				toHash = decodeBase58Check(self.address, 0) #PUBKEY_ADDRESS = 0
 
-				#Make change address and store it:
-				k = Key()
-				k.makeNewKey(compressed=True)
-				changeHash = RIPEMD160(SHA256(k.getPublicKey()))
-				changePrivateKey = encodeBase58Check(k.getPrivateKey(), 128) #PRIVKEY = 128
-				bitcoind.importprivkey(changePrivateKey, 'Amiko Pay IOUChannel change', False)
+	def handleBitcoinCommandFailed(self, command, error):
+		"""
+		Return value:
+			tuple(list, list)
+		"""
 
-				tx = sendToStandardPubKey(bitcoind, amount, toHash, changeHash, fee)
+		#None of these can be repaired by the channel itself, so the failure
+		#is only reported. Note that a rejected withdraw transaction may
+		#simply have been sent already by the peer.
+		if command == 'IOUChannel_getNewAddress':
+			#The channel stays in the opening state, so it never opens
+			#without an address:
+			log.log('Failed to get an IOUChannel address: ' + error)
+			return [], []
+
+		elif command == 'IOUChannel_makeCloseTransaction':
+			log.log('Failed to make the IOUChannel withdraw transaction: ' + \
+				error)
+			return [], []
 
-				self.withdrawTxID = tx.getTransactionID()[::-1].encode("hex")
+		elif command == 'sendRawTransaction':
+			log.log('Failed to send IOUChannel withdraw transaction %s: %s' % \
+				(self.withdrawTxID, error))
+			return [], []
+
+		raise Exception("Received unexpected bitcoin command failure")
+
+
+	def doClose(self):
+		"""
+		Return value:
+			tuple(list, list)
+		"""
+
+		if self.isIssuer:
+			self.state = self.states.closed
 
-				tx = tx.serialize()
+			amount = self.amountRemote
 
-				#TODO: for security, delay sending the transaction until all
-				#processing is finished. For that, create a new Bitcoin command type.
-				bitcoind.sendRawTransaction(tx)
+			#In case there is nothing to be sent, don't make a Bitcoin
+			#transaction. Tell the peer we close the channel without a
+			#transaction.
+			if amount == 0:
+				return [IOUChannel_WithdrawTransaction(transaction=None)], []
 
-				#Tell peer about the transaction
-				return [IOUChannel_WithdrawTransaction(transaction=tx)], []
-				
-			return [], [messages.BitcoinCommand(function=makeCloseTransaction)]
+			return [], \
+				[messages.BitcoinCommand(
+					command='IOUChannel_makeCloseTransaction',
+					arguments=[amount, self.address])]
 
 
 		#else (not self.isIssuer)
@@ -111,6 +111,35 @@ class PlainChannel(serializable.Serializable):
 		raise Exception("Received unexpected channel message")
 
 
+	def handleBitcoinReturnValue(self, command, value):
+		"""
+		Arguments:
+		command: str; the name of a BitcoinCommand sent by this channel
+		value: the return value of the command
+
+		Return value:
+			tuple(list, list)
+		"""
+
+		raise Exception("Received unexpected bitcoin return value")
+
+
+	def handleBitcoinCommandFailed(self, command, error):
+		"""
+		Called when a BitcoinCommand sent by this channel has failed, and
+		will not be retried.
+
+		Arguments:
+		command: str; the name of the BitcoinCommand
+		error: str; description of the error
+
+		Return value:
+			tuple(list, list)
+		"""
+
+		raise Exception("Received unexpected bitcoin command failure")
+
+
 	def startWithdraw(self):
 		"""
 		Return value:
@@ -27,9 +27,18 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import binascii
+import threading
+import Queue
+import shelve
+import fcntl
+import socket
+import httplib
 
 from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 
+from ..utils import bitcoinutils
+from ..utils.bitcointransaction import Transaction
+
 import log
 import messages
 
@@ -38,6 +47,130 @@ RPC_TRANSACTION_ALREADY_IN_CHAIN= -27 # Transaction already in chain
 
 
 
+class CacheInUse(Exception):
+	pass
+
+
+
+class BlockCache:
+	"""
+	On-disk cache of block chain data retrieved from a Bitcoin daemon.
+
+	Blocks are stored by height, and transactions by transaction hash.
+	Only transactions that are included in a block are stored.
+	Both contain a block hash; users of the cache must check it against the
+	main chain, so that data from blocks that were removed in a
+	re-organization is not used.
+
+	Access is thread-safe. The cache file can only be opened by one process
+	at a time; this is enforced with a lock file.
+	"""
+
+	def __init__(self, filename):
+		"""
+		Arguments:
+		filename: str; the cache file
+
+		Exceptions:
+		CacheInUse: the cache file is opened by another process
+		"""
+
+		#shelve doesn't support concurrent writers:
+		self.__lockFile = open(filename + '.lock', 'a')
+		try:
+			fcntl.flock(self.__lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			self.__lockFile.close()
+			raise CacheInUse('Cache file %s is in use' % filename)
+
+		self.__data = shelve.open(filename, protocol=2)
+		self.__lock = threading.Lock()
+
+
+	def close(self):
+		with self.__lock:
+			self.__data.close()
+			self.__lockFile.close() #releases the lock
+
+
+	def getBlock(self, height):
+		"""
+		Arguments:
+		height: int
+
+		Return value:
+		dict, or None if the block is not in the cache
+		"""
+
+		with self.__lock:
+			return self.__data.get('b%d' % height)
+
+
+	def getTransaction(self, thash):
+		"""
+		Arguments:
+		thash: str, hexadecimal, Bitcoin hash byte order
+
+		Return value:
+		dict, or None if the transaction is not in the cache
+		"""
+
+		with self.__lock:
+			return self.__data.get('t' + str(thash))
+
+
+	def update(self, blocks={}, transactions={}, removedTransactions=[]):
+		"""
+		Arguments:
+		blocks: dict of int (height) -> dict; blocks to be stored
+		transactions: dict of str (hash) -> dict; transactions to be stored
+		removedTransactions: list of str (hash); transactions to be removed
+
+		Removal is done before storing, so a transaction can be replaced by
+		removing and storing it.
+		"""
+
+		with self.__lock:
+			for thash in removedTransactions:
+				try:
+					del self.__data['t' + str(thash)]
+				except KeyError:
+					pass
+			for height, block in blocks.iteritems():
+				self.__data['b%d' % height] = block
+			for thash, tx in transactions.iteritems():
+				self.__data['t' + str(thash)] = tx
+			self.__data.sync()
+
+
+#Shared cache objects, by file name:
+blockCaches = {}
+blockCachesLock = threading.Lock()
+
+def getBlockCache(filename):
+	"""
+	Arguments:
+	filename: str; the cache file
+
+	Return value:
+	BlockCache, or None if the file is in use by another process
+
+	Returns the cache object for the given file. All users of the same file
+	in this process share the same object.
+	"""
+
+	with blockCachesLock:
+		if filename not in blockCaches:
+			try:
+				blockCaches[filename] = BlockCache(filename)
+			except CacheInUse:
+				log.log('Block chain cache file %s is in use by another process; not using the cache' % \
+					filename)
+				return None
+		return blockCaches[filename]
+
+
+
 class Bitcoind_Real:
 	"""
 	Connection to a Bitcoin daemon process.
@@ -46,16 +179,24 @@ class Bitcoind_Real:
 	def __init__(self, settings):
 		"""
 		Arguments:
-		settings: a settings object; must contain the attribute bitcoinRPCURL.
+		settings: a settings object; must contain the attributes bitcoinRPCURL,
+		          bitcoinRPCTimeout and bitcoinCacheFile.
 
 		Connects to a Bitcoin daemon process, indicated by settings.bitcoinRPCURL.
 		If settings.bitcoinRPCURL is empty, this object will not be connected.
+		Block chain data is cached in the file returned by
+		settings.getBitcoinCacheFile(), unless it is empty.
 		"""
 
+		self.cache = None
 		if settings.bitcoinRPCURL != "":
 			log.log("Making connection to Bitcoin daemon...")
-			self.access = AuthServiceProxy(settings.bitcoinRPCURL)
+			self.access = AuthServiceProxy(settings.bitcoinRPCURL,
+				timeout=settings.bitcoinRPCTimeout)
 			log.log("...done")
+			cacheFile = settings.getBitcoinCacheFile()
+			if cacheFile != "":
+				self.cache = getBlockCache(cacheFile)
 		else:
 			log.log("Bitcoin-RPC URL is not set: not connecting")
 			self.access = None
@@ -130,6 +271,107 @@ class Bitcoind_Real:
 		return self.access.dumpprivkey(address)
 
 
+	def getPrivateKeys(self, addresses):
+		"""
+		Arguments:
+		addresses: list of str, Base58Check-encoded addresses
+		Return value:
+		list of str, Base58Check-encoded private keys
+
+		Returns the private keys corresponding to the given addresses,
+		in the same order. Uses a single request to the Bitcoin daemon.
+		"""
+
+		return self.access.batch_(
+			[["dumpprivkey", address] for address in addresses])
+
+
+	def getBlocksByHeightRange(self, startHeight, endHeight):
+		"""
+		Arguments:
+		startHeight: int
+		endHeight: int
+
+		Return value:
+		list of dict; each element containing:
+			height: int; the block height
+			hash: str; the block hash (hexadecimal)
+			merkleroot: str; the block Merkle root (hexadecimal, Bitcoin hash byte order)
+			time: int; the block timestamp (UNIX time)
+			tx: list of str; the transaction hashes (hexadecimal, Bitcoin hash byte order)
+
+		Returns information about the blocks (in the main chain) with
+		startHeight <= height < endHeight, in order of increasing height.
+		Uses two requests to the Bitcoin daemon, independent of the number of
+		blocks. If all blocks are in the cache, only one request is used.
+		"""
+
+		heights = range(startHeight, endHeight)
+		bhashes = self.access.batch_(
+			[["getblockhash", height] for height in heights])
+
+		if self.cache is None:
+			blocks = [None for h in heights]
+		else:
+			blocks = [self.cache.getBlock(h) for h in heights]
+
+		#Blocks that are not cached, or that were replaced in a re-organization
+		missing = \
+		[
+			i for i in range(len(heights))
+			if blocks[i] is None or blocks[i]["hash"] != bhashes[i]
+		]
+		if len(missing) == 0:
+			return blocks
+
+		newBlocks = self.access.batch_(
+			[["getblock", bhashes[i]] for i in missing])
+		for i, binfo in zip(missing, newBlocks):
+			blocks[i] = \
+			{
+			"height": heights[i],
+			"hash": binfo["hash"],
+			"merkleroot": binfo["merkleroot"],
+			"time": binfo["time"],
+			"tx": binfo["tx"]
+			}
+
+		if self.cache is not None:
+			self.cache.update(blocks=dict(
+				(heights[i], blocks[i]) for i in missing))
+
+		return blocks
+
+
+	def getBlockByHash(self, bhash):
+		"""
+		Arguments:
+		bhash: str; the block hash (hexadecimal)
+
+		Return value:
+		dict; see getBlocksByHeightRange
+
+		Returns information about the block with the given hash.
+		Uses a single request to the Bitcoin daemon.
+		"""
+
+		binfo = self.access.getblock(bhash)
+		block = \
+		{
+		"height": binfo["height"],
+		"hash": binfo["hash"],
+		"merkleroot": binfo["merkleroot"],
+		"time": binfo["time"],
+		"tx": binfo["tx"]
+		}
+
+		#Only blocks in the main chain are cached
+		if self.cache is not None and binfo.get("confirmations", 0) > 0:
+			self.cache.update(blocks={block["height"]: block})
+
+		return block
+
+
 	def getBlockInfoByBlockHeight(self, height):
 		"""
 		Arguments:
@@ -144,8 +386,7 @@ class Bitcoind_Real:
 		Returns information about the block (in the main chain) at the
 		given height.
 		"""
-		bhash = self.access.getblockhash(height)
-		binfo = self.access.getblock(bhash)
+		binfo = self.getBlocksByHeightRange(height, height+1)[0]
 		return \
 		{
 		"hash": binfo["hash"],
@@ -165,9 +406,7 @@ class Bitcoind_Real:
 		given height.
 		"""
 
-		bhash = self.access.getblockhash(height)
-		block = self.access.getblock(bhash)
-		return block["tx"]
+		return self.getBlocksByHeightRange(height, height+1)[0]["tx"]
 
 
 	def getTransaction(self, thash):
@@ -188,7 +427,74 @@ class Bitcoind_Real:
 		Returns information about the transaction indicated by the given hash.
 		"""
 
-		return self.access.getrawtransaction(thash, 1)
+		return self.getTransactions([thash])[0]
+
+
+	def getTransactions(self, thashes):
+		"""
+		Arguments:
+		thashes: list of str, hexadecimal, Bitcoin hash byte order
+
+		Return value:
+		list of dict, in the same order as thashes; see getTransaction.
+
+		Returns information about the transactions indicated by the given
+		hashes. Uses a single request to the Bitcoin daemon; if the cache is
+		used, a second request is needed for transactions that are not cached.
+		"""
+
+		if self.cache is None:
+			return self.access.batch_(
+				[["getrawtransaction", thash, 1] for thash in thashes])
+
+		cached = {}
+		for thash in thashes:
+			tx = self.cache.getTransaction(thash)
+			if tx is not None:
+				cached[thash] = tx
+
+		#Check whether the cached transactions are still in the main chain
+		cachedHashes = cached.keys()
+		removed = []
+		if len(cachedHashes) > 0:
+			try:
+				results = self.access.batch_([["getblockcount"]] +
+					[["getblockhash", cached[t]["height"]] for t in cachedHashes])
+				blockCount = results[0]
+				removed = \
+				[
+					t for t, bhash in zip(cachedHashes, results[1:])
+					if bhash != cached[t]["blockhash"]
+				]
+			except JSONRPCException:
+				#A cached height is beyond the end of the main chain
+				removed = cachedHashes
+		for t in removed:
+			del cached[t]
+
+		missing = list(set(thashes) - set(cached.keys()))
+		newTransactions = {}
+		if len(missing) > 0:
+			results = self.access.batch_([["getblockcount"]] +
+				[["getrawtransaction", t, 1] for t in missing])
+			blockCount = results[0]
+			for t, tx in zip(missing, results[1:]):
+				if tx.get("confirmations", 0) > 0 and "blockhash" in tx:
+					tx["height"] = blockCount - tx["confirmations"] + 1
+					newTransactions[t] = tx
+				cached[t] = tx
+
+		if len(removed) > 0 or len(newTransactions) > 0:
+			self.cache.update(transactions=newTransactions,
+				removedTransactions=removed)
+
+		ret = []
+		for thash in thashes:
+			tx = dict(cached[thash])
+			if "height" in tx:
+				tx["confirmations"] = blockCount - tx["height"] + 1
+			ret.append(tx)
+		return ret
 
 
 	def importprivkey(self, privateKey, description, rescan):
@@ -244,24 +550,18 @@ class Bitcoind_Real:
 		return int(value*100000000)
 
 
-	def handleMessage(self, msg):
-		return \
-		[
-		messages.BitcoinReturnValue(
-			value=msg.function(self),
-			ID=msg.returnID, channelIndex=msg.returnChannelIndex)
-		]
-
-
 
 #This is a proxy-class that wraps different implementations.
 #The reason for having this is to be able to choose, at run-time, between a
-#real bitcoind connection, or (for testing purposes) a dummy.
+#real bitcoind connection, or (for testing purposes) a dummy or a simulator.
 class Bitcoind:
 	def __init__(self, settings):
 		if settings.bitcoinRPCURL == "dummy":
 			from bitcoind_dummy import Bitcoind_Dummy
 			self.bitcoind = Bitcoind_Dummy(settings)
+		elif settings.bitcoinRPCURL == "simulator":
+			from bitcoind_simulator import Bitcoind_Simulator
+			self.bitcoind = Bitcoind_Simulator(settings)
 		else:
 			self.bitcoind = Bitcoind_Real(settings)
 
@@ -270,3 +570,160 @@ class Bitcoind:
 		return getattr(self.bitcoind, attr, *args)
 
 
+
+def sendRawTransaction(bitcoind, txData):
+	try:
+		bitcoind.sendRawTransaction(txData)
+	finally:
+		#Whether it was sent or rejected, its inputs no longer need to be
+		#reserved against use by other transactions:
+		bitcoinutils.releaseInputs(Transaction.deserialize(txData))
+messages.registerBitcoinCommand(sendRawTransaction)
+
+
+def reservePendingInputs(commands):
+	"""
+	Reserves the inputs of the transactions in queued sendRawTransaction
+	commands. The reservations only exist in memory, so this must be done
+	for commands that were loaded from disk, before any other command can
+	select unspent outputs.
+
+	Arguments:
+	commands: list of BitcoinCommand; the queued commands
+	"""
+
+	for command in commands:
+		if command.command == 'sendRawTransaction':
+			bitcoinutils.reserveInputs(
+				Transaction.deserialize(command.arguments[0]))
+
+
+
+class BitcoinCommandExecutor:
+	"""
+	Executes BitcoinCommand messages in a pool of worker threads, so that
+	slow bitcoind calls don't block the node thread. Each worker thread has
+	its own Bitcoind object.
+
+	The results are collected as BitcoinReturnValue or BitcoinCommandFailed
+	messages, which can be retrieved with getResults().
+	"""
+
+	def __init__(self, settings, wakeup):
+		"""
+		Arguments:
+		settings: a settings object; bitcoinRPCURL and bitcoinWorkers are used.
+		wakeup: function; is called (by a worker thread) whenever a new
+		        result is available.
+		"""
+
+		self.__commands = Queue.Queue()
+		self.__results = Queue.Queue()
+		self.__wakeup = wakeup
+
+		#Held during the execution of exclusive commands:
+		self.__exclusiveLock = threading.Lock()
+
+		if settings.bitcoinWorkers < 1:
+			raise Exception(
+				"The number of bitcoind workers must be at least 1")
+
+		self.__workers = []
+		for i in range(settings.bitcoinWorkers):
+			w = threading.Thread(
+				name='%s bitcoind %d' % (settings.name, i),
+				target=self.__work, args=(Bitcoind(settings),))
+			#Don't keep the process alive if stop() is never called:
+			w.daemon = True
+			self.__workers.append(w)
+
+
+	def start(self):
+		for w in self.__workers:
+			w.start()
+
+
+	def stop(self):
+		"""
+		Stops the worker threads, after they have finished all submitted
+		commands.
+		"""
+
+		for w in self.__workers:
+			self.__commands.put(None)
+		for w in self.__workers:
+			w.join()
+
+
+	def submit(self, command):
+		"""
+		Arguments:
+		command: BitcoinCommand; the command to be executed. The command must
+		         not be modified by the caller afterwards.
+		"""
+
+		self.__commands.put(command)
+
+
+	def getResults(self):
+		"""
+		Return value:
+		list of BitcoinReturnValue and BitcoinCommandFailed; the results
+		that became available since the previous call.
+		"""
+
+		ret = []
+		while True:
+			try:
+				ret.append(self.__results.get_nowait())
+			except Queue.Empty:
+				return ret
+
+
+	def execute(self, bitcoind, command):
+		"""
+		Executes a command.
+
+		Arguments:
+		bitcoind: the Bitcoind object to be used
+		command: BitcoinCommand
+
+		Return value:
+		BitcoinReturnValue or BitcoinCommandFailed
+		"""
+
+		log.log('Executing bitcoin command %s' % command.command)
+		try:
+			function, isExclusive = \
+				messages.bitcoinCommandFunctions[command.command]
+			if isExclusive:
+				with self.__exclusiveLock:
+					value = function(bitcoind, *command.arguments)
+			else:
+				value = function(bitcoind, *command.arguments)
+		except Exception as e:
+			log.log('Bitcoin command %s failed:' % command.command)
+			log.logException()
+
+			#Connection errors and time-outs may be resolved later; other
+			#errors, like bitcoind rejecting the command with a
+			#JSONRPCException, will happen again.
+			isTransient = isinstance(e, (socket.error, httplib.HTTPException))
+
+			return messages.BitcoinCommandFailed(
+				commandID=command.ID, command=command.command, error=str(e),
+				isTransient=isTransient,
+				ID=command.returnID, channelIndex=command.returnChannelIndex)
+
+		return messages.BitcoinReturnValue(
+			commandID=command.ID, command=command.command, value=value,
+			ID=command.returnID, channelIndex=command.returnChannelIndex)
+
+
+	def __work(self, bitcoind):
+		while True:
+			command = self.__commands.get()
+			if command is None:
+				break
+			self.__results.put(self.execute(bitcoind, command))
+			self.__wakeup()
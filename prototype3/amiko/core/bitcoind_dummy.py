@@ -28,26 +28,99 @@
 
 import binascii
 import random
+import threading
 
 import log
-import messages
 
 from ..utils.crypto import *
 from ..utils import base58
 
 
 
-class Bitcoind_Dummy:
+class DummyWallet:
 	"""
-	Simulated connection to a Bitcoin daemon process.
+	The state of a Bitcoind_Dummy wallet.
 	"""
 
-	def __init__(self, settings):
+	#The number of unspent outputs returned by listUnspent:
+	numUnspent = 2
+
+
+	def __init__(self):
+		#Held while the state is used:
+		self.lock = threading.Lock()
+
 		self.random = random.Random()
 		self.random.seed(42)
-		self.keys = []
+		self.keys = {} #address -> Key
 		self.numConfirmations = {}
 
+		#A fixed set of unspent outputs, with keys from a separate sequence,
+		#so that listUnspent does not influence the addresses made by
+		#getNewAddress:
+		utxoRandom = random.Random()
+		utxoRandom.seed(43)
+		self.unspent = []
+		for i in range(self.numUnspent):
+			k = self.makeKey(utxoRandom)
+			self.unspent.append(
+				{
+				"address": getAddressFromKey(k),
+				"amount": 1000000000,
+				"scriptPubKey": "",
+				"txid": SHA256(k.getPublicKey()), #Wrong, but good enough for testing
+				"vout": 0
+				})
+
+
+	def makeKey(self, rnd=None):
+		if rnd is None:
+			rnd = self.random
+		newKey = Key()
+		privKey = "".join([chr(rnd.getrandbits(8)) for i in range(32)])
+		privKey += "\0" #indicate the use of compressed keys
+		newKey.setPrivateKey(privKey)
+		self.keys[getAddressFromKey(newKey)] = newKey
+		return newKey
+
+
+
+def getAddressFromKey(key):
+	return base58.encodeBase58Check(hash160(key.getPublicKey()), 0)
+
+
+#Shared wallets, by node name:
+wallets = {}
+walletsLock = threading.Lock()
+
+def getWallet(name):
+	"""
+	Arguments:
+	name: str; the name of the wallet
+
+	Return value:
+	DummyWallet; the wallet. It is made on the first call.
+	"""
+
+	with walletsLock:
+		if name not in wallets:
+			wallets[name] = DummyWallet()
+		return wallets[name]
+
+
+
+class Bitcoind_Dummy:
+	"""
+	Simulated connection to a Bitcoin daemon process.
+
+	Objects with the same settings.name share the same wallet, so that all
+	worker threads of a node see the same keys and outputs.
+	"""
+
+	def __init__(self, settings):
+		name = '' if settings is None else settings.name
+		self.wallet = getWallet(name)
+
 
 	def isConnected(self):
 		return True
@@ -62,80 +135,87 @@ class Bitcoind_Dummy:
 
 
 	def getNewAddress(self):
-		return self.__getAddressFromKey(self.__makeNewKey())
+		with self.wallet.lock:
+			return getAddressFromKey(self.wallet.makeKey())
 
 
 	def getPrivateKey(self, address):
-		for k in self.keys:
-			if self.__getAddressFromKey(k) == address:
-				return base58.encodeBase58Check(k.getPrivateKey(), 128)
+		return self.getPrivateKeys([address])[0]
 
-		while True:
-			k = self.__makeNewKey()
-			if self.__getAddressFromKey(k) == address:
-				return base58.encodeBase58Check(k.getPrivateKey(), 128)
 
+	def getPrivateKeys(self, addresses):
+		with self.wallet.lock:
+			for a in addresses:
+				if a not in self.wallet.keys:
+					raise Exception("Private key of address %s not found" % a)
 
-	def getTransactionHashesByBlockHeight(self, height):
-		return self.numConfirmations.keys()
+			return base58.encodeBase58CheckMany(
+				[self.wallet.keys[a].getPrivateKey() for a in addresses],
+				128) #PRIVKEY = 128
 
 
-	def getTransaction(self, thash):
-		#This is a partial, unfinished implementation
-		if thash in self.numConfirmations.keys():
-			self.numConfirmations[thash] += 1
-		else:
-			self.numConfirmations[thash] = 0
-		return {"confirmations": self.numConfirmations[thash]}
-
-
-	def importprivkey(self, privateKey, description, rescan):
-		pass
-
-
-	def listUnspent(self):
-		k1 = self.__makeNewKey()
-		k2 = self.__makeNewKey()
+	def getBlocksByHeightRange(self, startHeight, endHeight):
+		with self.wallet.lock:
+			txs = self.wallet.numConfirmations.keys()
 		return \
 		[
 			{
-			"address": self.__getAddressFromKey(k),
-			"amount": 1000000000,
-			"scriptPubKey": "",
-			"txid": SHA256(k.getPublicKey()), #Wrong, but good enough for testing
-			"vout": 0
+			"height": height,
+			"hash": SHA256(str(height))[::-1].encode("hex"), #Wrong, but good enough for testing
+			"merkleroot": SHA256(str(height))[::-1].encode("hex"), #Wrong, but good enough for testing
+			"time": 0,
+			"tx": txs
 			}
 
-			for k in [k1, k2]
+			for height in range(startHeight, endHeight)
 		]
 
 
-	def sendRawTransaction(self, txData):
-		pass
+	def getBlockByHash(self, bhash):
+		return self.getBlocksByHeightRange(0, 1)[0] #Wrong, but good enough for testing
 
 
-	def __makeNewKey(self):
-		newKey = Key()
-		privKey = "".join([chr(self.random.getrandbits(8)) for i in range(32)])
-		privKey += "\0" #indicate the use of compressed keys
-		newKey.setPrivateKey(privKey)
-		self.keys.append(newKey)
-		return newKey
+	def getBlockInfoByBlockHeight(self, height):
+		binfo = self.getBlocksByHeightRange(height, height+1)[0]
+		return \
+		{
+		"hash": binfo["hash"],
+		"merkleroot": binfo["merkleroot"],
+		"time": binfo["time"]
+		}
 
 
-	def __getAddressFromKey(self, key):
-		return base58.encodeBase58Check(
-			RIPEMD160(SHA256(key.getPublicKey())),
-			0)
+	def getTransactionHashesByBlockHeight(self, height):
+		with self.wallet.lock:
+			return self.wallet.numConfirmations.keys()
 
 
-	def handleMessage(self, msg):
-		return \
-		[
-		messages.BitcoinReturnValue(
-			value=msg.function(self),
-			ID=msg.returnID, channelIndex=msg.returnChannelIndex)
-		]
+	def getTransaction(self, thash):
+		#This is a partial, unfinished implementation
+		with self.wallet.lock:
+			numConfirmations = self.wallet.numConfirmations
+			if thash in numConfirmations.keys():
+				numConfirmations[thash] += 1
+			else:
+				numConfirmations[thash] = 0
+			return {"confirmations": numConfirmations[thash]}
+
+
+	def getTransactions(self, thashes):
+		return [self.getTransaction(thash) for thash in thashes]
+
+
+	def importprivkey(self, privateKey, description, rescan):
+		pass
+
+
+	def listUnspent(self):
+		with self.wallet.lock:
+			return [u.copy() for u in self.wallet.unspent]
+
+
+	def sendRawTransaction(self, txData):
+		pass
 
 
 
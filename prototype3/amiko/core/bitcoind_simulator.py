@@ -0,0 +1,758 @@
+#    bitcoind_simulator.py
+#    Copyright (C) 2016 by CJP
+#
+#    This file is part of Amiko Pay.
+#
+#    Amiko Pay is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Amiko Pay is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Amiko Pay. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Additional permission under GNU GPL version 3 section 7
+#
+#    If you modify this Program, or any covered work, by linking or combining it
+#    with the OpenSSL library (or a modified version of that library),
+#    containing parts covered by the terms of the OpenSSL License and the SSLeay
+#    License, the licensors of this Program grant you additional permission to
+#    convey the resulting work. Corresponding Source for a non-source form of
+#    such a combination shall include the source code for the parts of the
+#    OpenSSL library used as well as that of the covered work.
+
+
+import binascii
+import decimal
+import random
+import struct
+import threading
+import time
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+from ..utils.crypto import Key, hash160, doubleSHA256, publicKeyCache, \
+	verifyMany
+from ..utils import base58
+from ..utils.bitcointransaction import Transaction, TxIn, TxOut, Script, OP
+from ..utils.bitcointransaction import SigningSession
+from ..utils.merkle import getMerkleRoot
+
+
+#Error codes, as used by bitcoind:
+RPC_WALLET_ERROR = -4
+RPC_INVALID_ADDRESS_OR_KEY = -5
+RPC_INVALID_PARAMETER = -8
+RPC_DESERIALIZATION_ERROR = -22
+RPC_VERIFY_ERROR = -25
+RPC_VERIFY_REJECTED = -26
+
+
+
+def rpcError(code, message):
+	return JSONRPCException({"code": code, "message": message})
+
+
+def getStandardHash(scriptPubKey):
+	"""
+	Arguments:
+	scriptPubKey: Script
+
+	Return value:
+	str; the public key hash, if scriptPubKey is a standard Bitcoin
+	scriptPubKey, or None otherwise.
+	"""
+
+	e = list(scriptPubKey.elements)
+	if len(e) == 5 and \
+		e[0] == OP.DUP and e[1] == OP.HASH160 and \
+		e[3] == OP.EQUALVERIFY and e[4] == OP.CHECKSIG and \
+		isinstance(e[2], str) and len(e[2]) == 20:
+			return e[2]
+	return None
+
+
+def getMultiSigKeys(scriptPubKey):
+	"""
+	Arguments:
+	scriptPubKey: Script
+
+	Return value:
+	tuple (int, list of str); the number of required signatures and the
+	public keys, if scriptPubKey is a multi-signature scriptPubKey, or None
+	otherwise.
+	"""
+
+	e = list(scriptPubKey.elements)
+	if len(e) < 4 or e[-1] != OP.CHECKMULTISIG:
+		return None
+	OP_1 = OP.TWO - 1
+	pubKeys = e[1:-2]
+	if not isinstance(e[0], int) or not isinstance(e[-2], int) or \
+		e[-2] - OP_1 + 1 != len(pubKeys) or \
+		not 1 <= e[0] - OP_1 + 1 <= len(pubKeys) or \
+		not all(isinstance(k, str) for k in pubKeys):
+			return None
+	return e[0] - OP_1 + 1, pubKeys
+
+
+def checkSignatures(bodyHash, pubKeys, signatures):
+	"""
+	Checks signatures in the same way as OP_CHECKMULTISIG: the signatures
+	must correspond to public keys in the same order.
+
+	Arguments:
+	bodyHash: str; the signed data
+	pubKeys: list of str; the public keys
+	signatures: list of str; the signatures, including the hash type
+
+	Return value:
+	bool; indicates whether all signatures are correct
+	"""
+
+	pubKeys = list(pubKeys)
+	for sig in signatures:
+		while True:
+			if len(pubKeys) == 0:
+				return False
+			try:
+				key = publicKeyCache.getKey(pubKeys.pop(0))
+				if key.verify(bodyHash, sig[:-1]):
+					break
+			except Exception:
+				pass #invalid key or signature encoding: no match
+	return True
+
+
+def verifyInputs(tx, scriptPubKeys):
+	"""
+	Checks the signatures of the inputs of a transaction.
+	Only inputs that spend standard or multi-signature outputs are checked;
+	other inputs are accepted as they are.
+	Only SIGHASH_ALL signatures are supported.
+
+	Arguments:
+	tx: Transaction; the transaction
+	scriptPubKeys: list of Script; for each input, the scriptPubKey of the
+	               output it spends
+
+	Return value:
+	bool; indicates whether all checked signatures are correct
+	"""
+
+	hashType = 1 #SIGHASH_ALL
+	session = SigningSession(tx)
+	items = []
+	for i, scriptPubKey in enumerate(scriptPubKeys):
+		elements = list(tx.tx_in[i].scriptSig.elements)
+
+		pubKeyHash = getStandardHash(scriptPubKey)
+		multiSig = getMultiSigKeys(scriptPubKey)
+		if pubKeyHash is not None:
+			if len(elements) != 2 or not isinstance(elements[1], str) or \
+				hash160(elements[1]) != pubKeyHash:
+					return False
+			pubKeys, signatures = elements[1:], elements[:1]
+		elif multiSig is not None:
+			numRequired, pubKeys = multiSig
+			#The first element is a dummy value, because of a bug in
+			#OP_CHECKMULTISIG:
+			if len(elements) != numRequired + 1:
+				return False
+			signatures = elements[1:]
+		else:
+			continue
+
+		for sig in signatures:
+			if not isinstance(sig, str) or len(sig) < 2 or ord(sig[-1]) != hashType:
+				return False
+
+		bodyHash = session.getSignatureBodyHash(i, scriptPubKey, hashType)
+		if len(signatures) == len(pubKeys):
+			#Each signature must match the key at the same position, so
+			#these can be verified together with the other inputs:
+			try:
+				keys = [publicKeyCache.getKey(k) for k in pubKeys]
+			except Exception:
+				return False #invalid key
+			items += [(k, bodyHash, sig[:-1])
+				for k, sig in zip(keys, signatures)]
+		elif not checkSignatures(bodyHash, pubKeys, signatures):
+			return False
+
+	try:
+		return all(verifyMany(items))
+	except Exception:
+		return False #invalid signature encoding
+
+
+
+class SimulatedWallet:
+	"""
+	The keys of a simulated Bitcoin daemon.
+	Keys are generated from a pseudo-random sequence that depends on the
+	wallet name, so that simulations are reproducible.
+
+	Note: access must be protected with the lock of the chain that contains
+	the wallet.
+	"""
+
+	def __init__(self, name):
+		self.random = random.Random()
+		self.random.seed("wallet " + name)
+		self.keys = {} #address -> Key
+		self.addresses = {} #public key hash -> address
+
+
+	def makeNewKey(self):
+		"""
+		Return value:
+		str; the address of the new key
+		"""
+
+		privateKey = "".join([chr(self.random.getrandbits(8)) for i in range(32)])
+		privateKey += "\1" #indicate the use of compressed keys
+		return self.importPrivateKey(privateKey)
+
+
+	def importPrivateKey(self, privateKey):
+		"""
+		Arguments:
+		privateKey: str; the private key data (see Key.setPrivateKey)
+
+		Return value:
+		str; the address of the key
+		"""
+
+		key = Key()
+		key.setPrivateKey(privateKey)
+		pubKeyHash = hash160(key.getPublicKey())
+		address = base58.encodeBase58Check(pubKeyHash, 0) #PUBKEY_ADDRESS = 0
+		self.keys[address] = key
+		self.addresses[pubKeyHash] = address
+		return address
+
+
+	def getPrivateKey(self, address):
+		"""
+		Arguments:
+		address: str, Base58Check-encoded address
+
+		Return value:
+		str, Base58Check-encoded private key
+		"""
+
+		try:
+			key = self.keys[address]
+		except KeyError:
+			raise rpcError(RPC_WALLET_ERROR,
+				"Private key for address %s is not known" % address)
+		return base58.encodeBase58Check(key.getPrivateKey(), 128) #PRIVKEY = 128
+
+
+
+class SimulatedChain:
+	"""
+	In-memory block chain, with a set of unspent transaction outputs and a
+	mempool. It also contains the wallets of the simulated Bitcoin daemons,
+	one per node name.
+
+	New blocks are only made by generate, which can also be called
+	periodically by a timer thread (see startBlockTimer). Blocks have real
+	headers and Merkle roots, but there is no proof of work, there are no
+	re-organizations, and coinbase outputs can be spent immediately.
+
+	Access is thread-safe.
+	"""
+
+	blockSubsidy = 5000000000 #50 BTC
+	bits = 0x207fffff #as in regtest; not checked
+
+	#The number of blocks mined to a new wallet, to give it a starting balance:
+	initialBlocks = 2
+
+
+	def __init__(self):
+		self.lock = threading.RLock()
+
+		#Each element: dict, as returned by getBlocksByHeightRange; index = height
+		self.blocks = []
+		self.blockHeights = {} #block hash (hexadecimal) -> height
+
+		#Transaction ID (binary, OpenSSL byte order) -> dict, containing:
+		#  tx: Transaction
+		#  data: str; the serialized transaction
+		#  fee: int; the fee (in Satoshi)
+		#  height: int; the height of the block that contains it, or None
+		self.transactions = {}
+
+		#Outpoints are tuples (transaction ID, output index).
+		self.unspent = {} #outpoint -> TxOut, for confirmed outputs
+		self.unspentByHash = {} #public key hash -> set of outpoints
+
+		self.mempool = [] #transaction IDs, in order of arrival
+		self.mempoolOutputs = {} #outpoint -> TxOut
+		self.mempoolSpent = set() #outpoints
+
+		self.wallets = {} #name -> SimulatedWallet
+
+		self.timerThread = None
+		self.timerStop = None
+
+		#Block rewards that don't go to a wallet go to this key hash:
+		self.minerHash = hash160("Amiko Pay simulated miner")
+
+		self.generate(1) #genesis block
+
+
+	def getWallet(self, name):
+		"""
+		Arguments:
+		name: str; the name of the wallet
+
+		Return value:
+		SimulatedWallet; the wallet. If it doesn't exist yet, it is made, and
+		it receives the rewards of initialBlocks new blocks.
+		"""
+
+		with self.lock:
+			wallet = self.wallets.get(name)
+			if wallet is None:
+				wallet = SimulatedWallet(name)
+				self.wallets[name] = wallet
+				for i in range(self.initialBlocks):
+					address = wallet.makeNewKey()
+					self.generate(1, base58.decodeBase58Check(address, 0))
+			return wallet
+
+
+	def generate(self, numBlocks, pubKeyHash=None):
+		"""
+		Makes new blocks. The first new block contains all transactions in
+		the mempool.
+
+		Arguments:
+		numBlocks: int; the number of blocks
+		pubKeyHash: str; the public key hash that receives the block rewards
+		            (default: minerHash)
+
+		Return value:
+		list of str; the hashes of the new blocks (hexadecimal)
+		"""
+
+		if pubKeyHash is None:
+			pubKeyHash = self.minerHash
+
+		with self.lock:
+			return [self.__makeBlock(pubKeyHash) for i in range(numBlocks)]
+
+
+	def startBlockTimer(self, interval):
+		"""
+		Starts a thread that makes a new block every interval seconds.
+		Does nothing if such a thread is already running.
+
+		Arguments:
+		interval: float; the time between blocks (in seconds)
+		"""
+
+		with self.lock:
+			if self.timerThread is not None:
+				return
+			self.timerStop = threading.Event()
+			self.timerThread = threading.Thread(
+				target=self.__runBlockTimer, args=(interval, self.timerStop))
+			self.timerThread.daemon = True
+			self.timerThread.start()
+
+
+	def stopBlockTimer(self):
+		"""
+		Stops the thread started by startBlockTimer, if it is running.
+		"""
+
+		with self.lock:
+			thread, stop = self.timerThread, self.timerStop
+			self.timerThread = self.timerStop = None
+
+		if thread is not None:
+			stop.set()
+			thread.join()
+
+
+	def sendRawTransaction(self, txData):
+		"""
+		Adds a transaction to the mempool, after checking it.
+		Does nothing if the transaction is already known.
+
+		Arguments:
+		txData: str; the serialized transaction
+
+		Exceptions:
+		JSONRPCException: the transaction is not valid
+		"""
+
+		try:
+			tx = Transaction.deserialize(txData)
+		except Exception:
+			raise rpcError(RPC_DESERIALIZATION_ERROR, "TX decode failed")
+
+		txID = doubleSHA256(txData)
+
+		with self.lock:
+			if txID in self.transactions:
+				return
+
+			if len(tx.tx_in) == 0 or len(tx.tx_out) == 0:
+				raise rpcError(RPC_VERIFY_REJECTED, "bad-txns-vin-or-vout-empty")
+
+			spent = set()
+			inputs = []
+			for tx_in in tx.tx_in:
+				outpoint = (tx_in.previousOutputHash, tx_in.previousOutputIndex)
+				if outpoint in spent or outpoint in self.mempoolSpent:
+					raise rpcError(RPC_VERIFY_REJECTED, "txn-mempool-conflict")
+				output = self.unspent.get(outpoint, self.mempoolOutputs.get(outpoint))
+				if output is None:
+					raise rpcError(RPC_VERIFY_ERROR, "Missing inputs")
+				spent.add(outpoint)
+				inputs.append(output)
+
+			fee = sum([o.amount for o in inputs]) - sum([o.amount for o in tx.tx_out])
+			if fee < 0:
+				raise rpcError(RPC_VERIFY_REJECTED, "bad-txns-in-belowout")
+
+			if not verifyInputs(tx, [o.scriptPubKey for o in inputs]):
+				raise rpcError(RPC_VERIFY_REJECTED,
+					"mandatory-script-verify-flag-failed")
+
+			self.transactions[txID] = \
+				{"tx": tx, "data": txData, "fee": fee, "height": None}
+			self.mempool.append(txID)
+			self.mempoolSpent |= spent
+			for i, tx_out in enumerate(tx.tx_out):
+				self.mempoolOutputs[(txID, i)] = tx_out
+
+
+	def getBlockCount(self):
+		with self.lock:
+			return len(self.blocks) - 1
+
+
+	def getBlocksByHeightRange(self, startHeight, endHeight):
+		with self.lock:
+			if startHeight < 0 or endHeight > len(self.blocks):
+				raise rpcError(RPC_INVALID_PARAMETER, "Block height out of range")
+			return [self.__copyBlock(b) for b in self.blocks[startHeight:endHeight]]
+
+
+	def getBlockByHash(self, bhash):
+		with self.lock:
+			try:
+				return self.__copyBlock(self.blocks[self.blockHeights[bhash]])
+			except KeyError:
+				raise rpcError(RPC_INVALID_ADDRESS_OR_KEY, "Block not found")
+
+
+	def getTransaction(self, thash):
+		"""
+		Arguments:
+		thash: str, hexadecimal, Bitcoin hash byte order
+
+		Return value:
+		dict; see Bitcoind_Real.getTransaction. Also contains txid, vout
+		and, for confirmed transactions, blockhash and blocktime.
+		"""
+
+		with self.lock:
+			entry = self.transactions.get(binascii.unhexlify(thash)[::-1])
+			if entry is None:
+				raise rpcError(RPC_INVALID_ADDRESS_OR_KEY,
+					"No information available about transaction")
+
+			tx = entry["tx"]
+			vin = []
+			for tx_in in tx.tx_in:
+				scriptSig = tx_in.scriptSig.serialize().encode("hex")
+				if tx_in.previousOutputHash == "\0"*32:
+					vin.append({"coinbase": scriptSig, "sequence": 0xffffffff})
+				else:
+					vin.append(
+						{
+						"txid": tx_in.previousOutputHash[::-1].encode("hex"),
+						"vout": tx_in.previousOutputIndex,
+						"scriptSig": {"hex": scriptSig},
+						"sequence": 0xffffffff
+						})
+			vout = \
+			[
+				{
+				"value": decimal.Decimal(tx_out.amount) / 100000000,
+				"n": i,
+				"scriptPubKey": {"hex": tx_out.scriptPubKey.serialize().encode("hex")}
+				}
+				for i, tx_out in enumerate(tx.tx_out)
+			]
+
+			ret = {"txid": thash, "hex": entry["data"].encode("hex"),
+				"vin": vin, "vout": vout}
+			height = entry["height"]
+			if height is not None:
+				block = self.blocks[height]
+				ret["blockhash"] = block["hash"]
+				ret["blocktime"] = block["time"]
+				ret["confirmations"] = len(self.blocks) - height
+			return ret
+
+
+	def listUnspent(self, wallet):
+		"""
+		Arguments:
+		wallet: SimulatedWallet
+
+		Return value:
+		list; see Bitcoind_Real.listUnspent. Only confirmed outputs are
+		listed, and outputs that are spent by transactions in the mempool
+		are left out.
+		"""
+
+		with self.lock:
+			ret = []
+			for pubKeyHash, address in wallet.addresses.iteritems():
+				for outpoint in self.unspentByHash.get(pubKeyHash, []):
+					if outpoint in self.mempoolSpent:
+						continue
+					tx_out = self.unspent[outpoint]
+					ret.append(
+						{
+						"address": address,
+						"amount": tx_out.amount,
+						"scriptPubKey": tx_out.scriptPubKey.serialize(),
+						"txid": outpoint[0],
+						"vout": outpoint[1],
+						"confirmations":
+							len(self.blocks) - self.transactions[outpoint[0]]["height"]
+						})
+			ret.sort(key=lambda u: (u["txid"], u["vout"]))
+			return ret
+
+
+	def __copyBlock(self, block):
+		ret = dict(block)
+		ret["tx"] = list(block["tx"])
+		return ret
+
+
+	def __makeBlock(self, pubKeyHash):
+		height = len(self.blocks)
+		txIDs = self.mempool
+		fees = sum([self.transactions[t]["fee"] for t in txIDs])
+
+		#BIP 34: the height in the coinbase makes its transaction ID unique
+		coinbaseIn = TxIn("\0"*32, 0xffffffff)
+		coinbaseIn.scriptSig = Script([struct.pack('<I', height)])
+		coinbase = Transaction([coinbaseIn],
+			[TxOut(self.blockSubsidy + fees, Script.standardPubKey(pubKeyHash))])
+		coinbaseData = coinbase.serialize()
+		coinbaseID = doubleSHA256(coinbaseData)
+		self.transactions[coinbaseID] = \
+			{"tx": coinbase, "data": coinbaseData, "fee": 0, "height": None}
+		txIDs = [coinbaseID] + txIDs
+
+		for txID in txIDs:
+			entry = self.transactions[txID]
+			entry["height"] = height
+			if txID != coinbaseID:
+				for tx_in in entry["tx"].tx_in:
+					self.__removeUnspent(
+						(tx_in.previousOutputHash, tx_in.previousOutputIndex))
+			for i, tx_out in enumerate(entry["tx"].tx_out):
+				self.__addUnspent((txID, i), tx_out)
+
+		self.mempool = []
+		self.mempoolOutputs = {}
+		self.mempoolSpent = set()
+
+		if height == 0:
+			previousHash = "\0"*32
+			blockTime = int(time.time())
+		else:
+			previousHash = binascii.unhexlify(self.blocks[-1]["hash"])[::-1]
+			blockTime = max(int(time.time()), self.blocks[-1]["time"])
+		merkleRoot = getMerkleRoot(txIDs)
+		header = struct.pack('<I', 1) + previousHash + merkleRoot + \
+			struct.pack('<III', blockTime, self.bits, 0)
+		bhash = doubleSHA256(header)[::-1].encode("hex")
+
+		self.blocks.append(
+			{
+			"height": height,
+			"hash": bhash,
+			"merkleroot": merkleRoot[::-1].encode("hex"),
+			"time": blockTime,
+			"tx": [t[::-1].encode("hex") for t in txIDs]
+			})
+		self.blockHeights[bhash] = height
+		return bhash
+
+
+	def __addUnspent(self, outpoint, tx_out):
+		self.unspent[outpoint] = tx_out
+		pubKeyHash = getStandardHash(tx_out.scriptPubKey)
+		if pubKeyHash is not None:
+			self.unspentByHash.setdefault(pubKeyHash, set()).add(outpoint)
+
+
+	def __removeUnspent(self, outpoint):
+		tx_out = self.unspent.pop(outpoint)
+		pubKeyHash = getStandardHash(tx_out.scriptPubKey)
+		if pubKeyHash is not None:
+			self.unspentByHash[pubKeyHash].discard(outpoint)
+
+
+	def __runBlockTimer(self, interval, stop):
+		while not stop.wait(interval):
+			self.generate(1)
+
+
+
+#The chain that is shared by all Bitcoind_Simulator objects:
+simulatedChain = None
+simulatedChainLock = threading.Lock()
+
+def getSimulatedChain():
+	"""
+	Return value:
+	SimulatedChain; the shared chain. It is made on the first call.
+	"""
+
+	global simulatedChain
+
+	with simulatedChainLock:
+		if simulatedChain is None:
+			simulatedChain = SimulatedChain()
+		return simulatedChain
+
+
+
+class Bitcoind_Simulator:
+	"""
+	Simulated Bitcoin daemon, with an in-memory block chain, for testing
+	without a connection to a real Bitcoin daemon.
+
+	All objects share the same chain. Objects with the same settings.name
+	share the same wallet, so that all worker threads of a node see the
+	same keys and outputs.
+	"""
+
+	def __init__(self, settings, chain=None):
+		"""
+		Arguments:
+		settings: a settings object; must contain the attributes name and
+		          bitcoinSimulatorBlockInterval.
+		chain: SimulatedChain; the chain to use (default: the shared chain)
+
+		If settings.bitcoinSimulatorBlockInterval is larger than zero, a new
+		block is made every bitcoinSimulatorBlockInterval seconds.
+		"""
+
+		if chain is None:
+			chain = getSimulatedChain()
+		self.chain = chain
+		self.wallet = chain.getWallet(settings.name)
+
+		if settings.bitcoinSimulatorBlockInterval > 0:
+			chain.startBlockTimer(settings.bitcoinSimulatorBlockInterval)
+
+
+	def isConnected(self):
+		return True
+
+
+	def getBalance(self):
+		return sum([u["amount"] for u in self.listUnspent()])
+
+
+	def getBlockCount(self):
+		return self.chain.getBlockCount()
+
+
+	def getNewAddress(self):
+		with self.chain.lock:
+			return self.wallet.makeNewKey()
+
+
+	def getPrivateKey(self, address):
+		with self.chain.lock:
+			return self.wallet.getPrivateKey(address)
+
+
+	def getPrivateKeys(self, addresses):
+		with self.chain.lock:
+			return [self.wallet.getPrivateKey(a) for a in addresses]
+
+
+	def getBlocksByHeightRange(self, startHeight, endHeight):
+		return self.chain.getBlocksByHeightRange(startHeight, endHeight)
+
+
+	def getBlockByHash(self, bhash):
+		return self.chain.getBlockByHash(bhash)
+
+
+	def getBlockInfoByBlockHeight(self, height):
+		binfo = self.getBlocksByHeightRange(height, height+1)[0]
+		return \
+		{
+		"hash": binfo["hash"],
+		"merkleroot": binfo["merkleroot"],
+		"time": binfo["time"]
+		}
+
+
+	def getTransactionHashesByBlockHeight(self, height):
+		return self.getBlocksByHeightRange(height, height+1)[0]["tx"]
+
+
+	def getTransaction(self, thash):
+		return self.chain.getTransaction(thash)
+
+
+	def getTransactions(self, thashes):
+		with self.chain.lock:
+			return [self.chain.getTransaction(thash) for thash in thashes]
+
+
+	def importprivkey(self, privateKey, description, rescan):
+		privateKey = base58.decodeBase58Check(privateKey, 128) #PRIVKEY = 128
+		with self.chain.lock:
+			self.wallet.importPrivateKey(privateKey)
+
+
+	def listUnspent(self):
+		return self.chain.listUnspent(self.wallet)
+
+
+	def sendRawTransaction(self, txData):
+		self.chain.sendRawTransaction(txData)
+
+
+	def generate(self, numBlocks):
+		"""
+		Arguments:
+		numBlocks: int; the number of blocks
+
+		Return value:
+		list of str; the hashes of the new blocks (hexadecimal)
+
+		Makes new blocks, with rewards that go to a new address in the wallet.
+		"""
+
+		with self.chain.lock:
+			address = self.wallet.makeNewKey()
+			return self.chain.generate(numBlocks, base58.decodeBase58Check(address, 0))
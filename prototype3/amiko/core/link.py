@@ -47,12 +47,13 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 	def handleMessage(self, msg):
 		return \
 		{
-		messages.Link_Deposit      : self.msg_ownDeposit,
-		messages.Link_Withdraw     : self.msg_ownWithdraw,
-		messages.Deposit           : self.msg_peerDeposit,
-		messages.BitcoinReturnValue: self.msg_bitcoinReturnValue,
-		messages.LinkTimeout_Commit: self.msg_LinkTimeout_Commit,
-		messages.ChannelMessage    : self.continueChannelConversation,
+		messages.Link_Deposit        : self.msg_ownDeposit,
+		messages.Link_Withdraw       : self.msg_ownWithdraw,
+		messages.Deposit             : self.msg_peerDeposit,
+		messages.BitcoinReturnValue  : self.msg_bitcoinReturnValue,
+		messages.BitcoinCommandFailed: self.msg_bitcoinCommandFailed,
+		messages.LinkTimeout_Commit  : self.msg_LinkTimeout_Commit,
+		messages.ChannelMessage      : self.continueChannelConversation,
 		}[msg.__class__](msg)
 
 
@@ -101,7 +102,19 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 
 
 	def msg_bitcoinReturnValue(self, msg):
-		return self.handleChannelOutput(msg.channelIndex, msg.value)
+		channel = self.channels[msg.channelIndex]
+		return self.handleChannelOutput(
+			msg.channelIndex,
+			channel.handleBitcoinReturnValue(msg.command, msg.value)
+			)
+
+
+	def msg_bitcoinCommandFailed(self, msg):
+		channel = self.channels[msg.channelIndex]
+		return self.handleChannelOutput(
+			msg.channelIndex,
+			channel.handleBitcoinCommandFailed(msg.command, msg.error)
+			)
 
 
 	def makeRouteOutgoing(self, msg):
@@ -121,7 +134,7 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 
 			log.log("Reserving on channel %d succeeded" % i)
 
-			msg = copy.deepcopy(msg)
+			msg = copy.copy(msg)
 			msg.ID = self.remoteID
 			msg.channelIndex = i
 
@@ -185,7 +198,7 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 			c.unreserve(isOutgoing, routeID)
 			)
 
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.remoteID
 		return ret + [messages.OutboundMessage(localID=self.localID, message=msg)]
 
@@ -209,7 +222,7 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 		c.updateReservation(isOutgoing, routeID, msg.startTime, msg.endTime)
 
 		#Forward to peer:
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.remoteID
 		return [messages.OutboundMessage(localID=self.localID, message=msg)]
 
@@ -232,7 +245,7 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 		commitTimeout = c.getOutgoingCommitTimeout(routeID)
 
 		#TODO: add payload
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.remoteID
 		msg.channelIndex = ci
 		return \
@@ -264,7 +277,7 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 
 
 	def requestCommitOutgoing(self, msg):
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.remoteID
 		return [messages.OutboundMessage(localID=self.localID, message=msg)]
 
@@ -289,20 +302,15 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 			)
 
 		#TODO: add payload
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.remoteID
 		return ret + \
 		[
 			messages.OutboundMessage(localID=self.localID, message=msg),
-			messages.FilterTimeouts(function = lambda message: \
-				not(
-					isinstance(message, messages.LinkTimeout_Commit)
-					and
-					message.transactionID == transactionID
-					and
-					message.isPayerSide == msg.isPayerSide
-					and
-					message.ID == self.localID
+			messages.CancelTimeout(message=messages.LinkTimeout_Commit(
+				transactionID=transactionID,
+				isPayerSide=msg.isPayerSide,
+				ID=self.localID
 				))
 		]
 
@@ -329,7 +337,7 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 			)
 
 		#TODO: add payload
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.remoteID
 		return ret + [messages.OutboundMessage(localID=self.localID, message=msg)]
 
@@ -343,15 +351,10 @@ class Link(linkbase.LinkBase, serializable.Serializable):
 			c.settleRollbackIncoming(routeID)
 			) + \
 		[
-			messages.FilterTimeouts(function = lambda message: \
-				not(
-					isinstance(message, messages.LinkTimeout_Commit)
-					and
-					message.transactionID == msg.transactionID
-					and
-					message.isPayerSide == msg.isPayerSide
-					and
-					message.ID == self.localID
+			messages.CancelTimeout(message=messages.LinkTimeout_Commit(
+				transactionID=msg.transactionID,
+				isPayerSide=msg.isPayerSide,
+				ID=self.localID
 				))
 		]
 
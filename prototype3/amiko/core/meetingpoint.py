@@ -93,28 +93,28 @@ class MeetingPoint(linkbase.LinkBase, serializable.Serializable):
 
 
 	def lockOutgoing(self, msg):
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.ID
 		msg.isPayerSide = False
 		return [msg]
 
 
 	def requestCommitOutgoing(self, msg):
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.ID
 		msg.isPayerSide = True
 		return [msg]
 
 
 	def settleCommitOutgoing(self, msg):
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.ID
 		msg.isPayerSide = False
 		return [msg]
 
 
 	def settleRollbackOutgoing(self, msg):
-		msg = copy.deepcopy(msg)
+		msg = copy.copy(msg)
 		msg.ID = self.ID
 		msg.isPayerSide = True
 		return [msg]
@@ -26,7 +26,6 @@
 #    such a combination shall include the source code for the parts of the
 #    OpenSSL library used as well as that of the covered work.
 
-import copy
 
 from ..utils import serializable
 from ..utils import utils
@@ -46,26 +45,27 @@ payerLocalID = "__payer__"
 #Abstract base class
 class Message:
 	def __init__(self, **kwargs):
-		attributes = self.__class__.attributes
-		for name in attributes.keys():
-			setattr(self, name, copy.deepcopy(
-					kwargs[name]
-				if name in kwargs else
-					attributes[name] #default value
-				))
+		#Note: the message takes ownership of the values in kwargs.
+		serializable.initAttributes(self, self.__class__.attributes, kwargs)
 
 
-class BitcoinCommand(Message):
+class BitcoinReturnValue(Message):
+	#commandID, command: ID and name of the BitcoinCommand
+	#ID, channelIndex: the channel that sent the BitcoinCommand
 	attributes = {
-		#Function accepts a bitcoind object as argument. The return value will
-		#be emitted, wrapped in a BitcoinReturnValue message.
-		'function': (lambda bitcoind: (None, None)),
-		'returnID': '',
-		'returnChannelIndex': 0}
+		'commandID': None, 'command': '', 'value': None,
+		'ID': '', 'channelIndex': 0}
 
 
-class BitcoinReturnValue(Message):
-	attributes = {'value': None, 'ID': '', 'channelIndex': 0}
+class BitcoinCommandFailed(Message):
+	#commandID, command: ID and name of the BitcoinCommand
+	#ID, channelIndex: the channel that sent the BitcoinCommand
+	#error: str; description of the error
+	#isTransient: bool; True if the command might succeed when it is retried,
+	#             e.g. after a connection error or a time-out
+	attributes = {
+		'commandID': None, 'command': '', 'error': '', 'isTransient': False,
+		'ID': '', 'channelIndex': 0}
 
 
 class Confirmation(Message):
@@ -115,8 +115,10 @@ class SetEvent(Message):
 	attributes = {'event': None}
 
 
-class FilterTimeouts(Message):
-	attributes = {'function': lambda message: True}
+class CancelTimeout(Message):
+	#message: a time-out message, as in TimeoutMessage.message.
+	#All time-outs with the same key (see getTimeoutKey) are cancelled.
+	attributes = {'message': None}
 
 
 class NodeState_TimeoutRollback(Message):
@@ -260,32 +262,88 @@ serializable.registerClass(SettleRollback)
 ################################################################################
 
 
+#Functions that can be executed by BitcoinCommand messages, indexed by name.
+#Each element is a tuple (function, isExclusive).
+bitcoinCommandFunctions = {}
+
+def registerBitcoinCommand(function, isExclusive=False):
+	"""
+	Registers a function under its name, so that it can be executed by
+	BitcoinCommand messages.
+
+	Arguments:
+	function: function; accepts a bitcoind object, followed by the arguments
+	          of the command. The return value will be emitted, wrapped in a
+	          BitcoinReturnValue message.
+	isExclusive: bool; if True, the function is never executed concurrently
+	             with other exclusive functions. Use this for functions that
+	             select unspent outputs from the wallet.
+	"""
+	if function.__name__ in bitcoinCommandFunctions.keys():
+		raise Exception("Multiple bitcoin commands with the same name: " + function.__name__)
+	bitcoinCommandFunctions[function.__name__] = (function, isExclusive)
+
+
+class BitcoinCommand(serializable.Serializable):
+	#command: the name of a function registered with registerBitcoinCommand
+	#arguments: list; the arguments of the function
+	#ID: assigned by the node state, when the command is queued
+	#returnID, returnChannelIndex: the channel that sent the command
+	#numRetries: the number of times the command was retried after a failure
+	serializableAttributes = {
+		'ID': None, 'command': '', 'arguments': [],
+		'returnID': '', 'returnChannelIndex': 0, 'numRetries': 0}
+serializable.registerClass(BitcoinCommand)
+
+
 class OutboundMessage(serializable.Serializable):
 	serializableAttributes = {'localID': '', 'message': None}
 serializable.registerClass(OutboundMessage)
 
 
 class TimeoutMessage(serializable.Serializable):
+	#Note: message is set to None when the time-out is cancelled.
 	serializableAttributes = {'timestamp': 0.0, 'message': None}
+
+	def __lt__(self, other):
+		return self.timestamp < other.timestamp
 serializable.registerClass(TimeoutMessage)
 
 
+def getTimeoutKey(message):
+	'''
+	Returns the key of a time-out message (as in TimeoutMessage.message), by
+	which the time-out can be cancelled. The key consists of the class name
+	and the values of the attributes in the timeoutKeyAttributes of the class.
+	Messages of classes without timeoutKeyAttributes have None as key: these
+	time-outs can not be cancelled.
+	'''
+	if not hasattr(message, 'timeoutKeyAttributes'):
+		return None
+	return (message.__class__.__name__,) + \
+		tuple(getattr(message, name) for name in message.timeoutKeyAttributes)
+
+
 class PayerTimeout(serializable.Serializable):
 	serializableAttributes = {'state':''}
+	timeoutKeyAttributes = []
 serializable.registerClass(PayerTimeout)
 
 
 class NodeStateTimeout_Route(serializable.Serializable):
 	serializableAttributes = {'transactionID': '', 'isPayerSide': None, 'payerID': ''}
+	timeoutKeyAttributes = ['transactionID', 'isPayerSide', 'payerID']
 serializable.registerClass(NodeStateTimeout_Route)
 
 
 class NodeStateTimeout_Lock(serializable.Serializable):
 	serializableAttributes = {'transactionID': '', 'isPayerSide': None, 'payerID': ''}
+	timeoutKeyAttributes = ['transactionID', 'isPayerSide', 'payerID']
 serializable.registerClass(NodeStateTimeout_Lock)
 
 
 class LinkTimeout_Commit(serializable.Serializable):
 	serializableAttributes = {'transactionID': '', 'isPayerSide': None, 'ID': ''}
+	timeoutKeyAttributes = ['transactionID', 'isPayerSide', 'ID']
 serializable.registerClass(LinkTimeout_Commit)
 
@@ -28,6 +28,10 @@
 
 import asyncore
 import socket
+import os
+import errno
+import fcntl
+import struct
 
 from ..utils import serializable
 import messages
@@ -40,10 +44,39 @@ class ConnectFailed(Exception):
 	pass
 
 
+class FramingError(Exception):
+	pass
+
+
+#Framing modes of messages on a connection:
+#newline: each message is followed by a newline character
+#length:  each message is preceded by its length (4 bytes, big endian)
+#binary:  like length, but messages are serialized in the binary data format
+#         instead of JSON
+#Connections always start in newline mode. The connecting side offers the
+#other modes it supports, in its connect message; if the other side accepts,
+#both sides announce their switch with a {'framing': mode} message.
+framings = ['newline', 'length', 'binary']
+
+
 class Connection(asyncore.dispatcher_with_send):
 	def __init__(self, sock, network):
 		asyncore.dispatcher_with_send.__init__(self, sock, map=network.channelMap)
-		self.readBuffer = ''
+
+		#Messages are small, and are often sent shortly after each other
+		#(e.g. a framing switch, followed by a message). Don't let Nagle's
+		#algorithm delay them until the peer acknowledges the previous data:
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+		#Data before readPos has already been processed; data before scanPos
+		#is known to contain no newline character:
+		self.readBuffer = bytearray()
+		self.readPos = 0
+		self.scanPos = 0
+
+		self.readFraming = 'newline'
+		self.writeFraming = 'newline'
+
 		self.network = network
 		self.localID = None
 		self.dice = None
@@ -55,23 +88,85 @@ class Connection(asyncore.dispatcher_with_send):
 		if data:
 			self.readBuffer += data
 
-			#TODO restrict the size of the buffer, to prevent memory issues
-
-			while True:
-				newlinePos = self.readBuffer.find('\n')
-				if newlinePos < 0:
-					break #no more messages in the buffer
-				msgData = self.readBuffer[:newlinePos]
-				self.readBuffer = self.readBuffer[newlinePos+1:]
-				self.processReceivedMessageData(msgData)
+			try:
+				while True:
+					msgData = self.getNextFrame()
+					if msgData is None:
+						break #no more messages in the buffer
+					self.processReceivedMessageData(msgData)
+			except FramingError as e:
+				log.log("Closing connection %s: %s" % (str(self.localID), str(e)))
+				self.handle_close()
+				return
+
+			#Remove the processed data from the buffer. This moves the
+			#remaining data, so it is only done once the processed data is at
+			#least half of the buffer; otherwise, a burst of small messages
+			#would move the same data over and over again.
+			if self.readPos > 0 and 2 * self.readPos >= len(self.readBuffer):
+				del self.readBuffer[:self.readPos]
+				self.scanPos -= self.readPos
+				self.readPos = 0
+
+
+	def getNextFrame(self):
+		'''
+		Removes the next complete message from the read buffer.
+
+		Return value:
+		str or None; the message data, or None if the read buffer does not
+		contain a complete message.
+
+		Exceptions:
+		FramingError: the message is larger than the maximum message size
+		'''
+
+		maxSize = self.network.maxMessageSize
+
+		if self.readFraming != 'newline':
+			if len(self.readBuffer) - self.readPos < 4:
+				return None
+			length = struct.unpack_from('>I', self.readBuffer, self.readPos)[0]
+			if length > maxSize:
+				raise FramingError(
+					"Message size %d exceeds the maximum (%d)" % (length, maxSize))
+			start = self.readPos + 4
+			if len(self.readBuffer) < start + length:
+				return None
+			self.readPos = self.scanPos = start + length
+			return str(buffer(self.readBuffer, start, length))
+
+		newlinePos = self.readBuffer.find('\n', self.scanPos)
+		if newlinePos < 0:
+			self.scanPos = len(self.readBuffer)
+			if self.scanPos - self.readPos > maxSize:
+				raise FramingError(
+					"Message size exceeds the maximum (%d)" % maxSize)
+			return None
+		start = self.readPos
+		self.readPos = self.scanPos = newlinePos + 1
+		return str(buffer(self.readBuffer, start, newlinePos - start))
 
 
 	def processReceivedMessageData(self, msgData):
-		log.log("Received from %s: %s\n" % (str(self.localID), msgData))
+		isBinary = msgData.startswith(serializable.binaryMagic)
+		if not isBinary:
+			log.log("Received from %s: %s\n" % (str(self.localID), msgData))
 
 		try:
 			container = serializable.deserialize(msgData)
-			if 'received' in container.keys():
+			if isBinary:
+				#Converting the data to a human-readable form would undo the
+				#speed-up of the binary format, so only log a summary:
+				if 'message' in container.keys():
+					contents = str(container['message'].__class__)
+				else:
+					contents = ', '.join(sorted(container.keys()))
+				log.log("Received from %s: %d bytes of binary data (%s)\n" % \
+					(str(self.localID), len(msgData), contents))
+			if 'framing' in container.keys():
+				self.switchFraming(container['framing'])
+			elif 'received' in container.keys():
 				#Process received confirmation:
 				index = container['received']
 				self.network.callback.handleMessage(
@@ -81,6 +176,9 @@ class Connection(asyncore.dispatcher_with_send):
 				index = container['index']
 				msg = container['message']
 
+				if 'framings' in container.keys():
+					self.acceptFraming(container['framings'])
+
 				if msg.__class__ == messages.ConnectLink:
 					if not (self.localID is None):
 						raise Exception("Received ConnectLink message while already connected")
@@ -97,7 +195,7 @@ class Connection(asyncore.dispatcher_with_send):
 				else:
 					#Send confirmation on non-connect messages:
 					confirmation = {'received': index}
-					self.send(serializable.serialize(confirmation) + '\n')
+					self.sendContainer(confirmation)
 
 				#Always set/overwrite the ID attribute with our own localID
 				msg.ID = self.localID
@@ -112,14 +210,59 @@ class Connection(asyncore.dispatcher_with_send):
 			#TODO: send error back to remote host?
 
 
+	def acceptFraming(self, offeredFramings):
+		#Switch the framing of our outgoing data, if we both support it:
+		framing = self.network.framing
+		if framing != self.writeFraming and framing in offeredFramings:
+			self.sendContainer({'framing': framing})
+			self.writeFraming = framing
+
+
+	def switchFraming(self, framing):
+		if framing not in framings:
+			raise Exception("Received unsupported framing mode %s" % repr(framing))
+
+		#All data after this message has the new framing:
+		self.readFraming = framing
+
+		#Announce the switch of our outgoing data, if we didn't do so yet:
+		if self.writeFraming != framing:
+			self.sendContainer({'framing': framing})
+			self.writeFraming = framing
+
+
+	def sendFrame(self, data):
+		if self.writeFraming == 'newline':
+			self.send(data + '\n')
+		else:
+			self.send(struct.pack('>I', len(data)) + data)
+
+
+	def sendContainer(self, container):
+		dataFormat = 'binary' if self.writeFraming == 'binary' else 'json'
+		self.sendFrame(serializable.serialize(container, dataFormat))
+
+
 	def sendMessage(self, index, msg):
 		log.log("Sending message %s" % str(msg.__class__))
 		container = {'index': index, 'message': msg}
-		self.send(serializable.serialize(container) + '\n')
+		self.sendContainer(container)
+
+
+	def sendConnectMessage(self, msg):
+		log.log("Sending connect message %s" % str(msg.__class__))
+		container = {'index': None, 'message': msg}
+		if self.network.framing != 'newline':
+			container['framings'] = [self.network.framing]
+		self.sendContainer(container)
 
 
 	def handle_close(self):
 		self.isClosed = True
+		#Remove the socket from the channel map; otherwise, select would keep
+		#reporting the end-of-file condition, and the event loop would never
+		#block.
+		self.close()
 
 
 
@@ -144,14 +287,82 @@ class Listener(asyncore.dispatcher):
 
 
 
+class Waker(asyncore.file_dispatcher):
+	'''
+	Self-pipe, which can be used by other threads to interrupt a blocking
+	processNetworkEvents call.
+	'''
+
+	def __init__(self, network):
+		readFD, self.writeFD = os.pipe()
+		#Note: file_dispatcher makes the read side non-blocking, and uses a
+		#duplicate of the file descriptor.
+		asyncore.file_dispatcher.__init__(self, readFD, map=network.channelMap)
+		os.close(readFD)
+
+		flags = fcntl.fcntl(self.writeFD, fcntl.F_GETFL, 0)
+		fcntl.fcntl(self.writeFD, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+	def wakeup(self):
+		try:
+			os.write(self.writeFD, 'x')
+		except OSError as e:
+			#A full pipe means a wake-up is already pending:
+			if e.errno != errno.EAGAIN:
+				raise
+
+
+	def handle_read(self):
+		#Discard all pending wake-up data:
+		try:
+			while len(self.recv(4096)) == 4096:
+				pass
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+
+	def writable(self):
+		return False
+
+
+	def close(self):
+		asyncore.file_dispatcher.close(self)
+		if self.writeFD is not None:
+			os.close(self.writeFD)
+			self.writeFD = None
+
+
+
 class Network:
-	def __init__(self, host, port, callback):
+	def __init__(self, host, port, callback,
+		framing='binary', maxMessageSize=1048576):
+		'''
+		Constructor.
+
+		Arguments:
+		host: str; the host to listen on
+		port: int; the port to listen on
+		callback: object with a handleMessage method, which is called for
+		          all received messages
+		framing: str; the preferred framing mode (see framings)
+		maxMessageSize: int; the maximum size of a received message. Larger
+		                messages cause the connection to be closed.
+		'''
+
+		if framing not in framings:
+			raise Exception("Unsupported framing mode %s" % repr(framing))
+
 		self.channelMap = {}
 		self.listener = None
 		self.host = host
 		self.port = port
 		self.callback = callback
+		self.framing = framing
+		self.maxMessageSize = maxMessageSize
 		self.connections = []
+		self.waker = Waker(self)
 
 
 	def openListener(self):
@@ -160,9 +371,28 @@ class Network:
 
 
 	def processNetworkEvents(self, timeout):
+		'''
+		Waits for network activity and processes it.
+
+		Arguments:
+		timeout: float or None; the maximum waiting time (in seconds).
+		         None means: wait until there is network activity, or until
+		         wakeup() is called.
+		'''
+
 		asyncore.loop(timeout=timeout, count=1, map=self.channelMap)
 
 
+	def wakeup(self):
+		'''
+		Makes a (possibly blocking) processNetworkEvents call return as soon
+		as possible. This method may be called from any thread.
+		'''
+
+		if self.waker is not None:
+			self.waker.wakeup()
+
+
 	def sendOutboundMessage(self, index, msg):
 		self.getInterface(msg.localID).sendMessage(index, msg.message)
 
@@ -202,7 +432,7 @@ class Network:
 		connection.dice = randomsource.getNonSecureRandom(numBytes=4)
 
 		connectMessage.dice = connection.dice
-		connection.sendMessage(None, connectMessage)
+		connection.sendConnectMessage(connectMessage)
 
 		return connection
 
@@ -253,4 +483,7 @@ class Network:
 		if self.listener is not None:
 			self.listener.close()
 		self.listener = None
+		if self.waker is not None:
+			self.waker.close()
+		self.waker = None
 
@@ -29,6 +29,7 @@
 import randomsource
 
 import time
+import heapq
 
 import settings
 import link
@@ -54,6 +55,48 @@ class TransactionNotFound(Exception):
 
 
 
+#Heap operations, as in the heapq module, but they only change the heap
+#through its list methods. For a serializable.TrackedList, this way, only the
+#O(log n) changed items are journaled, instead of a copy of the heap.
+
+def heapPush(heap, item):
+	heap.append(item)
+	item = heap[-1] #the item, as adopted by the heap
+	pos = len(heap) - 1
+	while pos > 0:
+		parentPos = (pos - 1) >> 1
+		parent = heap[parentPos]
+		if not (item < parent):
+			break
+		heap[pos] = parent
+		pos = parentPos
+	heap[pos] = item
+
+
+def heapPop(heap):
+	last = heap.pop()
+	if len(heap) == 0:
+		return last
+	ret = heap[0]
+	size = len(heap)
+	pos = 0
+	while True:
+		childPos = 2*pos + 1
+		if childPos >= size:
+			break
+		rightPos = childPos + 1
+		if rightPos < size and heap[rightPos] < heap[childPos]:
+			childPos = rightPos
+		child = heap[childPos]
+		if not (child < last):
+			break
+		heap[pos] = child
+		pos = childPos
+	heap[pos] = last
+	return ret
+
+
+
 class NodeState(serializable.Serializable):
 	'''
 	Serializable class containing all state data of a single node.
@@ -74,10 +117,40 @@ class NodeState(serializable.Serializable):
 	'meetingPoints':{},
 	'transactions':[],
 	'connections':{},
-	'timeoutMessages': []
+	'timeoutMessages': [],
+
+	#Queued BitcoinCommand messages, waiting for their return value:
+	'bitcoinCommands': [],
+	'lastBitcoinCommandID': 0
 	}
 
 
+	def __init__(self, **kwargs):
+		serializable.Serializable.__init__(self, **kwargs)
+
+		#Non-serialized indexes on self.transactions:
+		#(transactionID, isPayerSide) -> list of Transaction:
+		self.__transactionIndex = {}
+		#id(Transaction) -> position in self.transactions:
+		self.__transactionPositions = {}
+		for position, tx in enumerate(self.transactions):
+			self.__transactionPositions[id(tx)] = position
+			self.__transactionIndex.setdefault(
+				(tx.transactionID, tx.isPayerSide), []).append(tx)
+
+		#self.timeoutMessages is a heap, ordered by timestamp.
+		#Cancelled time-outs (with message=None) don't need to be kept:
+		self.timeoutMessages = \
+			[t for t in self.timeoutMessages if t.message is not None]
+		heapq.heapify(self.timeoutMessages)
+		self.__numCancelledTimeouts = 0
+		#Non-serialized index on self.timeoutMessages:
+		#time-out key (see messages.getTimeoutKey) -> list of TimeoutMessage:
+		self.__timeoutIndex = {}
+		for timeout in self.timeoutMessages:
+			self.__indexTimeout(timeout)
+
+
 	def handleMessage(self, msg):
 		return \
 		{
@@ -87,7 +160,11 @@ class NodeState(serializable.Serializable):
 		messages.MakeMeetingPoint         : self.msg_makeMeetingPoint,
 
 		messages.TimeoutMessage           : self.msg_timeoutMessage,
-		messages.FilterTimeouts           : self.msg_filterTimeouts,
+		messages.CancelTimeout            : self.msg_cancelTimeout,
+
+		messages.BitcoinCommand           : self.msg_bitcoinCommand,
+		messages.BitcoinReturnValue       : self.msg_bitcoinReturnValue,
+		messages.BitcoinCommandFailed     : self.msg_bitcoinCommandFailed,
 
 		messages.MakeRoute                : self.msg_makeRoute,
 		messages.HaveNoRoute              : self.msg_haveNoRoute,
@@ -118,8 +195,7 @@ class NodeState(serializable.Serializable):
 		messages.Link_Withdraw     : self.msg_passToLink,
 		messages.LinkTimeout_Commit: self.msg_passToLink,
 		messages.ChannelMessage    : self.msg_passToLink,
-		messages.Deposit           : self.msg_passToLink,
-		messages.BitcoinReturnValue: self.msg_passToLink
+		messages.Deposit           : self.msg_passToLink
 		}[msg.__class__](msg)
 
 
@@ -203,22 +279,138 @@ class NodeState(serializable.Serializable):
 
 
 	def msg_timeoutMessage(self, msg):
-		self.timeoutMessages.append(msg)
-		self.timeoutMessages.sort(
-			cmp = lambda a, b: int(a.timestamp - b.timestamp)
-			)
+		heapPush(self.timeoutMessages, msg)
+		self.__indexTimeout(msg)
 		return []
 
 
-	def msg_filterTimeouts(self, msg):
-		self.timeoutMessages = filter(
-			lambda message: msg.function(message.message),
-			self.timeoutMessages
-			)
+	def msg_cancelTimeout(self, msg):
+		#Cancelled time-outs stay in the heap until they reach the top:
+		timeouts = self.__timeoutIndex.pop(messages.getTimeoutKey(msg.message), [])
+		for timeout in timeouts:
+			timeout.message = None
+		self.__numCancelledTimeouts += len(timeouts)
+
+		#Clean up the heap when it consists mostly of cancelled time-outs:
+		if 2*self.__numCancelledTimeouts > len(self.timeoutMessages):
+			timeouts = [t for t in self.timeoutMessages if t.message is not None]
+			heapq.heapify(timeouts)
+			self.timeoutMessages[:] = timeouts
+			self.__numCancelledTimeouts = 0
 
 		return []
 
 
+	def getNextTimeout(self):
+		'''
+		Return value:
+		float or None; the timestamp of the first time-out, or None if there
+		are no time-outs.
+		'''
+
+		self.__dropCancelledTimeouts()
+		if len(self.timeoutMessages) == 0:
+			return None
+		return self.timeoutMessages[0].timestamp
+
+
+	def popExpiredTimeout(self, now):
+		'''
+		Removes the first time-out, if it has expired.
+
+		Arguments:
+		now: float; the current time
+
+		Return value:
+		The message of the removed time-out, or None if no time-out has
+		expired.
+		'''
+
+		timestamp = self.getNextTimeout()
+		if timestamp is None or timestamp >= now:
+			return None
+
+		timeout = heapPop(self.timeoutMessages)
+
+		key = messages.getTimeoutKey(timeout.message)
+		if key is not None:
+			timeouts = self.__timeoutIndex[key]
+			if len(timeouts) == 1:
+				del self.__timeoutIndex[key]
+			else:
+				timeouts.remove(timeout)
+
+		return timeout.message
+
+
+	def __indexTimeout(self, timeout):
+		key = messages.getTimeoutKey(timeout.message)
+		if key is not None:
+			self.__timeoutIndex.setdefault(key, []).append(timeout)
+
+
+	def __dropCancelledTimeouts(self):
+		while len(self.timeoutMessages) > 0 and \
+			self.timeoutMessages[0].message is None:
+				heapPop(self.timeoutMessages)
+				self.__numCancelledTimeouts -= 1
+
+
+	def __cancelRouteTimeouts(self, transactionID, isPayerSide, payerID, timeoutClasses):
+		return \
+		[
+		messages.CancelTimeout(message=c(
+			transactionID=transactionID, isPayerSide=isPayerSide,
+			payerID=payerID))
+		for c in timeoutClasses
+		]
+
+
+	def msg_bitcoinCommand(self, msg):
+		#The command stays queued until its return value is processed, so
+		#that it is executed again if the node is restarted before that.
+		self.lastBitcoinCommandID += 1
+		msg.ID = self.lastBitcoinCommandID
+		self.bitcoinCommands.append(msg)
+		return []
+
+
+	def msg_bitcoinReturnValue(self, msg):
+		if self.__removeBitcoinCommand(msg.commandID) is None:
+			log.log('Ignoring return value of bitcoin command %s: it is no longer queued' % \
+				str(msg.commandID))
+			return []
+
+		return self.msg_passToLink(msg)
+
+
+	def msg_bitcoinCommandFailed(self, msg):
+		command = self.__removeBitcoinCommand(msg.commandID)
+		if command is None:
+			return []
+
+		if msg.isTransient and \
+			command.numRetries < self.settings.bitcoinMaxRetries:
+
+			#Retry later: the command is queued again when the time-out expires.
+			command.numRetries += 1
+			return [messages.TimeoutMessage(
+				timestamp=time.time()+self.settings.bitcoinRetryDelay,
+				message=command)]
+
+		log.log('Giving up on bitcoin command %s after %d retries' % \
+			(command.command, command.numRetries))
+		return self.msg_passToLink(msg)
+
+
+	def __removeBitcoinCommand(self, commandID):
+		for i, command in enumerate(self.bitcoinCommands):
+			if command.ID == commandID:
+				del self.bitcoinCommands[i]
+				return command
+		return None
+
+
 	def msg_makeRoute(self, msg):
 		log.log('Processing MakeRoute message')
 
@@ -288,13 +480,13 @@ class NodeState(serializable.Serializable):
 			startTime=msg.startTime,
 			endTime=msg.endTime
 			)
-		self.transactions.append(newTx)
+		self.addTransaction(newTx)
 
 		nextRoute = newTx.tryNextRoute()
 		if nextRoute is None:
 			log.log('  No route found')
 			#Delete the tx we just created:
-			self.transactions.remove(newTx)
+			self.removeTransaction(newTx)
 			#Send back haveNoRoute:
 			ret += sourceLink.haveNoRouteOutgoing(
 				msg.transactionID, msg.isPayerSide)
@@ -340,16 +532,9 @@ class NodeState(serializable.Serializable):
 			ret += payer.haveNoRouteIncoming(msg)
 
 		#Clean up old route and lock time-out:
-		oldPayerID = tx.payerID #keep reference to innermost object
-		ret.append(messages.FilterTimeouts(function = lambda message: not (
-			isinstance(message, (messages.NodeStateTimeout_Route, messages.NodeStateTimeout_Lock))
-			and
-			message.transactionID == msg.transactionID
-			and
-			message.isPayerSide == msg.isPayerSide
-			and
-			message.payerID == oldPayerID
-			)))
+		ret += self.__cancelRouteTimeouts(msg.transactionID, msg.isPayerSide,
+			tx.payerID,
+			[messages.NodeStateTimeout_Route, messages.NodeStateTimeout_Lock])
 
 		#Try to find another route
 		nextRoute = tx.tryNextRoute()
@@ -362,7 +547,7 @@ class NodeState(serializable.Serializable):
 				ret += payee.haveNoRouteOutgoing(msg.transactionID, isPayerSide=False)
 
 			#Clean up cancelled transaction:
-			self.transactions.remove(tx)
+			self.removeTransaction(tx)
 
 			return ret
 
@@ -414,18 +599,12 @@ class NodeState(serializable.Serializable):
 			ret += payer.cancelOutgoing(msg)
 
 		#Clean up cancelled transaction:
-		self.transactions.remove(tx)
+		self.removeTransaction(tx)
 
 		#Clean up route and lock time-out:
-		ret.append(messages.FilterTimeouts(function = lambda message: not (
-			isinstance(message, (messages.NodeStateTimeout_Route, messages.NodeStateTimeout_Lock))
-			and
-			message.transactionID == msg.transactionID
-			and
-			message.isPayerSide == msg.isPayerSide
-			and
-			message.payerID == tx.payerID
-			)))
+		ret += self.__cancelRouteTimeouts(msg.transactionID, msg.isPayerSide,
+			tx.payerID,
+			[messages.NodeStateTimeout_Route, messages.NodeStateTimeout_Lock])
 
 		return ret
 
@@ -458,7 +637,7 @@ class NodeState(serializable.Serializable):
 				))
 
 		#Clean up cancelled transaction:
-		self.transactions.remove(tx)
+		self.removeTransaction(tx)
 
 		return ret
 
@@ -503,15 +682,8 @@ class NodeState(serializable.Serializable):
 				)))
 
 		#Clean up route time-out:
-		ret.append(messages.FilterTimeouts(function = lambda message: not (
-			isinstance(message, messages.NodeStateTimeout_Route)
-			and
-			message.transactionID == msg.transactionID
-			and
-			message.isPayerSide == msg.isPayerSide
-			and
-			message.payerID == tx.payerID
-			)))
+		ret += self.__cancelRouteTimeouts(msg.transactionID, msg.isPayerSide,
+			tx.payerID, [messages.NodeStateTimeout_Route])
 
 		return ret
 
@@ -546,7 +718,7 @@ class NodeState(serializable.Serializable):
 				))
 
 		#Clean up cancelled transaction:
-		self.transactions.remove(tx)
+		self.removeTransaction(tx)
 
 		return ret
 
@@ -589,15 +761,8 @@ class NodeState(serializable.Serializable):
 		ret += payee.lockOutgoing(msg)
 
 		#Clean up lock time-out:
-		ret.append(messages.FilterTimeouts(function = lambda message: not (
-			isinstance(message, messages.NodeStateTimeout_Lock)
-			and
-			message.transactionID == msg.transactionID
-			and
-			message.isPayerSide == msg.isPayerSide
-			and
-			message.payerID == tx.payerID
-			)))
+		ret += self.__cancelRouteTimeouts(msg.transactionID, msg.isPayerSide,
+			tx.payerID, [messages.NodeStateTimeout_Lock])
 
 		return ret
 
@@ -621,7 +786,7 @@ class NodeState(serializable.Serializable):
 			))
 
 		#Clean up no-longer-needed transaction:
-		self.transactions.remove(tx)
+		self.removeTransaction(tx)
 
 		return ret
 
@@ -687,7 +852,7 @@ class NodeState(serializable.Serializable):
 			pass
 
 		#Clean up no-longer-needed transaction:
-		self.transactions.remove(tx)
+		self.removeTransaction(tx)
 
 		return ret
 
@@ -723,7 +888,7 @@ class NodeState(serializable.Serializable):
 			pass
 
 		#Clean up no-longer-needed transaction:
-		self.transactions.remove(tx)
+		self.removeTransaction(tx)
 
 		return ret
 
@@ -778,19 +943,50 @@ class NodeState(serializable.Serializable):
 		return self.links[msg.ID].handleMessage(msg)
 
 
+	def addTransaction(self, tx):
+		self.__transactionPositions[id(tx)] = len(self.transactions)
+		self.transactions.append(tx)
+		self.__transactionIndex.setdefault(
+			(tx.transactionID, tx.isPayerSide), []).append(tx)
+
+
+	def removeTransaction(self, tx):
+		position = self.__transactionPositions.pop(id(tx))
+
+		#Move the last transaction to the position of the removed one:
+		#the order of self.transactions is not significant.
+		lastTx = self.transactions.pop()
+		if lastTx is not tx:
+			self.transactions[position] = lastTx
+			self.__transactionPositions[id(lastTx)] = position
+
+		key = (tx.transactionID, tx.isPayerSide)
+		bucket = self.__transactionIndex[key]
+		if len(bucket) == 1:
+			del self.__transactionIndex[key]
+		else:
+			bucket.remove(tx)
+
+
 	def findMultipleTransactions(self, transactionID, isPayerSide, payerID=None, payeeID=None):
-		ret = self.transactions[:]
+		if transactionID is not None and isPayerSide is not None:
+			ret = self.__transactionIndex.get((transactionID, isPayerSide), [])
+		else:
+			ret = self.transactions
+			if transactionID is not None:
+				ret = [x for x in ret if x.transactionID == transactionID]
+			if isPayerSide is not None:
+				ret = [x for x in ret if x.isPayerSide == isPayerSide]
 
-		if transactionID is not None:
-			ret = [x for x in ret if x.transactionID == transactionID]
-		if isPayerSide is not None:
-			ret = [x for x in ret if x.isPayerSide == isPayerSide]
+		#Note: payerID and payeeID are not indexed, since they are changed by
+		#Transaction.tryNextRoute. There are only a few transactions with the
+		#same transactionID and isPayerSide.
 		if payerID is not None:
 			ret = [x for x in ret if x.payerID == payerID]
 		if payeeID is not None:
 			ret = [x for x in ret if x.payeeID == payeeID]
 
-		return ret
+		return ret[:]
 
 
 	def findTransaction(self, transactionID, isPayerSide, payerID=None, payeeID=None):
@@ -88,7 +88,7 @@ class PayeeLink(linkbase.LinkBase, serializable.Serializable):
 				amount=self.amount,
 				receipt=self.receipt,
 				transactionID=self.transactionID,
-				meetingPoints=self.meetingPoints
+				meetingPoints=self.meetingPoints[:]
 			))]
 
 
@@ -295,9 +295,7 @@ class PayerLink(linkbase.LinkBase, serializable.Serializable):
 
 
 	def __removeTimeouts(self):
-		return [messages.FilterTimeouts(function = lambda message:
-			not isinstance(message, messages.PayerTimeout)
-			)]
+		return [messages.CancelTimeout(message=messages.PayerTimeout())]
 
 serializable.registerClass(PayerLink)
 
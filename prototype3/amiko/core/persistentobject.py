@@ -27,6 +27,8 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import os
+import hashlib
+import zlib
 
 import log
 from ..utils import serializable
@@ -44,9 +46,19 @@ class PersistentObject:
 	or restoring (exception) at the end of the section. Note that, in the case
 	of nested 'with' statements, only the leaving of the outermost 'with'
 	statement causes such a saving/restoring action.
+
+	On disk, the state consists of a snapshot file and a write-ahead log.
+	Saving normally appends only the changes since the previous save to the
+	write-ahead log. Once in a while, the log is compacted: the complete
+	state is written to a new snapshot, and the log is restarted.
+
+	In memory, changes are recorded by a serializable.ChangeTracker, so that
+	restoring the previous state only undoes the changes that were actually
+	made, and saving only converts the changed objects to a state.
 	'''
 
-	def __init__(self, filename, defaultObject, nonserializedAttributes={}):
+	def __init__(self, filename, defaultObject, nonserializedAttributes={},
+		compactionInterval=1000, stateFormat='json'):
 		'''
 		Constructor.
 
@@ -57,7 +69,8 @@ class PersistentObject:
 		filename: str;
 			The base filename for loading/saving. Note that, to make sure that
 			a completely consistent state always exists on disk, <filename>.old
-			and <filename>.new may also be used.
+			and <filename>.new may also be used. The write-ahead log is stored
+			in <filename>.wal (and, temporarily, <filename>.wal.new).
 		defaultObject: serializable.Serializable derived;
 			Object that is used in case no data could be loaded from disk.
 		nonserializedAttributes: dict of str->(any);
@@ -65,22 +78,39 @@ class PersistentObject:
 			each time the object is loaded or restored to a previous state.
 			Typically, these are constants that are not part of the serialized
 			data.
+		compactionInterval: int;
+			The number of write-ahead log records after which the complete
+			state is written to a new snapshot.
+		stateFormat: str;
+			The data format (see serializable.dataFormats) in which the state
+			is saved. On loading, the format is detected automatically.
 		'''
 
 		self.__filename = filename
+		self.__walFilename = filename + ".wal"
 		self.__object = None
 		self.__nonserializedAttributes = nonserializedAttributes
+		self.__compactionInterval = compactionInterval
+		self.__stateFormat = stateFormat
 
-		self.__oldState = None
+		self.__changeTracker = serializable.ChangeTracker()
 		self.__withBlockCount = 0
 
+		self.__walFile = None
+		self.__numWALRecords = 0
+
 		try:
 			self.load()
 		except IOError:
+			if self.__object is not None:
+				#Loading succeeded, but writing the new snapshot failed.
+				#Don't overwrite the loaded state with the default state!
+				raise
+
 			log.log("Failed to load from %s" % self.__filename)
 			log.log("Starting with default state")
 
-			self.__object = defaultObject
+			self.__object = self.__changeTracker.track(defaultObject)
 			for k, v in self.__nonserializedAttributes.iteritems():
 				setattr(self.__object, k, v)
 
@@ -93,9 +123,14 @@ class PersistentObject:
 		Load the object state from disk, overwriting existing in-memory
 		object state (if any).
 
+		The state is loaded from the snapshot, and all complete records of the
+		write-ahead log are applied to it. After that, the result is written
+		to a new snapshot, with an empty write-ahead log.
+
 		Exceptions:
 		IOError: File reading failed: either the file does not exist, or
-		         we have no read permissions.
+		         we have no read permissions. Also raised when writing the
+		         new snapshot failed.
 		TBD: De-serialization failed.
 		'''
 
@@ -111,7 +146,13 @@ class PersistentObject:
 		with open(self.__filename, 'rb') as fp:
 			stateData = fp.read()
 
-		self.__setState(serializable.deserializeState(stateData))
+		state = serializable.deserializeState(stateData)
+		state = self.__replayWAL(self.__getSnapshotID(stateData), state)
+		self.__setState(state)
+
+		#Compaction: this also gets rid of any incomplete last record in the
+		#write-ahead log.
+		self.__writeSnapshot()
 
 
 	def save(self):
@@ -124,7 +165,46 @@ class PersistentObject:
 		         write the state file, or maybe there is insufficient disk space.
 		'''
 
-		stateData = serializable.serializeState(self.__getState())
+		if self.__walFile is None or \
+			self.__numWALRecords >= self.__compactionInterval:
+				self.__writeSnapshot()
+				return
+
+		#Only the objects that were changed since the previous save are
+		#converted to a state:
+		delta = self.__changeTracker.getStateDelta(self.__object)
+		self.__changeTracker.clearChanges()
+		if len(delta) > 0:
+			record = serializable.serializeState(delta, self.__stateFormat)
+			try:
+				#The length is included, since the record may contain newline
+				#characters in the binary format:
+				self.__walFile.write('%08x %d %s\n' % \
+					(self.__getChecksum(record), len(record), record))
+				self.__walFile.flush()
+			except IOError:
+				log.logException()
+				log.log("Writing to %s failed; writing a new snapshot instead" % \
+					self.__walFilename)
+				#The log might now end with a partial record, so we must not
+				#append anything to it anymore.
+				self.__closeWAL()
+				self.__writeSnapshot()
+				return
+			self.__numWALRecords += 1
+
+
+	def __writeSnapshot(self):
+		'''
+		Writes the complete state to a new snapshot, and starts a new, empty
+		write-ahead log for it.
+		'''
+
+		self.__closeWAL()
+
+		self.__changeTracker.clearChanges()
+		stateData = serializable.serializeState(
+			self.__getState(), self.__stateFormat)
 
 		newFile = self.__filename + ".new"
 		log.log("Saving in " + newFile)
@@ -144,20 +224,112 @@ class PersistentObject:
 		except OSError:
 			log.log("Got OSError on removing old state file; probably it didn't exist, which is OK in a fresh installation.")
 
+		#The new log is written under a temporary name first, so that a
+		#complete log file always exists: if we crash before the rename, the
+		#old log is ignored on loading, since its header doesn't match the new
+		#snapshot.
+		newWALFile = self.__walFilename + ".new"
+		with open(newWALFile, 'wb') as fp:
+			fp.write(self.__getWALHeader(self.__getSnapshotID(stateData)))
+		os.rename(newWALFile, self.__walFilename)
+
+		self.__walFile = open(self.__walFilename, 'ab')
+		self.__numWALRecords = 0
+
+
+	def __closeWAL(self):
+		if self.__walFile is not None:
+			self.__walFile.close()
+			self.__walFile = None
+
+
+	def __replayWAL(self, snapshotID, state):
+		'''
+		Applies the records of the write-ahead log to the given state, if the
+		log belongs to the given snapshot. Reading stops at the first
+		incomplete or corrupted record, since that is where a crash occurred.
+
+		Return value:
+		The new state.
+		'''
+
+		try:
+			fp = open(self.__walFilename, 'rb')
+		except IOError:
+			log.log("No write-ahead log found in %s" % self.__walFilename)
+			return state
+
+		with fp:
+			if fp.readline() != self.__getWALHeader(snapshotID):
+				log.log("Ignoring write-ahead log %s: it doesn't belong to the snapshot" % \
+					self.__walFilename)
+				return state
+
+			data = fp.read()
+
+		numRecords = 0
+		pos = 0
+		while pos < len(data):
+			record, pos = self.__parseWALRecord(data, pos)
+			if record is None:
+				log.log("Ignoring incomplete last record of the write-ahead log")
+				break
+
+			state = serializable.applyStateDelta(
+				state, serializable.deserializeState(record))
+			numRecords += 1
+
+		log.log("Applied %d records of the write-ahead log" % numRecords)
+		return state
+
+
+	def __parseWALRecord(self, data, pos):
+		'''
+		Parses a write-ahead log record: <checksum> <length> <data>\n
+
+		Return value:
+		tuple (record, newPos), with record=None if the record is incomplete
+		or corrupted.
+		'''
+
+		fields = data[pos:pos+32].split(' ', 2)
+		if len(fields) < 3 or not fields[1].isdigit():
+			return None, pos
+
+		start = pos + len(fields[0]) + len(fields[1]) + 2
+		end = start + int(fields[1])
+		record = data[start:end]
+		if data[end:end+1] != '\n' or fields[0] != '%08x' % self.__getChecksum(record):
+			return None, pos
+
+		return record, end + 1
+
+
+	def __getSnapshotID(self, stateData):
+		return hashlib.sha256(stateData).hexdigest()
+
+
+	def __getWALHeader(self, snapshotID):
+		return "AMIKOPAY-WAL 2 %s\n" % snapshotID
+
+
+	def __getChecksum(self, record):
+		return zlib.crc32(record) & 0xffffffff
+
 
 	def __getState(self):
 		return serializable.object2State(self.__object)
 
 
 	def __setState(self, s):
-		self.__object = serializable.state2Object(s)
+		self.__object = self.__changeTracker.track(serializable.state2Object(s))
 		for k, v in self.__nonserializedAttributes.iteritems():
 			setattr(self.__object, k, v)
 
 
 	def __enter__(self):
 		if self.__withBlockCount == 0:
-			self.__oldState = self.__getState()
+			self.__changeTracker.begin()
 
 		self.__withBlockCount += 1
 		return self
@@ -169,12 +341,11 @@ class PersistentObject:
 		if self.__withBlockCount == 0:
 			if exceptionType is None:
 				#Save state in case of no exception
+				self.__changeTracker.commit()
 				self.save()
 			else:
 				#Restore old state in case of an exception
-				self.__setState(self.__oldState)
-
-			self.__oldState = None
+				self.__changeTracker.rollback()
 
 		return False #False = don't silence exceptions
 
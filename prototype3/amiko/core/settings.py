@@ -28,6 +28,7 @@
 
 import ConfigParser
 import binascii
+import os
 
 from ..utils import crypto
 
@@ -36,7 +37,7 @@ from ..utils import crypto
 #Design settings (changing these creates an incompatibility):
 
 def hashAlgorithm(data):
-	return crypto.RIPEMD160(crypto.SHA256(data))
+	return crypto.hash160(data)
 	
 
 defaultPort = 4321
@@ -58,10 +59,24 @@ class Settings:
 		#general
 		self.name = self.__get(
 			"general", "name", '')
+		self.walCompactionInterval = int(self.__get(
+			"general", "walCompactionInterval", 1000))
 
 		#bitcoin RPC
 		self.bitcoinRPCURL = self.__get(
 			"bitcoind", "RPCURL", "")
+		self.bitcoinWorkers = int(self.__get(
+			"bitcoind", "workers", 2))
+		if self.bitcoinWorkers < 1:
+			raise Exception("bitcoind workers must be at least 1")
+		self.bitcoinRPCTimeout = float(self.__get(
+			"bitcoind", "timeout", 30))
+		self.bitcoinRetryDelay = float(self.__get(
+			"bitcoind", "retryDelay", 60))
+		self.bitcoinMaxRetries = int(self.__get(
+			"bitcoind", "maxRetries", 10))
+		self.bitcoinSimulatorBlockInterval = float(self.__get(
+			"bitcoind", "simulatorBlockInterval", 0))
 
 		#network
 		self.listenHost = self.__get(
@@ -72,6 +87,10 @@ class Settings:
 			"network", "advertizedHost", self.listenHost)
 		self.advertizedPort = int(self.__get(
 			"network", "advertizedPort", self.listenPort))
+		self.framing = self.__get(
+			"network", "framing", "binary")
+		self.maxMessageSize = int(self.__get(
+			"network", "maxMessageSize", 1048576))
 
 		#providers
 		self.externalMeetingPoints = self.__get(
@@ -91,6 +110,10 @@ class Settings:
 			"files", "statefile", "amikopay.dat")
 		self.payLogFile = self.__get(
 			"files", "paylogfile", "payments.log")
+		self.stateFormat = self.__get(
+			"files", "stateformat", "json")
+		self.bitcoinCacheFile = self.__get(
+			"files", "bitcoindcachefile", "bitcoindcache.db")
 
 		self.__config = None
 
@@ -108,3 +131,12 @@ class Settings:
 		return "%s:%s" % (self.advertizedHost, self.advertizedPort)
 
 
+	def getBitcoinCacheFile(self):
+		#A relative path is relative to the directory of the state file, and
+		#not to the current directory of whichever program loads the settings.
+		if self.bitcoinCacheFile == "":
+			return ""
+		return os.path.join(
+			os.path.dirname(self.stateFile), self.bitcoinCacheFile)
+
+
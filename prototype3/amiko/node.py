@@ -30,6 +30,7 @@
 import threading
 from urlparse import urlparse
 import time
+import copy
 
 from core import log
 from core import bitcoind
@@ -69,6 +70,7 @@ def runInNodeThread(implementationFunc):
 		with self._commandFunctionLock:
 			self._commandFunction = (implementationFunc, args, kwargs)
 			self._commandProcessed.clear()
+		self._wakeup()
 		self._commandProcessed.wait()
 
 		if isinstance(self._commandReturnValue, Exception):
@@ -115,12 +117,19 @@ class Node(threading.Thread):
 		self.name = self.settings.name
 
 		self.__network = network.Network(
-			self.settings.listenHost, self.settings.listenPort, callback=self)
+			self.settings.listenHost, self.settings.listenPort, callback=self,
+			framing=self.settings.framing,
+			maxMessageSize=self.settings.maxMessageSize)
 
 		self.bitcoind = bitcoind.Bitcoind(self.settings)
 		if not self.bitcoind.isConnected():
 			raise Exception('Connecting to bitcoind failed; see the log file for details.')
 
+		self.__bitcoinCommandExecutor = bitcoind.BitcoinCommandExecutor(
+			self.settings, self._wakeup)
+		#IDs of the queued bitcoin commands that were passed to the executor:
+		self.__submittedBitcoinCommands = set([])
+
 		self.payLog = paylog.PayLog(self.settings)
 
 		self.__stop = False
@@ -136,6 +145,8 @@ class Node(threading.Thread):
 
 		self.__node = persistentobject.PersistentObject(
 			filename=self.settings.stateFile,
+			stateFormat=self.settings.stateFormat,
+			compactionInterval=self.settings.walCompactionInterval,
 			defaultObject=nodestate.NodeState(), #empty state; used when file can not be loaded
 			nonserializedAttributes={'settings': self.settings} #attributes added to object after loading
 			)
@@ -184,16 +195,10 @@ class Node(threading.Thread):
 				elif msg.__class__ == messages.SetEvent:
 					setEvents.add(msg.event)
 
-				#Messages for Bitcoind:
-				elif msg.__class__ == messages.BitcoinCommand:
-					#Right now, these messages are not buffered/stored.
-					#We depend on bitcoind to remain available.
-					#TODO: find out whether buffering of messages in the node
-					#state makes sense.
-					newMessages = self.bitcoind.handleMessage(msg)
-
 				else:
-					#All other messages go to the node:
+					#All other messages go to the node.
+					#Note: BitcoinCommand messages are queued in the node
+					#state; they are executed after processing has finished.
 					newMessages = self.__node.handleMessage(msg)
 
 				#Add new messages to the end of the queue:
@@ -206,9 +211,23 @@ class Node(threading.Thread):
 		for e in setEvents:
 			self.__events[e].set()
 
+		self.__submitBitcoinCommands()
+
 		return returnValue
 
 
+	def __submitBitcoinCommands(self):
+		#Pass the newly queued commands to the executor.
+		#Commands stay queued in the node state until their return value is
+		#processed; commands that are no longer queued are forgotten here.
+		queuedIDs = set([])
+		for command in self.__node.bitcoinCommands:
+			queuedIDs.add(command.ID)
+			if command.ID not in self.__submittedBitcoinCommands:
+				self.__bitcoinCommandExecutor.submit(copy.deepcopy(command))
+		self.__submittedBitcoinCommands = queuedIDs
+
+
 	def makeConnection(self, ID):
 		persistentConn = self.__node.connections[ID]
 
@@ -230,9 +249,22 @@ class Node(threading.Thread):
 		"""
 
 		self.__stop = True
+		self._wakeup()
 		self.join()
 
 
+	def _wakeup(self):
+		"""
+		Makes the Node thread check for new API commands and for the stop
+		request, without waiting for network activity or time-outs.
+
+		Intended for internal use by Node.
+		Not intended to be part of the API.
+		"""
+
+		self.__network.wakeup()
+
+
 	@runInNodeThread
 	def request(self, amount, receipt, linkname=None):
 		"""
@@ -438,6 +470,13 @@ class Node(threading.Thread):
 
 		self.__network.openListener()
 
+		#Start executing bitcoin commands, including the ones that were
+		#still queued when the node was stopped. Transactions that were made
+		#but not yet sent keep their inputs reserved:
+		bitcoind.reservePendingInputs(self.__node.bitcoinCommands)
+		self.__bitcoinCommandExecutor.start()
+		self.__submitBitcoinCommands()
+
 		#Establish connections
 		for ID in self.__node.connections.keys():
 			try:
@@ -449,7 +488,9 @@ class Node(threading.Thread):
 
 		self.__stop = False
 		while True:
-			self.__network.processNetworkEvents(timeout=0.01)
+			#Block until there is network activity, an API command, a stop
+			#request, or until the first time-out expires:
+			self.__network.processNetworkEvents(timeout=self.__getWaitTime())
 
 			#API events:
 			with self._commandFunctionLock:
@@ -463,10 +504,16 @@ class Node(threading.Thread):
 					self._commandProcessed.set()
 					self._commandFunction = None
 
+			#Bitcoin command results:
+			for msg in self.__bitcoinCommandExecutor.getResults():
+				self.handleMessage(msg)
+
 			#Time-out events:
-			while len(self.__node.timeoutMessages) > 0 and self.__node.timeoutMessages[0].timestamp < time.time():
-				msg = self.__node.timeoutMessages.pop(0)
-				self.handleMessage(msg.message)
+			while True:
+				msg = self.__node.popExpiredTimeout(time.time())
+				if msg is None:
+					break
+				self.handleMessage(msg)
 
 			#Connections: data transmission and closing
 			doSaveState = False
@@ -489,6 +536,18 @@ class Node(threading.Thread):
 				break
 
 		self.__network.closeAll()
+		self.__bitcoinCommandExecutor.stop()
 
 		log.log("Node thread terminated\n\n")
 
+
+	def __getWaitTime(self):
+		if self.__stop or self._commandFunction != None:
+			return 0.0
+
+		timestamp = self.__node.getNextTimeout()
+		if timestamp is None:
+			return None #wait indefinitely
+
+		return max(0.0, timestamp - time.time())
+
@@ -31,12 +31,25 @@
 import binascii
 import struct
 
-from crypto import SHA256, RIPEMD160
+from crypto import doubleSHA256, SHA256Many
 
 
 
 base58Chars = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
 
+#Reverse lookup table: character code -> digit value, or -1 if not allowed
+base58Values = [-1] * 256
+for i, c in enumerate(base58Chars):
+	base58Values[ord(c)] = i
+
+#The big integer is converted in chunks of this many digits, so that most of
+#the arithmetic is done on small integers:
+chunkDigits = 10
+chunkBase = 58**chunkDigits
+
+#Table of all two-digit combinations, used to convert a chunk to characters:
+base58Pairs = [a+b for a in base58Chars for b in base58Chars]
+
 
 def encodeBase58(data):
 	"""
@@ -52,21 +65,21 @@ def encodeBase58(data):
 	# Convert big endian data to bignum
 	bignum = int('00' + data.encode("hex"), 16) #00 is necessary in case of empty string
 
-	ret = ""
+	#Little endian list of two-digit strings:
+	pairs = []
 	while bignum > 0:
-		bignum, remainder = divmod(bignum, 58)
-		ret = ret + base58Chars[remainder]
+		bignum, chunk = divmod(bignum, chunkBase)
+		for i in range(chunkDigits/2):
+			chunk, pair = divmod(chunk, 3364) #58*58
+			pairs.append(base58Pairs[pair])
 
-	# Leading zeroes encoded as base58 zeros
-	for i in range(len(data)):
-		if data[i] != '\0':
-			break
-		ret = ret + base58Chars[0]
+	# Convert to big endian, and remove zeroes added by the chunked conversion
+	ret = "".join(reversed(pairs)).lstrip(base58Chars[0])
 
-	# Convert little endian string to big endian
-	ret = ret[::-1]
+	# Leading zeroes encoded as base58 zeros
+	numZeroes = len(data) - len(data.lstrip('\0'))
 
-	return ret
+	return base58Chars[0]*numZeroes + ret
 
 
 def decodeBase58(data):
@@ -84,30 +97,66 @@ def decodeBase58(data):
 	"""
 
 	#Leading zeroes:
-	zeroes = ""
-	while len(data) > 0 and data[0] == base58Chars[0]:
-		zeroes += '\0'
-		data = data[1:]
+	numZeroes = len(data) - len(data.lstrip(base58Chars[0]))
 
-	#Big endian base58 decoding:
+	#Big endian base58 decoding, in chunks:
 	bignum = 0
-	for c in data:
-		digit = base58Chars.index(c)
-		bignum = 58*bignum + digit
+	for start in range(numZeroes, len(data), chunkDigits):
+		chunkData = data[start:start+chunkDigits]
+		chunk = 0
+		for c in chunkData:
+			try:
+				digit = base58Values[ord(c)]
+			except IndexError: #non-ASCII unicode character
+				digit = -1
+			if digit < 0:
+				raise ValueError("Illegal character in Base58 data: %r" % c)
+			chunk = 58*chunk + digit
+		if len(chunkData) == chunkDigits:
+			bignum = chunkBase*bignum + chunk
+		else:
+			bignum = 58**len(chunkData)*bignum + chunk
 
 	#To big endian:
 	#First to hex:
 	ret = "%x" % bignum
 	#Add leading zero to force even-length: (unhexlify doesn't like odd-length)
 	ret = "0"*(len(ret) & 1) + ret
-	#Then to binary string:
-	ret = binascii.unhexlify(ret)
+	#Then to binary string, without leading zeroes:
+	ret = binascii.unhexlify(ret).lstrip('\0')
+
+	return '\0'*numZeroes + ret
+
+
+def encodeBase58Many(dataList):
+	"""
+	Base58-encodes multiple data items, without checksum or version number.
+
+	Arguments:
+	dataList: list of str; the to-be-encoded data items.
+
+	Return value:
+	list of str; the encoded data items.
+	"""
+
+	return [encodeBase58(data) for data in dataList]
+
+
+def decodeBase58Many(dataList):
+	"""
+	Base58-decodes multiple data items, without checksum or version number.
 
-	#Skip zeroes:
-	while len(ret) > 0 and ret[0] == '\0':
-		ret = ret[1:]
+	Arguments:
+	dataList: list of str; the to-be-decoded data items.
+
+	Return value:
+	list of str; the decoded data items.
 
-	return zeroes + ret
+	Exceptions:
+	ValueError: data contains an illegal character
+	"""
+
+	return [decodeBase58(data) for data in dataList]
 
 
 def encodeBase58Check_noVersion(data):
@@ -122,7 +171,7 @@ def encodeBase58Check_noVersion(data):
 	"""
 
 	# add 4-byte hash check to the end
-	checksum = SHA256(SHA256(data))[:4]
+	checksum = doubleSHA256(data)[:4]
 	return encodeBase58(data + checksum)
 
 
@@ -144,7 +193,7 @@ def decodeBase58Check_noVersion(data):
 	decoded = decodeBase58(data)
 	checksum = decoded[-4:]
 	rest = decoded[:-4]
-	if checksum != SHA256(SHA256(rest))[:4]:
+	if checksum != doubleSHA256(rest)[:4]:
 		raise Exception("Checksum failed")
 	return rest
 
@@ -198,3 +247,54 @@ def decodeBase58Check(data, version):
 		raise Exception("Version mismatch")
 	return decoded[1:]
 
+
+def encodeBase58CheckMany(dataList, version):
+	"""
+	Base58-encodes multiple data items, with checksum and version number.
+	This is faster than calling encodeBase58Check for every item.
+
+	Arguments:
+	dataList: list of str; the to-be-encoded data items.
+	version: int, the version number (see encodeBase58Check).
+
+	Return value:
+	list of str; the encoded data items.
+	"""
+
+	versionByte = struct.pack('B', version)
+	dataList = [versionByte + data for data in dataList]
+	checksums = SHA256Many(dataList, double=True)
+	return [
+		encodeBase58(data + checksum[:4])
+		for data, checksum in zip(dataList, checksums)
+		]
+
+
+def decodeBase58CheckMany(dataList, version):
+	"""
+	Base58-decodes multiple data items, with checksum and version number.
+	This is faster than calling decodeBase58Check for every item.
+
+	Arguments:
+	dataList: list of str; the to-be-decoded data items.
+	version: int, the version number (see decodeBase58Check).
+
+	Return value:
+	list of str; the decoded data items.
+
+	Exceptions:
+	Exception: checksum failed, or version number mismatch
+	ValueError: data contains an illegal character
+	"""
+
+	decoded = decodeBase58Many(dataList)
+	rest = [d[:-4] for d in decoded]
+	checksums = SHA256Many(rest, double=True)
+	versionByte = struct.pack('B', version)
+	for d, r, checksum in zip(decoded, rest, checksums):
+		if d[-4:] != checksum[:4]:
+			raise Exception("Checksum failed")
+		if r[:1] != versionByte:
+			raise Exception("Version mismatch")
+	return [r[1:] for r in rest]
+
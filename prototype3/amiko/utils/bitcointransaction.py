@@ -27,8 +27,7 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import struct
-import copy
-from crypto import SHA256
+from crypto import doubleSHA256, SHA256, SHA256Context, signMany
 
 
 
@@ -79,32 +78,35 @@ def packVarInt(i):
 		return struct.pack('B', 0xff) + struct.pack('<Q', i) #uint64_t
 
 
-def unpackVarInt(data):
+def unpackVarInt(data, offset=0):
 	"""
 	Bitcoin variable length integer decoding
 
 	Arguments:
-	str; the variable-length encoded value
+	data: str; contains the variable-length encoded value
+	offset: int; the position of the value in data (default: 0)
 
 	Return value:
+	tuple (i, numBytes)
 	i: int; the decoded integer value
+	numBytes: int; the number of bytes that has been read
 
 	Exceptions:
 	struct.error: unexpected end of data
 	"""
 
-	firstByte = struct.unpack('B', data[0])[0] #uint8_t
+	firstByte = struct.unpack('B', data[offset:offset+1])[0] #uint8_t
 	if firstByte < 0xfd:
 		value = firstByte
 		return value, 1
 	elif firstByte == 0xfd:
-		value = struct.unpack('<H', data[1:3])[0] #uint16_t
+		value = struct.unpack_from('<H', data, offset+1)[0] #uint16_t
 		return value, 3
 	elif firstByte == 0xfe:
-		value = struct.unpack('<I', data[1:5])[0] #uint32_t
+		value = struct.unpack_from('<I', data, offset+1)[0] #uint32_t
 		return value, 5
 	elif firstByte == 0xff:
-		value = struct.unpack('<Q', data[1:9])[0] #uint64_t
+		value = struct.unpack_from('<Q', data, offset+1)[0] #uint64_t
 		return value, 9
 
 	raise Exception("Bug detected in unpackVarInt")
@@ -203,38 +205,44 @@ class Script:
 
 
 	@staticmethod
-	def deserialize(data):
+	def deserialize(data, offset=0, end=None):
 		"""
 		De-serializes a Bitcoin script.
 		This is a static method: it can be called without having an instance,
 		as an alternative to calling the constructor directly.
 
 		Arguments:
-		data: str; the serialized script
+		data: str; contains the serialized script
+		offset: int; the start of the script in data (default: 0)
+		end: int; the end of the script in data (default: the end of data)
 
 		Return value:
 		Script; the de-serialized script
 		"""
 
+		if end is None:
+			end = len(data)
+
 		elements = []
-		while len(data) > 0:
-			opcode = struct.unpack('B', data[0])[0]
-			data = data[1:]
+		pos = offset
+		while pos < end:
+			opcode = ord(data[pos])
+			pos += 1
 
 			if opcode <= 0x4e:
 				if opcode <= 0x4b:
 					length = opcode
 				elif opcode == 0x4c:
-					length = struct.unpack('B', data[:1])[0]
-					data = data[1:]
+					length = struct.unpack('B', data[pos:min(pos+1, end)])[0]
+					pos += 1
 				elif opcode == 0x4d:
-					length = struct.unpack('<H', data[:2])[0]
-					data = data[2:]
+					length = struct.unpack('<H', data[pos:min(pos+2, end)])[0]
+					pos += 2
 				else:
-					length = struct.unpack('<I', data[:4])[0]
-					data = data[4:]
-				elements.append(data[:length])
-				data = data[length:]
+					length = struct.unpack('<I', data[pos:min(pos+4, end)])[0]
+					pos += 4
+				elements.append(data[pos:min(pos+length, end)])
+				pos += length
 			else:
 				elements.append(opcode)
 
@@ -309,16 +317,17 @@ class TxIn:
 	"""
 
 	@staticmethod
-	def deserialize(data):
+	def deserialize(data, offset=0):
 		"""
 		De-serializes a transaction input.
 		This is a static method: it can be called without having an instance,
 		as an alternative to calling the constructor directly.
 
 		Arguments:
-		data: str; the serialized transaction input.
+		data: str; contains the serialized transaction input.
 		      May contain trailing bytes that are not part of the serialized
 		      transaction input.
+		offset: int; the start of the transaction input in data (default: 0)
 
 		Return value:
 		Tuple, containing:
@@ -326,21 +335,18 @@ class TxIn:
 		int; the number of bytes that has been read
 		"""
 
-		outputHash = data[:32]
-		data = data[32:]
-
-		outputIndex = struct.unpack('<I', data[:4])[0] #uint32_t
-		data = data[4:]
+		outputHash = data[offset:offset+32]
 
-		scriptSigLen, numBytesInLen = unpackVarInt(data)
-		data = data[numBytesInLen:]
+		outputIndex = struct.unpack_from('<I', data, offset+32)[0] #uint32_t
 
-		scriptSig = Script.deserialize(data[:scriptSigLen])
-		data = data[scriptSigLen:]
+		scriptSigLen, numBytesInLen = unpackVarInt(data, offset+36)
+		scriptStart = offset + 36 + numBytesInLen
+		scriptEnd = scriptStart + scriptSigLen
+		scriptSig = Script.deserialize(data, scriptStart, min(scriptEnd, len(data)))
 
 		#TODO: Store this. We need this for time locking:
 		#https://bitcointalk.org/index.php?topic=888124.0
-		sequenceNumber = struct.unpack('<I', data[:4])[0] #uint32_t
+		sequenceNumber = struct.unpack_from('<I', data, scriptEnd)[0] #uint32_t
 
 		obj = TxIn(outputHash, outputIndex)
 		obj.scriptSig = scriptSig
@@ -393,16 +399,17 @@ class TxOut:
 	"""
 
 	@staticmethod
-	def deserialize(data):
+	def deserialize(data, offset=0):
 		"""
 		De-serializes a transaction output.
 		This is a static method: it can be called without having an instance,
 		as an alternative to calling the constructor directly.
 
 		Arguments:
-		data: str; the serialized transaction output.
+		data: str; contains the serialized transaction output.
 		      May contain trailing bytes that are not part of the serialized
 		      transaction output.
+		offset: int; the start of the transaction output in data (default: 0)
 
 		Return value:
 		Tuple, containing:
@@ -410,13 +417,12 @@ class TxOut:
 		int; the number of bytes that has been read
 		"""
 
-		amount = struct.unpack('<Q', data[:8])[0] #uint64_t
-		data = data[8:]
+		amount = struct.unpack_from('<Q', data, offset)[0] #uint64_t
 
-		scriptPubKeyLen, numBytesInLen = unpackVarInt(data)
-		data = data[numBytesInLen:]
-
-		scriptPubKey = Script.deserialize(data[:scriptPubKeyLen])
+		scriptPubKeyLen, numBytesInLen = unpackVarInt(data, offset+8)
+		scriptStart = offset + 8 + numBytesInLen
+		scriptPubKey = Script.deserialize(data, scriptStart,
+			min(scriptStart + scriptPubKeyLen, len(data)))
 
 		obj = TxOut(amount, scriptPubKey)
 		numBytes = 8 + numBytesInLen + scriptPubKeyLen
@@ -480,39 +486,74 @@ class Transaction:
 		Exception: deserialization failed
 		"""
 
-		version = struct.unpack('<I', data[:4])[0] #version, uint32_t
-		data = data[4:]
+		tx, numBytes = Transaction.deserializeFrom(data)
+
+		#To make sure we're not accepting a transaction that has been serialized
+		#in a non-standard way (e.g. containing trailing information).
+		#This might be important when making/checking signatures.
+		#It might be advisable anyway to re-serialize a received transaction and
+		#check whether the result matches the original.
+		if numBytes != len(data):
+			raise Exception("Transaction deserialization failed: incorrect data length")
+
+		return tx
+
+
+	@staticmethod
+	def deserializeFrom(data, offset=0):
+		"""
+		De-serializes a transaction that is embedded in a larger string,
+		e.g. a serialized block.
+		This is a static method: it can be called without having an instance,
+		as an alternative to calling the constructor directly.
+
+		Arguments:
+		data: str; contains the serialized transaction.
+		      May contain trailing bytes that are not part of the serialized
+		      transaction.
+		offset: int; the start of the transaction in data (default: 0)
+
+		Return value:
+		Tuple, containing:
+		Transaction; the de-serialized transaction
+		int; the number of bytes that has been read
+
+		Exceptions:
+		Exception: deserialization failed
+		struct.error: unexpected end of data
+		"""
+
+		pos = offset
+
+		version = struct.unpack_from('<I', data, pos)[0] #version, uint32_t
+		pos += 4
 
 		if version != 1:
 			raise Exception("Transaction deserialization failed: version != 1")
 
-		num_tx_in, numBytes = unpackVarInt(data)
-		data = data[numBytes:]
+		num_tx_in, numBytes = unpackVarInt(data, pos)
+		pos += numBytes
 		tx_in = []
 		for i in range(num_tx_in):
-			obj, numBytes = TxIn.deserialize(data)
-			data = data[numBytes:]
+			obj, numBytes = TxIn.deserialize(data, pos)
+			pos += numBytes
 			tx_in.append(obj)
 
-		num_tx_out, numBytes = unpackVarInt(data)
-		data = data[numBytes:]
+		num_tx_out, numBytes = unpackVarInt(data, pos)
+		pos += numBytes
 		tx_out = []
 		for i in range(num_tx_out):
-			obj, numBytes = TxOut.deserialize(data)
-			data = data[numBytes:]
+			obj, numBytes = TxOut.deserialize(data, pos)
+			pos += numBytes
 			tx_out.append(obj)
 
-		#To make sure we're not accepting a transaction that has been serialized
-		#in a non-standard way (e.g. containing trailing information).
-		#This might be important when making/checking signatures.
-		#It might be advisable anyway to re-serialize a received transaction and
-		#check whether the result matches the original.
-		if len(data) != 4:
+		if pos + 4 > len(data):
 			raise Exception("Transaction deserialization failed: incorrect data length")
 
-		lockTime = struct.unpack('<I', data[:4])[0] #uint32_t
+		lockTime = struct.unpack_from('<I', data, pos)[0] #uint32_t
+		pos += 4
 
-		return Transaction(tx_in, tx_out, lockTime)
+		return Transaction(tx_in, tx_out, lockTime), pos - offset
 
 
 	def __init__(self, tx_in, tx_out, lockTime=0):
@@ -567,42 +608,8 @@ class Transaction:
 		signatures.
 		"""
 
-		#https://en.bitcoin.it/wiki/OP_CHECKSIG
-
-		#1.	the public key and the signature are popped from the stack, in that
-		#	order. If the hash-type value is 0, then it is replaced by the
-		#	last_byte of the signature. Then the last byte of the signature is
-		#	always deleted.
-		#2.	A new subscript is created from the instruction from the most
-		#	recently parsed OP_CODESEPARATOR (last one in script) to the end of
-		#	the script. If there is no OP_CODESEPARATOR the entire script
-		#	becomes the subscript (hereby referred to as subScript)
-		#3.	The sig is deleted from subScript.
-		#4.	All OP_CODESEPARATORS are removed from subScript
-
-		#Since there is no OP_CODESEPARATOR or signature in scriptPubKey:
-		subScript = scriptPubKey
-
-		#6.	A copy is made of the current transaction (hereby referred to txCopy)
-		txCopy = copy.deepcopy(self)
-
-		#7.	The scripts for all transaction inputs in txCopy are set to empty
-		#	scripts (exactly 1 byte 0x00)
-		for tx_in in txCopy.tx_in:
-			tx_in.scriptSig = Script() #Empty (zero-byte)
-
-		#8.	The script for the current transaction input in txCopy is set to
-		#	subScript (lead in by its length as a var-integer encoded!)
-		txCopy.tx_in[index].scriptSig = subScript
-
-		#An array of bytes is constructed from the serialized txCopy appended by
-		#four bytes for the hash type.
-		signatureBody = txCopy.serialize() + struct.pack('<I', hashType) #uint32_t
-
-		#This array is sha256 hashed twice,
-		bodyHash = SHA256(SHA256(signatureBody))
-
-		return bodyHash
+		return SigningSession(self).getSignatureBodyHash(
+			index, scriptPubKey, hashType)
 
 
 	def signInputWithSignatures(self, index, scriptSigTemplate, signatures):
@@ -663,6 +670,35 @@ class Transaction:
 		self.signInputWithSignatures(index, scriptSigTemplate, signatures)
 
 
+	def signInputs(self, inputs):
+		"""
+		Signs multiple inputs with the given private keys.
+		This is faster than calling signInput for each input, since the
+		serialized transaction is shared by all signatures.
+
+		Arguments:
+		inputs: list of tuple (index, scriptPubKey, scriptSigTemplate, privateKeys);
+		        for each input to be signed, the arguments as they would
+		        be passed to signInput.
+		"""
+
+		session = SigningSession(self)
+
+		hashType = 1 #SIGHASH_ALL
+		signItems = []
+		for index, scriptPubKey, scriptSigTemplate, privateKeys in inputs:
+			bodyHash = session.getSignatureBodyHash(index, scriptPubKey, hashType)
+			signItems += [(key, bodyHash) for key in privateKeys]
+
+		hashTypeByte = struct.pack('B', hashType) #uint8_t
+		allSignatures = [sig + hashTypeByte for sig in signMany(signItems)]
+
+		for index, scriptPubKey, scriptSigTemplate, privateKeys in inputs:
+			signatures = allSignatures[:len(privateKeys)]
+			allSignatures = allSignatures[len(privateKeys):]
+			self.signInputWithSignatures(index, scriptSigTemplate, signatures)
+
+
 	def getTransactionID(self):
 		"""
 		Returns the transaction ID.
@@ -671,6 +707,206 @@ class Transaction:
 		str; the transaction ID. Note that the byte order is the reverse as
 		shown in Bitcoin.
 		"""
-		return SHA256(SHA256(self.serialize())) #Note: in Bitcoin, the tx hash is shown reversed!
+		return doubleSHA256(self.serialize()) #Note: in Bitcoin, the tx hash is shown reversed!
+
+
+
+def getTransactionSize(data, offset=0):
+	"""
+	Determines the size of a serialized transaction, without de-serializing
+	its inputs and outputs.
+
+	Arguments:
+	data: str; contains the serialized transaction.
+	      May contain trailing bytes that are not part of the serialized
+	      transaction.
+	offset: int; the start of the transaction in data (default: 0)
+
+	Return value:
+	int; the size of the serialized transaction, in bytes
+
+	Exceptions:
+	Exception: the data is too short to contain the transaction
+	struct.error: unexpected end of data
+	"""
+
+	pos = offset + 4 #version
+
+	num_tx_in, numBytes = unpackVarInt(data, pos)
+	pos += numBytes
+	for i in range(num_tx_in):
+		pos += 36 #previous output hash and index
+		scriptLen, numBytes = unpackVarInt(data, pos)
+		pos += numBytes + scriptLen + 4 #script and sequence number
+
+	num_tx_out, numBytes = unpackVarInt(data, pos)
+	pos += numBytes
+	for i in range(num_tx_out):
+		pos += 8 #amount
+		scriptLen, numBytes = unpackVarInt(data, pos)
+		pos += numBytes + scriptLen
+
+	pos += 4 #lock time
+
+	if pos > len(data):
+		raise Exception("Unexpected end of transaction data")
+
+	return pos - offset
+
+
+def iterBlockTransactionRanges(block):
+	"""
+	Iterates over the locations of the transactions in a serialized block.
+	The transactions are not de-serialized.
+
+	Arguments:
+	block: str; the serialized block (header and transactions)
+
+	Return value:
+	generator of tuple (offset, size)
+	offset: int; the start of the transaction in block
+	size: int; the size of the serialized transaction, in bytes
+
+	Exceptions:
+	Exception: the block data is invalid
+	struct.error: unexpected end of data
+	"""
+
+	pos = 80 #block header
+
+	numTransactions, numBytes = unpackVarInt(block, pos)
+	pos += numBytes
+
+	for i in range(numTransactions):
+		size = getTransactionSize(block, pos)
+		yield pos, size
+		pos += size
+
+	if pos != len(block):
+		raise Exception("Block parsing failed: incorrect data length")
+
+
+def iterBlockTransactions(block):
+	"""
+	Iterates over the transactions in a serialized block.
+	Transactions are de-serialized one at a time, when they are requested.
+
+	Arguments:
+	block: str; the serialized block (header and transactions)
+
+	Return value:
+	generator of Transaction
+
+	Exceptions:
+	Exception: the block data is invalid
+	struct.error: unexpected end of data
+	"""
+
+	for offset, size in iterBlockTransactionRanges(block):
+		tx, numBytes = Transaction.deserializeFrom(block, offset)
+		yield tx
+
+
+class SigningSession:
+	"""
+	Calculates the signature body hashes of the inputs of a transaction.
+
+	The signature bodies of all inputs are equal, except for the script of
+	the input that is being signed. This class serializes the equal parts
+	only once, and keeps the SHA256 state after the data that precedes each
+	input, so that that data does not need to be hashed again.
+
+	The session reflects the transaction at the time of construction; changes
+	to scriptSigs (e.g. by signing) do not matter, since these are not
+	part of the signature bodies, but other changes require a new session.
+	"""
+
+	def __init__(self, transaction):
+		"""
+		Constructor.
+
+		Arguments:
+		transaction: Transaction; the transaction
+		"""
+
+		#https://en.bitcoin.it/wiki/OP_CHECKSIG
+
+		#1.	the public key and the signature are popped from the stack, in that
+		#	order. If the hash-type value is 0, then it is replaced by the
+		#	last_byte of the signature. Then the last byte of the signature is
+		#	always deleted.
+		#2.	A new subscript is created from the instruction from the most
+		#	recently parsed OP_CODESEPARATOR (last one in script) to the end of
+		#	the script. If there is no OP_CODESEPARATOR the entire script
+		#	becomes the subscript (hereby referred to as subScript)
+		#3.	The sig is deleted from subScript.
+		#4.	All OP_CODESEPARATORS are removed from subScript
+		#6.	A copy is made of the current transaction (hereby referred to txCopy)
+		#7.	The scripts for all transaction inputs in txCopy are set to empty
+		#	scripts (exactly 1 byte 0x00)
+		#8.	The script for the current transaction input in txCopy is set to
+		#	subScript (lead in by its length as a var-integer encoded!)
+
+		#Instead of making txCopy, its parts are serialized here:
+		sequenceNumber = struct.pack('<I', 0xffffffff) #uint32_t
+
+		#Outpoints of the inputs:
+		self.outPoints = \
+		[
+			tx_in.previousOutputHash +
+			struct.pack('<I', tx_in.previousOutputIndex) #uint32_t
+			for tx_in in transaction.tx_in
+		]
 
+		#Inputs with an empty script, and where each of them starts:
+		emptyInputs = [p + "\x00" + sequenceNumber for p in self.outPoints]
+		self.emptyInputs = "".join(emptyInputs)
+		self.inputOffsets = [0]
+		for x in emptyInputs:
+			self.inputOffsets.append(self.inputOffsets[-1] + len(x))
 
+		self.outputs = packVarInt(len(transaction.tx_out))
+		self.outputs += "".join(tx_out.serialize() for tx_out in transaction.tx_out)
+		self.outputs += struct.pack('<I', transaction.lockTime) #uint32_t
+
+		#SHA256 state after the data that precedes each input:
+		h = SHA256Context(
+			struct.pack('<I', 1) + #version, uint32_t
+			packVarInt(len(transaction.tx_in))
+			)
+		self.midStates = []
+		for x in emptyInputs:
+			self.midStates.append(h.copy())
+			h.update(x)
+
+
+	def getSignatureBodyHash(self, index, scriptPubKey, hashType=1):
+		"""
+		Arguments:
+		index: int; the index of the transaction input to which a signature
+		       applies
+		scriptPubKey: Script; the scriptPubKey of the output to which the
+		              signature applies
+		hashType: int; the hash type (default: SIGHASH_ALL = 1)
+
+		Return value:
+		str; the signature body hash; see Transaction.getSignatureBodyHash.
+		"""
+
+		#Since there is no OP_CODESEPARATOR or signature in scriptPubKey:
+		subScript = scriptPubKey.serialize()
+
+		h = self.midStates[index].copy()
+		h.update(
+			self.outPoints[index] +
+			packVarInt(len(subScript)) + subScript +
+			struct.pack('<I', 0xffffffff) #sequence number, uint32_t
+			)
+		h.update(self.emptyInputs[self.inputOffsets[index+1]:])
+
+		#An array of bytes is constructed from the serialized txCopy appended by
+		#four bytes for the hash type.
+		h.update(self.outputs + struct.pack('<I', hashType)) #uint32_t
+
+		#This array is sha256 hashed twice,
+		return SHA256(h.digest())
@@ -28,18 +28,60 @@
 
 import base58
 import struct
+import threading
 
 from bitcointransaction import Transaction, TxIn, TxOut, Script, OP
 
-from crypto import Key, SHA256
+from crypto import Key, SHA256, verifyMany, publicKeyCache
 
 
 
+#Outputs that are spent by transactions which have been made, but not yet
+#sent to the Bitcoin network. getInputsForAmount does not use these.
+#Each element is a tuple (txid, vout), with txid as in the inputs returned
+#by getInputsForAmount.
+reservedOutputs = set()
+reservedOutputsLock = threading.Lock()
+
+
+def reserveInputs(tx):
+	"""
+	Reserves the outputs spent by the inputs of a transaction, so that
+	getInputsForAmount doesn't select them again, until releaseInputs is
+	called.
+	Note that selecting inputs and reserving them must be done without
+	interruption by other transaction-making code, to prevent conflicts.
+
+	Arguments:
+	tx: Transaction; the transaction
+	"""
+
+	with reservedOutputsLock:
+		reservedOutputs.update(
+			(txIn.previousOutputHash, txIn.previousOutputIndex)
+			for txIn in tx.tx_in)
+
+
+def releaseInputs(tx):
+	"""
+	Ends the reservation made by reserveInputs. Inputs that were not
+	reserved are ignored.
+
+	Arguments:
+	tx: Transaction; the transaction
+	"""
+
+	with reservedOutputsLock:
+		reservedOutputs.difference_update(
+			(txIn.previousOutputHash, txIn.previousOutputIndex)
+			for txIn in tx.tx_in)
+
+
 def getInputsForAmount(bitcoind, amount):
 	"""
 	Returns information about unspent outputs, which are available to be used
 	as inputs for a new transaction, and have a total amount that is at least
-	the requested amount.
+	the requested amount. Outputs reserved with reserveInputs are not used.
 
 	Arguments:
 	bitcoind: Bitcoind; the bitcoin daemon from which to retrieve this information
@@ -64,6 +106,11 @@ def getInputsForAmount(bitcoind, amount):
 	#Filter: only use "normal" outputs, not multisig etc.
 	unspent = [u for u in unspent if "address" in u]
 
+	#Filter: don't use outputs that will be spent by unpublished transactions
+	with reservedOutputsLock:
+		unspent = [u for u in unspent
+			if (u["txid"], u["vout"]) not in reservedOutputs]
+
 	#TODO: think about the best policy here.
 	#Possible objectives:
 	# - minimizing taint between addresses (privacy protection)
@@ -90,16 +137,36 @@ def getInputsForAmount(bitcoind, amount):
 			used.append(u)
 			total += u["amount"]
 
-	for u in used:
-		address = u["address"]
-		u["privateKey"] = base58.decodeBase58Check(
-			bitcoind.getPrivateKey(address), 128)
+	privateKeys = bitcoind.getPrivateKeys([u["address"] for u in used])
+	privateKeys = base58.decodeBase58CheckMany(privateKeys, 128) #PRIVKEY = 128
+	for u, privateKey in zip(used, privateKeys):
+		u["privateKey"] = privateKey
 
 	return total, [
 		(u["txid"], u["vout"], u["scriptPubKey"], u["privateKey"])
 		for u in used]
 
 
+def signInputs(tx, inputs):
+	"""
+	Sign all inputs of a transaction that spends standard Bitcoin scriptPubKeys.
+
+	Arguments:
+	tx: Transaction; the transaction. Note that the transaction will be changed
+	    by this function.
+	inputs: list of tuple (txid, vout, scriptPubKey, privateKey); the input
+	        information, as returned by getInputsForAmount
+	"""
+
+	signData = []
+	for i in range(len(inputs)):
+		scriptPubKey = Script.deserialize(inputs[i][2])
+		key = Key()
+		key.setPrivateKey(inputs[i][3])
+		signData.append((i, scriptPubKey, [None, key.getPublicKey()], [key]))
+	tx.signInputs(signData)
+
+
 def sendToStandardPubKey(bitcoind, amount, toHash, changeHash, fee):
 	"""
 	Make a transaction to send funds from ourself to a standard Bitcoin
@@ -138,11 +205,7 @@ def sendToStandardPubKey(bitcoind, amount, toHash, changeHash, fee):
 			]
 		)
 
-	for i in range(len(inputs)):
-		scriptPubKey = Script.deserialize(inputs[i][2])
-		key = Key()
-		key.setPrivateKey(inputs[i][3])
-		tx.signInput(i, scriptPubKey, [None, key.getPublicKey()], [key])
+	signInputs(tx, inputs)
 
 	return tx
 
@@ -184,11 +247,7 @@ def sendToDataPubKey(bitcoind, data, changeHash, fee):
 			]
 		)
 
-	for i in range(len(inputs)):
-		scriptPubKey = Script.deserialize(inputs[i][2])
-		key = Key()
-		key.setPrivateKey(inputs[i][3])
-		tx.signInput(i, scriptPubKey, [None, key.getPublicKey()], [key])
+	signInputs(tx, inputs)
 
 	return tx
 
@@ -231,11 +290,7 @@ def sendToMultiSigPubKey(bitcoind, amount, toPubKey1, toPubKey2, changeHash, fee
 			]
 		)
 
-	for i in range(len(inputs)):
-		scriptPubKey = Script.deserialize(inputs[i][2])
-		key = Key()
-		key.setPrivateKey(inputs[i][3])
-		tx.signInput(i, scriptPubKey, [None, key.getPublicKey()], [key])
+	signInputs(tx, inputs)
 
 	return tx
 
@@ -304,8 +359,8 @@ def verifyMultiSigSignature(tx, inputIndex, pubKeys, key, signature):
 	            applies
 	pubKeys: sequence of str; the public keys
 	         2 <= len(pubKeys) <= 16
-	key: Key; the public key used for signing (should correspond to one of the
-	     keys in pubKeys)
+	key: Key or str; the public key used for signing (should correspond to one
+	     of the keys in pubKeys). A str is taken from the public key cache.
 	signature: str; the signature, including the hash type
 
 	Return value:
@@ -315,13 +370,52 @@ def verifyMultiSigSignature(tx, inputIndex, pubKeys, key, signature):
 	Exception: signature verification failed
 	"""
 
-	hashType = struct.unpack('B', signature[-1])[0] #uint8_t
-	if hashType != 1: #SIGHASH_ALL
-		return False
-	signature = signature[:-1]
+	return verifyMultiSigSignatures(
+		tx, inputIndex, pubKeys, [key], [signature])[0]
+
+
+def verifyMultiSigSignatures(tx, inputIndex, pubKeys, keys, signatures):
+	"""
+	Verify several signatures for a transaction that spends a 2-of-2
+	multi-signature output. The signature body hash is calculated only once.
+
+	Arguments:
+	tx: Transaction; the transaction
+	inputIndex: int; the index of the transaction input to which the signatures
+	            apply
+	pubKeys: sequence of str; the public keys
+	         2 <= len(pubKeys) <= 16
+	keys: list of Key or str; the public keys used for signing (should
+	      correspond to keys in pubKeys). Keys given as str are taken from
+	      the public key cache.
+	signatures: list of str; the signatures, including the hash type, in the
+	            same order as keys
+
+	Return value:
+	list of bool; for each signature, whether it is correct (True) or not (False)
+
+	Exceptions:
+	Exception: signature verification failed
+	"""
+
+	hashType = 1 #SIGHASH_ALL
 	scriptPubKey = Script.multiSigPubKey(pubKeys)
 	bodyHash = tx.getSignatureBodyHash(inputIndex, scriptPubKey, hashType)
-	return key.verify(bodyHash, signature)
+
+	ret = [False] * len(signatures)
+	items = []
+	indices = []
+	for i, (key, signature) in enumerate(zip(keys, signatures)):
+		if struct.unpack('B', signature[-1])[0] != hashType: #uint8_t
+			continue
+		if not isinstance(key, Key):
+			key = publicKeyCache.getKey(key)
+		items.append((key, bodyHash, signature[:-1]))
+		indices.append(i)
+
+	for i, result in zip(indices, verifyMany(items)):
+		ret[i] = result
+	return ret
 
 
 def applyMultiSigSignatures(tx, sig1, sig2):
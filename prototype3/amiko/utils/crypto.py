@@ -29,6 +29,10 @@
 
 import threading
 import ctypes
+import sys
+import Queue
+import collections
+import atexit
 
 libssl = ctypes.cdll.LoadLibrary("libssl.so") #Will be different on windows
 
@@ -47,6 +51,33 @@ class BIGNUM(ctypes.Structure):
 	]
 
 
+class SHA256_CTX(ctypes.Structure):
+	_fields_ = \
+	[
+	("h", ctypes.c_uint * 8),
+	("Nl", ctypes.c_uint),
+	("Nh", ctypes.c_uint),
+	("data", ctypes.c_uint * 16),
+	("num", ctypes.c_uint),
+	("md_len", ctypes.c_uint)
+	]
+
+
+class RIPEMD160_CTX(ctypes.Structure):
+	_fields_ = \
+	[
+	("A", ctypes.c_uint),
+	("B", ctypes.c_uint),
+	("C", ctypes.c_uint),
+	("D", ctypes.c_uint),
+	("E", ctypes.c_uint),
+	("Nl", ctypes.c_uint),
+	("Nh", ctypes.c_uint),
+	("data", ctypes.c_uint * 16),
+	("num", ctypes.c_uint)
+	]
+
+
 #Callback types:
 #Maybe WINFUNCTYPE in windows?
 lockingCallbackType = ctypes.CFUNCTYPE(None,
@@ -126,10 +157,38 @@ libssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
 libssl.ECDSA_verify.restype = ctypes.c_int
 
 libssl.SHA256.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p]
-libssl.SHA256.restype = ctypes.c_char_p
+libssl.SHA256.restype = ctypes.c_void_p
+
+libssl.SHA256_Init.argtypes = [ctypes.c_void_p]
+libssl.SHA256_Init.restype = ctypes.c_int
+
+libssl.SHA256_Update.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+libssl.SHA256_Update.restype = ctypes.c_int
+
+libssl.SHA256_Final.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+libssl.SHA256_Final.restype = ctypes.c_int
 
 libssl.RIPEMD160.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p]
-libssl.RIPEMD160.restype = ctypes.c_char_p
+libssl.RIPEMD160.restype = ctypes.c_void_p
+
+libssl.RIPEMD160_Init.argtypes = [ctypes.c_void_p]
+libssl.RIPEMD160_Init.restype = ctypes.c_int
+
+libssl.RIPEMD160_Update.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+libssl.RIPEMD160_Update.restype = ctypes.c_int
+
+libssl.RIPEMD160_Final.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+libssl.RIPEMD160_Final.restype = ctypes.c_int
+
+#Variants of the one-shot hash functions that take raw addresses, for hashing
+#into and from the middle of a buffer:
+SHA256_raw = libssl["SHA256"]
+SHA256_raw.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+SHA256_raw.restype = ctypes.c_void_p
+
+RIPEMD160_raw = libssl["RIPEMD160"]
+RIPEMD160_raw.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+RIPEMD160_raw.restype = ctypes.c_void_p
 
 libssl.d2i_ECPrivateKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long]
 libssl.d2i_ECPrivateKey.restype = ctypes.c_void_p
@@ -195,6 +254,18 @@ def cleanup():
 	#TODO: maybe clean up the callbacks?
 
 
+#Per-thread output buffer of the hash functions, so that they don't need to
+#allocate one on every call:
+threadLocal = threading.local()
+
+def getHashBuffer():
+	try:
+		return threadLocal.hashBuffer
+	except AttributeError:
+		threadLocal.hashBuffer = ctypes.create_string_buffer(32)
+		return threadLocal.hashBuffer
+
+
 def SHA256(data):
 	"""
 	Calculate the SHA256 hash of given data
@@ -209,9 +280,115 @@ def SHA256(data):
 	        (at least some cases of) the byte order used in Bitcoin.
 	"""
 
-	b = ctypes.create_string_buffer(32)
+	b = getHashBuffer()
 	libssl.SHA256(data, len(data), b)
-	return ''.join(b)
+	return b.raw
+
+
+def doubleSHA256(data):
+	"""
+	Calculate SHA256(SHA256(data)), without making an intermediate string.
+
+	Arguments:
+	data : str; the data of which to calculate the hash
+
+	Return value:
+	str; the hash, in the same form as returned by SHA256.
+	"""
+
+	b = getHashBuffer()
+	libssl.SHA256(data, len(data), b)
+	SHA256_raw(b, 32, b)
+	return b.raw
+
+
+def SHA256Many(items, double=False):
+	"""
+	Calculate the SHA256 hashes of many data items.
+	This is faster than calling SHA256 for every item.
+
+	Arguments:
+	items : list of str; the data items
+	double : bool; if True, calculate SHA256(SHA256(item)) (default: False)
+
+	Return value:
+	list of str; the hashes, in the same order as items, in the same form as
+	returned by SHA256.
+	"""
+
+	data = "".join(items)
+	b = ctypes.create_string_buffer(32*len(items))
+
+	#Note: ctypes passes the internal buffer of a str, without copying it
+	dataAddress = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+	bAddress = ctypes.addressof(b)
+	for item in items:
+		size = len(item)
+		SHA256_raw(dataAddress, size, bAddress)
+		if double:
+			SHA256_raw(bAddress, 32, bAddress)
+		dataAddress += size
+		bAddress += 32
+
+	raw = b.raw
+	return [raw[i:i+32] for i in range(0, len(raw), 32)]
+
+
+def SHA256Chunks(data, chunkSize, double=False):
+	"""
+	Calculate the SHA256 hashes of consecutive, equally-sized chunks of data.
+
+	Arguments:
+	data : str; the data. Its length must be a multiple of chunkSize.
+	chunkSize : int; the size of the chunks
+	double : bool; if True, calculate SHA256(SHA256(chunk)) (default: False)
+
+	Return value:
+	str; the concatenated hashes, 32 bytes per chunk, in the same form as
+	returned by SHA256.
+	"""
+
+	numChunks = len(data) / chunkSize
+	b = ctypes.create_string_buffer(32*numChunks)
+
+	dataAddress = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+	bAddress = ctypes.addressof(b)
+	for i in xrange(numChunks):
+		SHA256_raw(dataAddress, chunkSize, bAddress)
+		if double:
+			SHA256_raw(bAddress, 32, bAddress)
+		dataAddress += chunkSize
+		bAddress += 32
+
+	return b.raw
+
+
+def SHA256File(f, chunkSize=1048576):
+	"""
+	Calculate the SHA256 hash of the contents of a file.
+	The file is read in chunks, so memory usage does not depend on the file
+	size.
+
+	Arguments:
+	f : file; the file, opened in binary mode. It is read until the end.
+	chunkSize : int; the number of bytes read at a time (default: 1 MiB)
+
+	Return value:
+	str; the SHA256 hash.
+	Note: this is in binary form (not hexadecimal), in the same byte order as
+	returned by SHA256.
+
+	Exceptions:
+	Exception: hashing failed
+	"""
+
+	h = SHA256Context()
+	while True:
+		data = f.read(chunkSize)
+		if len(data) == 0:
+			break
+		h.update(data)
+	return h.digest()
 
 
 def RIPEMD160(data):
@@ -226,9 +403,226 @@ def RIPEMD160(data):
 	Note: this is in binary form (not hexadecimal).
 	"""
 
-	b = ctypes.create_string_buffer(20)
+	b = getHashBuffer()
 	libssl.RIPEMD160(data, len(data), b)
-	return ''.join(b)
+	return b.raw[:20]
+
+
+def hash160(data):
+	"""
+	Calculate RIPEMD160(SHA256(data)), without making an intermediate string.
+
+	Arguments:
+	data : str; the data of which to calculate the hash
+
+	Return value:
+	str; the hash, in the same form as returned by RIPEMD160.
+	"""
+
+	b = getHashBuffer()
+	libssl.SHA256(data, len(data), b)
+	RIPEMD160_raw(b, 32, b)
+	return b.raw[:20]
+
+
+
+class HashContext:
+	"""
+	Base class of incremental hash calculation objects.
+	The interface is similar to that of the objects in Python's hashlib module.
+	"""
+
+	#To be defined in derived classes:
+	contextType = None
+	digest_size = None
+	initFunction = None
+	updateFunction = None
+	finalFunction = None
+
+
+	def __init__(self, data=None):
+		"""
+		Constructor.
+
+		Arguments:
+		data: str; initial data (optional)
+
+		Exceptions:
+		Exception: initialization failed
+		"""
+
+		self.context = self.contextType()
+		if not getattr(libssl, self.initFunction)(ctypes.byref(self.context)):
+			raise Exception(self.initFunction + " failed")
+		if data is not None:
+			self.update(data)
+
+
+	def update(self, data):
+		"""
+		Adds data to the hashed data.
+
+		Arguments:
+		data: str; the data
+
+		Exceptions:
+		Exception: hashing failed
+		"""
+
+		if not getattr(libssl, self.updateFunction)(
+				ctypes.byref(self.context), data, len(data)):
+			raise Exception(self.updateFunction + " failed")
+
+
+	def digest(self):
+		"""
+		Return value:
+		str; the hash of all data added so far, in binary form.
+		More data can still be added afterwards.
+
+		Exceptions:
+		Exception: hashing failed
+		"""
+
+		#Finalizing changes the context, so do it on a copy:
+		context = self.contextType.from_buffer_copy(self.context)
+		b = getHashBuffer()
+		if not getattr(libssl, self.finalFunction)(b, ctypes.byref(context)):
+			raise Exception(self.finalFunction + " failed")
+		return b.raw[:self.digest_size]
+
+
+	def hexdigest(self):
+		return self.digest().encode("hex")
+
+
+	def copy(self):
+		"""
+		Return value:
+		HashContext; an independent copy of this object, in the same state.
+		"""
+
+		ret = self.__class__()
+		ret.context = self.contextType.from_buffer_copy(self.context)
+		return ret
+
+
+
+class SHA256Context(HashContext):
+	"""
+	Incremental SHA256 hash calculation.
+	"""
+
+	contextType = SHA256_CTX
+	digest_size = 32
+	initFunction = "SHA256_Init"
+	updateFunction = "SHA256_Update"
+	finalFunction = "SHA256_Final"
+
+
+
+class RIPEMD160Context(HashContext):
+	"""
+	Incremental RIPEMD160 hash calculation.
+	"""
+
+	contextType = RIPEMD160_CTX
+	digest_size = 20
+	initFunction = "RIPEMD160_Init"
+	updateFunction = "RIPEMD160_Update"
+	finalFunction = "RIPEMD160_Final"
+
+
+
+class WorkerPool:
+	"""
+	A pool of worker threads for applying a function to chunks of a list.
+	Since ctypes releases the GIL during library calls, this allows OpenSSL
+	operations to run in parallel.
+	The threads are only created when they are needed for the first time,
+	and are then kept for later calls.
+	"""
+
+	def __init__(self):
+		self.tasks = Queue.Queue()
+		self.threads = []
+		self.lock = threading.Lock()
+
+
+	def map(self, function, items, numThreads=1):
+		"""
+		Apply a function to consecutive chunks of a list.
+
+		Arguments:
+		function: function (list) -> list; is called once for each chunk, and
+		          should return one result per item in the chunk
+		items: list; the items
+		numThreads: int; the maximum number of threads (default: 1)
+		            With a value of 1, function is called in the calling thread.
+
+		Return value:
+		list; the concatenated results of all calls of function
+
+		Exceptions:
+		any exception raised by function (the first one, if there are several)
+		"""
+
+		numThreads = max(1, min(numThreads, len(items)))
+		if numThreads == 1:
+			return function(items)
+
+		chunkSize = (len(items) + numThreads - 1) / numThreads
+		chunks = [items[i:i+chunkSize] for i in range(0, len(items), chunkSize)]
+
+		#The calling thread does the first chunk:
+		self.startThreads(len(chunks) - 1)
+		done = Queue.Queue()
+		for i in range(1, len(chunks)):
+			self.tasks.put((function, chunks[i], i, done))
+		results = [None] * len(chunks)
+		errors = []
+		self.run(function, chunks[0], 0, done)
+		for c in chunks:
+			i, result, error = done.get()
+			results[i] = result
+			if error is not None:
+				errors.append(error)
+
+		if errors:
+			raise errors[0][0], errors[0][1], errors[0][2]
+
+		ret = []
+		for r in results:
+			ret += r
+		return ret
+
+
+	def startThreads(self, numThreads):
+		with self.lock:
+			while len(self.threads) < numThreads:
+				t = threading.Thread(
+					name='crypto worker %d' % len(self.threads),
+					target=self.work)
+				t.daemon = True
+				t.start()
+				self.threads.append(t)
+
+
+	def run(self, function, chunk, i, done):
+		try:
+			done.put((i, function(chunk), None))
+		except:
+			done.put((i, None, sys.exc_info()))
+
+
+	def work(self):
+		while True:
+			self.run(*self.tasks.get())
+
+
+#The shared worker pool of signMany and verifyMany:
+workerPool = WorkerPool()
+
 
 
 class Key:
@@ -463,20 +857,26 @@ class Key:
 		Exception: signing failed
 		"""
 
-		if not self.hasPrivateKey:
-			raise Exception("private key unknown")
+		return signChunk([(self, data)])[0]
 
-		size = ctypes.c_int(libssl.ECDSA_size(self.keyData))
 
-		b_data = ctypes.create_string_buffer(data)
+	def signMany(self, dataList, numThreads=1):
+		"""
+		Sign multiple pieces of data.
+		Note: private key must be available.
 
-		b_sig = ctypes.create_string_buffer(size.value)
+		Arguments:
+		dataList : list of str; the data to be signed.
+		numThreads: int; the maximum number of threads to use (default: 1)
 
-		if not libssl.ECDSA_sign(0, ctypes.byref(b_data), len(data),
-				ctypes.byref(b_sig), ctypes.byref(size), self.keyData):
-			raise Exception("ECDSA_sign failed")
+		Return value:
+		list of str; the signatures, in the same order as dataList.
+
+		Exceptions:
+		Exception: signing failed
+		"""
 
-		return ''.join([b_sig[i] for i in range(size.value)]) #size contains actual size
+		return signMany([(self, data) for data in dataList], numThreads)
 
 
 	def verify(self, data, signature):
@@ -495,17 +895,235 @@ class Key:
 		Exception: signature verification failed
 		"""
 
-		if not self.hasPublicKey:
-			raise Exception("public key unknown")
+		return verifyChunk([(self, data, signature)])[0]
+
+
+	def verifyMany(self, items, numThreads=1):
+		"""
+		Verify multiple signatures.
+		Note: public key must be available.
+
+		Arguments:
+		items : list of tuple (str, str); the data to which each signature
+		        applies, and the signature.
+		numThreads: int; the maximum number of threads to use (default: 1)
+
+		Return value:
+		list of bool; for each signature, whether it is correct (True) or
+		not (False)
+
+		Exceptions:
+		Exception: signature verification failed
+		"""
+
+		return verifyMany(
+			[(self, data, signature) for data, signature in items], numThreads)
+
+
+
+class PublicKeyCache:
+	"""
+	A bounded cache of Key objects containing parsed public keys, so that
+	repeated verification with the same public key does not need to allocate
+	and parse a new key object every time.
+	The least recently used key is evicted when the cache is full.
+
+	Note: the Key objects are shared by all users of the cache; they should
+	only be used for operations that do not modify them (e.g. verify).
+	"""
+
+	def __init__(self, maxSize=100):
+		"""
+		Constructor.
+
+		Arguments:
+		maxSize: int; the maximum number of keys in the cache (default: 100)
+		"""
+
+		self.maxSize = maxSize
+		self.keys = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+
+	def __len__(self):
+		return len(self.keys)
+
+
+	def __contains__(self, publicKey):
+		return publicKey in self.keys
+
+
+	def getKey(self, publicKey):
+		"""
+		Gets a Key object for a public key, parsing it only if it is not
+		in the cache yet.
+
+		Arguments:
+		publicKey: str; the public key data
 
-		b_data = ctypes.create_string_buffer(data)
+		Return value:
+		Key; a key object containing the public key
+
+		Exceptions:
+		Exception: setting the key failed
+		"""
+
+		with self.lock:
+			key = self.keys.pop(publicKey, None)
+			if key is not None:
+				self.keys[publicKey] = key #move to the most recent position
+				self.hits += 1
+				return key
+			self.misses += 1
+
+		key = Key()
+		key.setPublicKey(publicKey)
+
+		with self.lock:
+			#Another thread may have added it in the mean time; that's OK.
+			self.keys[publicKey] = key
+			while len(self.keys) > self.maxSize:
+				self.keys.popitem(last=False)
+
+		return key
+
+
+	def evict(self, publicKey):
+		"""
+		Removes a public key from the cache, if it is present.
+
+		Arguments:
+		publicKey: str; the public key data
+		"""
+
+		with self.lock:
+			self.keys.pop(publicKey, None)
+
+
+	def clear(self):
+		"""
+		Removes all keys from the cache.
+		"""
+
+		with self.lock:
+			self.keys.clear()
+
+
+#The shared public key cache:
+publicKeyCache = PublicKeyCache()
+
+#The cached keys must be freed while the module is still intact: freeing
+#them during interpreter shutdown calls lockingCallback after the module
+#globals are gone, which crashes the interpreter.
+atexit.register(publicKeyCache.clear)
+
+
+def signChunk(items):
+	"""
+	Sign multiple pieces of data, re-using the signature buffer.
+	Note: intended for use in signMany.
+
+	Arguments:
+	items: list of tuple (Key, str); the keys and the data to be signed
+
+	Return value:
+	list of str; the signatures
+
+	Exceptions:
+	Exception: signing failed
+	"""
+
+	b_sig = None
+	size = ctypes.c_int()
+	ret = []
+	for key, data in items:
+		if not key.hasPrivateKey:
+			raise Exception("private key unknown")
+
+		maxSize = libssl.ECDSA_size(key.keyData)
+		if b_sig is None or len(b_sig) < maxSize:
+			b_sig = ctypes.create_string_buffer(maxSize)
+
+		if not libssl.ECDSA_sign(0, data, len(data),
+				b_sig, ctypes.byref(size), key.keyData):
+			raise Exception("ECDSA_sign failed")
+
+		ret.append(b_sig.raw[:size.value]) #size contains actual size
+	return ret
+
+
+def verifyChunk(items):
+	"""
+	Verify multiple signatures.
+	Note: intended for use in verifyMany.
+
+	Arguments:
+	items: list of tuple (Key, str, str); the keys, the data to which the
+	       signatures apply and the signatures
+
+	Return value:
+	list of bool; for each signature, whether it is correct
+
+	Exceptions:
+	Exception: signature verification failed
+	"""
+
+	ret = []
+	for key, data, signature in items:
+		if not key.hasPublicKey:
+			raise Exception("public key unknown")
 
 		# -1 = error, 0 = bad sig, 1 = good
-		result = libssl.ECDSA_verify(0, b_data, len(data), signature, len(signature), self.keyData)
+		result = libssl.ECDSA_verify(0, data, len(data),
+			signature, len(signature), key.keyData)
 		if result == 1:
-			return True
-		if result == 0:
-			return False
-		raise Exception("ECDSA_verify failed")
+			ret.append(True)
+		elif result == 0:
+			ret.append(False)
+		else:
+			raise Exception("ECDSA_verify failed")
+	return ret
+
 
+def signMany(items, numThreads=1):
+	"""
+	Sign multiple pieces of data, possibly with different keys.
+	The signature buffer is re-used within each thread.
+
+	Arguments:
+	items: list of tuple (Key, str); the keys (with private key) and the data
+	       to be signed
+	numThreads: int; the maximum number of threads to use (default: 1)
+
+	Return value:
+	list of str; the signatures, in the same order as items.
+
+	Exceptions:
+	Exception: signing failed
+	"""
+
+	return workerPool.map(signChunk, items, numThreads)
+
+
+def verifyMany(items, numThreads=1):
+	"""
+	Verify multiple signatures, possibly of different keys.
+	The keys are used as they are; to avoid parsing the same public key
+	again for every call, get them from publicKeyCache.
+
+	Arguments:
+	items: list of tuple (Key, str, str); the keys (with public key), the data
+	       to which the signatures apply and the signatures
+	numThreads: int; the maximum number of threads to use (default: 1)
+
+	Return value:
+	list of bool; for each signature, whether it is correct (True) or
+	not (False)
+
+	Exceptions:
+	Exception: signature verification failed
+	"""
 
+	return workerPool.map(verifyChunk, items, numThreads)
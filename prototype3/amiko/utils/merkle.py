@@ -0,0 +1,167 @@
+#    merkle.py
+#    Copyright (C) 2016 by CJP
+#
+#    This file is part of Amiko Pay.
+#
+#    Amiko Pay is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Amiko Pay is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Amiko Pay. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Additional permission under GNU GPL version 3 section 7
+#
+#    If you modify this Program, or any covered work, by linking or combining it
+#    with the OpenSSL library (or a modified version of that library),
+#    containing parts covered by the terms of the OpenSSL License and the SSLeay
+#    License, the licensors of this Program grant you additional permission to
+#    convey the resulting work. Corresponding Source for a non-source form of
+#    such a combination shall include the source code for the parts of the
+#    OpenSSL library used as well as that of the covered work.
+
+
+from crypto import SHA256Chunks, SHA256Many
+
+
+
+class MerkleTree:
+	"""
+	A Merkle tree, as used in Bitcoin blocks: every node is the double-SHA256
+	of the concatenation of its children. Levels with an odd number of nodes
+	are made even-length by repeating their last node.
+
+	Every level is stored as a single string of concatenated 32-byte hashes,
+	and is calculated from the level below it in a single call.
+	"""
+
+	def __init__(self, leaves):
+		"""
+		Constructor.
+
+		Arguments:
+		leaves: list of str; the leaves (32-byte hashes). Must not be empty.
+		        The list is not modified.
+		"""
+
+		if len(leaves) == 0:
+			raise Exception("A Merkle tree needs at least one leaf")
+		for leaf in leaves:
+			if len(leaf) != 32:
+				raise Exception("Merkle tree leaves must be 32-byte hashes")
+
+		self.numLeaves = len(leaves)
+
+		#Each element: str; a level, starting at the leaves
+		self.levels = []
+
+		level = "".join(leaves)
+		while len(level) > 32:
+			if (len(level) / 32) % 2 != 0:
+				level += level[-32:] #repeat last element to make even-length
+			self.levels.append(level)
+			level = SHA256Chunks(level, 64, double=True)
+		self.levels.append(level)
+
+
+	def getRoot(self):
+		"""
+		Return value:
+		str; the root of the tree
+		"""
+
+		return self.levels[-1]
+
+
+	def getBranch(self, index):
+		"""
+		Arguments:
+		index: int; the index of a leaf
+
+		Return value:
+		list of tuple (str, str); the (left, right) pairs of nodes on the path
+		from the leaf to the root, starting at the leaf.
+
+		Exceptions:
+		IndexError: index is outside the range 0..numLeaves-1
+		"""
+
+		return self.getBranches([index])[0]
+
+
+	def getBranches(self, indices):
+		"""
+		Arguments:
+		indices: list of int; the indices of leaves
+
+		Return value:
+		list of branches, in the same order as indices; see getBranch.
+
+		Exceptions:
+		IndexError: an index is outside the range 0..numLeaves-1
+
+		All branches are calculated in one pass over the tree.
+		"""
+
+		for index in indices:
+			if not (0 <= index < self.numLeaves):
+				raise IndexError(
+					"Leaf index %d is out of range (%d leaves)" % \
+					(index, self.numLeaves))
+
+		branches = [[] for i in indices]
+		indices = list(indices)
+		for level in self.levels[:-1]:
+			for i, index in enumerate(indices):
+				pos = 64 * (index / 2)
+				branches[i].append((level[pos:pos+32], level[pos+32:pos+64]))
+				indices[i] = index / 2
+
+		return branches
+
+
+
+def getMerkleRoot(leaves):
+	"""
+	Arguments:
+	leaves: list of str; the leaves (32-byte hashes). Must not be empty.
+
+	Return value:
+	str; the root of the Merkle tree of the leaves
+	"""
+
+	return MerkleTree(leaves).getRoot()
+
+
+def verifyBranch(leaf, branch, root):
+	"""
+	Verifies that a leaf is part of a Merkle tree, without the other leaves
+	of the tree.
+
+	Arguments:
+	leaf: str; the leaf (32-byte hash)
+	branch: list of tuple (str, str); the branch of the leaf, as returned by
+	        MerkleTree.getBranch
+	root: str; the root of the tree
+
+	Return value:
+	bool; indicates whether the branch connects the leaf to the root
+	"""
+
+	if len(branch) == 0:
+		return leaf == root
+
+	sums = SHA256Many([left + right for left, right in branch], double=True)
+
+	if leaf not in branch[0]:
+		return False
+	for i in range(len(branch)-1):
+		if sums[i] not in branch[i+1]:
+			return False
+	return sums[-1] == root
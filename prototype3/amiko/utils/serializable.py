@@ -27,7 +27,10 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import copy
+import itertools
 import json
+import re
+import struct
 
 
 
@@ -42,123 +45,1077 @@ def registerClass(c):
 	registeredClasses[c.__name__] = c
 
 
-def applyRecursively(selectFunction, transformFunction, obj):
-	#For these iterables, process the items recursively:
-	if type(obj) == dict:
-		obj = \
-		{
-		applyRecursively(selectFunction, transformFunction, k):
-			applyRecursively(selectFunction, transformFunction, v)
-		for k,v in obj.iteritems()
-		}
-	if type(obj) == list:
-		obj = \
-		[
-		applyRecursively(selectFunction, transformFunction, x)
-		for x in obj
-		]
-
-	#Apply the transformation for selected objects:
-	if selectFunction(obj):
-		return transformFunction(obj)
-
-	return obj
-
-
-def state2Object(s):
-	def transformFunction(attribs):
-		c = registeredClasses[attribs["_class"]]
-		return c(**attribs)
-
-	return applyRecursively(
-		lambda obj: type(obj) == dict and "_class" in obj.keys(),
-		transformFunction,
-		s)
-
-
-def object2State(s):
-	def transformFunction(obj):
-		className = obj.__class__.__name__
-		c = registeredClasses[className]
-		attributes = c.serializableAttributes
-		obj = \
-		{
-			name: object2State(getattr(obj, name))
-			for name in attributes.keys()
-		}
-		obj["_class"] = className
+#Per-class plans for converting objects to states, indexed by class.
+#Each plan is a tuple (class name, list of serialized attribute names).
+classPlans = {}
+
+def getClassPlan(c):
+	"""
+	c: class
+	"""
+	try:
+		return classPlans[c]
+	except KeyError:
+		className = c.__name__
+		attributes = registeredClasses[className].serializableAttributes
+		plan = className, attributes.keys()
+		classPlans[c] = plan
+		return plan
+
+
+#Types that are the same in objects and states:
+scalarTypes = set([int, long, float, bool, type(None), unicode])
+
+
+def makeObjectEncoder(encodeString):
+	"""
+	Makes a function that converts objects to states in a single pass.
+	Containers are always copied, so the state does not share any data with
+	the objects.
+
+	Arguments:
+	encodeString: function that is applied to every str, or None
+
+	Return value:
+	function
+	"""
+
+	def encode(obj):
+		t = type(obj)
+		if t is str:
+			return obj if encodeString is None else encodeString(obj)
+		if t in scalarTypes:
+			return obj
+		if isinstance(obj, dict):
+			return {encode(k): encode(v) for k, v in obj.iteritems()}
+		if isinstance(obj, list):
+			return [encode(x) for x in obj]
+		if isinstance(obj, Serializable):
+			className, attributeNames = getClassPlan(obj.__class__)
+			attributes = obj.__dict__
+			ret = {name: encode(attributes[name]) for name in attributeNames}
+			ret['_class'] = className
+			return ret
 		return obj
 
-	return applyRecursively(
-		lambda obj: isinstance(obj, Serializable),
-		transformFunction,
-		s)
+	return encode
 
 
-def encodeStrings(s):
-	def transformFunction(obj):
-		nonReadableChars = [c for c in obj if ord(c) < 32 or ord(c) >= 128]
-		isHumanReadable = len(nonReadableChars) == 0
-		if isHumanReadable:
-			if len(obj) > 0 and obj[0] == '!':
-				obj = '!' + obj
-		else:
-			obj = '!x' + obj.encode('hex')
+def makeStateDecoder(stringTypes, decodeString, makeObjects):
+	"""
+	Makes a function that transforms a state in a single pass.
+	Containers are only copied if something inside them changes; unchanged
+	containers are shared with the input state. Objects take ownership of
+	their attribute values, so they may share containers with the input
+	state as well.
+
+	Arguments:
+	stringTypes: tuple of types to which decodeString is applied
+	decodeString: function
+	makeObjects: bool; if True, dicts with a '_class' item are converted to
+	             objects.
+
+	Return value:
+	function
+	"""
+
+	def decode(obj):
+		t = type(obj)
+		if t in stringTypes:
+			return decodeString(obj)
+		if t is dict:
+			ret = None
+			for i, (k, v) in enumerate(obj.iteritems()):
+				newK = decode(k)
+				newV = decode(v)
+				if ret is None:
+					if newK is k and newV is v:
+						continue
+					#Copy the unchanged items that come before this one:
+					ret = dict(itertools.islice(obj.iteritems(), i))
+				ret[newK] = newV
+			if ret is None:
+				ret = obj
+			if makeObjects and '_class' in ret:
+				c = registeredClasses[ret['_class']]
+				return c(**ret)
+			return ret
+		if t is list:
+			ret = None
+			for i, x in enumerate(obj):
+				newX = decode(x)
+				if ret is None:
+					if newX is x:
+						continue
+					ret = obj[:i]
+				ret.append(newX)
+			return obj if ret is None else ret
 		return obj
 
-	return applyRecursively(
-		lambda obj: type(obj) == str,
-		transformFunction,
-		s)
+	return decode
+
+
+#Characters that make a string non-human-readable:
+nonReadableCharacters = re.compile('[^\x20-\x7f]')
+
+
+def encodeString(s):
+	if nonReadableCharacters.search(s) is None:
+		if s.startswith('!'):
+			return '!' + s
+		return s
+	return '!x' + s.encode('hex')
+
+
+def decodeString(s):
+	s = str(s)
+	if len(s) >= 2 and s[0] == '!':
+		if s[1] == 'x':
+			return s[2:].decode('hex')
+		elif s[1] == '!':
+			return s[1:]
+		else:
+			raise Exception('Formatting error')
+	return s
+
+
+object2State = makeObjectEncoder(None)
+state2Object = makeStateDecoder((), None, True)
+encodeStrings = makeStateDecoder((str,), encodeString, False)
+decodeStrings = makeStateDecoder((str, unicode), decodeString, False)
 
+#Single-pass conversions between objects and JSON data:
+encodeJSON = makeObjectEncoder(encodeString)
+decodeJSON = makeStateDecoder((str, unicode), decodeString, True)
 
-def decodeStrings(s):
-	def transformFunction(obj):
-		obj = str(obj)
-		if len(obj) >= 2 and obj[0] == '!':
-			if obj[1] == 'x':
-				return obj[2:].decode('hex')
-			elif obj[1] == '!':
-				return obj[1:]
+
+def getStateDelta(old, new):
+	"""
+	Determines the changes that transform one state into another.
+
+	Arguments:
+	old: the old state (as returned by object2State)
+	new: the new state (as returned by object2State)
+
+	Return value:
+	list; the changes, in a form that can be passed to serializeState and
+	applyStateDelta. Each element is a list, in one of the following forms:
+	['s', path, value]: set the item at path to value
+	['d', path]: delete the dictionary item at path
+	['t', path, length]: truncate the list at path to the given length
+	['r', path, start, end, values]: replace the items start..end-1 of the
+	                                 list at path by the list values
+	                                 (only made by ChangeTracker.getStateDelta)
+	path is a list of dictionary keys and list indices, starting at the
+	top-level state.
+	"""
+
+	ret = []
+
+	def isEqual(a, b):
+		#Note: the type check prevents that e.g. a change from 1 to True is
+		#missed.
+		return a is b or (type(a) == type(b) and a == b)
+
+	def compare(path, a, b):
+		if type(a) == dict and type(b) == dict:
+			for k, v in b.iteritems():
+				if k not in a:
+					ret.append(['s', path + [k], v])
+				elif not isEqual(a[k], v):
+					compare(path + [k], a[k], v)
+			for k in a.iterkeys():
+				if k not in b:
+					ret.append(['d', path + [k]])
+			return
+
+		if type(a) == list and type(b) == list:
+			common = min(len(a), len(b))
+			changed = [i for i in range(common) if not isEqual(a[i], b[i])]
+			#Only describe item changes if a significant part of the list is
+			#unchanged:
+			if 2*len(changed) <= common:
+				for i in changed:
+					compare(path + [i], a[i], b[i])
+				for i in range(common, len(b)):
+					ret.append(['s', path + [i], b[i]])
+				if len(a) > len(b):
+					ret.append(['t', path, len(b)])
+				return
+
+		if not isEqual(a, b):
+			ret.append(['s', path, b])
+
+	compare([], old, new)
+	return ret
+
+
+def applyStateDelta(state, delta):
+	"""
+	Applies changes, as returned by getStateDelta, to a state.
+
+	Arguments:
+	state: the state (as returned by object2State); it is modified in-place.
+	delta: list; the changes
+
+	Return value:
+	the modified state. This is a different object than the state argument,
+	in case the top-level state is replaced as a whole.
+	"""
+
+	for change in delta:
+		operation, path = change[0], change[1]
+
+		if operation in ('t', 'r'):
+			target = state
+			for key in path:
+				target = target[key]
+			if operation == 't':
+				del target[change[2]:]
 			else:
-				raise Exception('Formatting error')
-		return obj
+				target[change[2]:change[3]] = change[4]
+			continue
+
+		if len(path) == 0:
+			if operation != 's':
+				raise Exception('Invalid state change: %s' % repr(change))
+			state = change[2]
+			continue
+
+		parent = state
+		for key in path[:-1]:
+			parent = parent[key]
+		key = path[-1]
+
+		if operation == 's':
+			if type(parent) == list and key == len(parent):
+				parent.append(change[2])
+			else:
+				parent[key] = change[2]
+		elif operation == 'd':
+			del parent[key]
+		else:
+			raise Exception('Invalid state change: %s' % repr(change))
+
+	return state
+
 
-	return applyRecursively(
-		lambda obj: type(obj) in (unicode, str),
-		transformFunction,
-		s)
+#Serialized data formats:
+#json:   human-readable; binary strings are hex-encoded (see encodeStrings)
+#binary: compact tagged format (see encodeBinary)
+dataFormats = ['json', 'binary']
+
+
+#Start of data in the binary format. This can never be the start of JSON data.
+binaryMagic = '\x00\x01'
+
+
+def encodeBinary(s):
+	"""
+	Encodes a state in the binary format.
+
+	The binary format consists of binaryMagic, followed by the encoded state.
+	Each encoded value starts with a one-byte tag:
+	N, T, F:  None, True, False
+	i:        int/long; followed by a zigzag-encoded varint
+	f:        float; followed by an 8-byte big endian double
+	s:        str; followed by a varint length and the data
+	u:        unicode; followed by a varint length and the UTF-8 data
+	l:        list; followed by a varint count and the items
+	m:        dict; followed by a varint count and the key, value pairs
+	o:        serialized object (dict with a '_class' item); followed by the
+	          class name and a varint count of the attributes, and then, for
+	          each attribute, its name and its value. The class name and the
+	          attribute names are encoded as a varint length and the data.
+
+	Arguments:
+	s: the state (as returned by object2State)
+
+	Return value:
+	str; the encoded state
+	"""
+
+	ret = [binaryMagic]
+	write = ret.append
+
+	def writeVarInt(n):
+		while n >= 0x80:
+			write(chr(0x80 | (n & 0x7f)))
+			n >>= 7
+		write(chr(n))
+
+	def writeString(obj):
+		writeVarInt(len(obj))
+		write(obj)
+
+	def encode(obj):
+		t = type(obj)
+		if t == str:
+			write('s')
+			writeString(obj)
+		elif t == bool:
+			write('T' if obj else 'F')
+		elif t in (int, long):
+			write('i')
+			writeVarInt(2*obj if obj >= 0 else -2*obj-1)
+		elif obj is None:
+			write('N')
+		elif isinstance(obj, dict):
+			if '_class' in obj:
+				write('o')
+				writeString(obj['_class'])
+				writeVarInt(len(obj) - 1)
+				for k, v in obj.iteritems():
+					if k != '_class':
+						writeString(k)
+						encode(v)
+			else:
+				write('m')
+				writeVarInt(len(obj))
+				for k, v in obj.iteritems():
+					encode(k)
+					encode(v)
+		elif isinstance(obj, list):
+			write('l')
+			writeVarInt(len(obj))
+			for x in obj:
+				encode(x)
+		elif t == float:
+			write('f')
+			write(struct.pack('>d', obj))
+		elif t == unicode:
+			write('u')
+			writeString(obj.encode('utf-8'))
+		else:
+			raise Exception('Binary encoding of type %s is not supported' % str(t))
+
+	encode(s)
+	return ''.join(ret)
+
+
+def decodeBinary(data):
+	"""
+	Decodes a state in the binary format (see encodeBinary).
+
+	Arguments:
+	data: str; the encoded state
+
+	Return value:
+	the state (as accepted by state2Object)
+
+	Exceptions:
+	Exception: the data is not correctly encoded
+	"""
+
+	if not data.startswith(binaryMagic):
+		raise Exception('Data is not in the binary format')
+
+	#Use a list, so that the nested functions can update the position:
+	position = [len(binaryMagic)]
+
+	def readVarInt():
+		ret = 0
+		shift = 0
+		pos = position[0]
+		while True:
+			b = ord(data[pos])
+			pos += 1
+			ret |= (b & 0x7f) << shift
+			shift += 7
+			if b < 0x80:
+				break
+		position[0] = pos
+		return ret
+
+	def readString():
+		length = readVarInt()
+		start = position[0]
+		end = start + length
+		if end > len(data):
+			raise Exception('Binary data is truncated')
+		position[0] = end
+		return data[start:end]
+
+	def decode():
+		tag = data[position[0]]
+		position[0] += 1
+
+		if tag == 's':
+			return readString()
+		elif tag == 'i':
+			n = readVarInt()
+			return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+		elif tag == 'N':
+			return None
+		elif tag == 'T':
+			return True
+		elif tag == 'F':
+			return False
+		elif tag == 'o':
+			ret = {'_class': readString()}
+			for i in range(readVarInt()):
+				k = readString()
+				ret[k] = decode()
+			return ret
+		elif tag == 'm':
+			ret = {}
+			for i in range(readVarInt()):
+				k = decode()
+				ret[k] = decode()
+			return ret
+		elif tag == 'l':
+			return [decode() for i in range(readVarInt())]
+		elif tag == 'f':
+			start = position[0]
+			position[0] = start + 8
+			return struct.unpack('>d', data[start:start+8])[0]
+		elif tag == 'u':
+			return readString().decode('utf-8')
+
+		raise Exception('Invalid tag in binary data: %s' % repr(tag))
+
+	try:
+		ret = decode()
+	except (IndexError, struct.error):
+		raise Exception('Binary data is truncated')
+
+	if position[0] != len(data):
+		raise Exception('Trailing data after binary encoded state')
+
+	return ret
 
 
 def deserializeState(s):
+	"""
+	De-serializes a state. The data format is detected automatically.
+	"""
+	if s.startswith(binaryMagic):
+		return decodeBinary(s)
 	return decodeStrings(json.loads(s))
 
 
 def deserialize(s):
-	return state2Object(deserializeState(s))
+	if s.startswith(binaryMagic):
+		return state2Object(decodeBinary(s))
+	return decodeJSON(json.loads(s))
 
 
-def serializeState(s):
+def serializeState(s, dataFormat='json'):
+	"""
+	Serializes a state.
+
+	Arguments:
+	s: the state (as returned by object2State)
+	dataFormat: str; one of dataFormats
+
+	Return value:
+	str; the serialized state
+	"""
+	if dataFormat == 'binary':
+		return encodeBinary(s)
+	if dataFormat != 'json':
+		raise Exception('Unsupported data format: %s' % repr(dataFormat))
 	return json.dumps(encodeStrings(s))
 
 
-def serialize(obj):
-	return serializeState(object2State(obj))
+def serialize(obj, dataFormat='json'):
+	if dataFormat == 'json':
+		return json.dumps(encodeJSON(obj))
+	return serializeState(object2State(obj), dataFormat)
+
+
+
+def initAttributes(obj, attributes, kwargs):
+	"""
+	Sets the attributes of a newly constructed object.
+
+	The object takes ownership of the values in kwargs: they are not copied,
+	so the caller should not keep using them. Attributes that are missing in
+	kwargs get their default value; mutable default values are copied.
+
+	Arguments:
+	obj: the object
+	attributes: dict; name -> default value
+	kwargs: dict; name -> value
+	"""
+	for name, default in attributes.iteritems():
+		if name in kwargs:
+			value = kwargs[name]
+		elif type(default) in (dict, list) or isinstance(default, Serializable):
+			value = copy.deepcopy(default)
+		else:
+			value = default
+		setattr(obj, name, value)
 
 
 
 class Serializable:
 	def __init__(self, **kwargs):
 		c = registeredClasses[self.__class__.__name__]
-		attributes = c.serializableAttributes
-		for name in attributes.keys():
-			setattr(self, name, copy.deepcopy(
-					kwargs[name]
-				if name in kwargs else
-					attributes[name] #default value
-				))
+		initAttributes(self, c.serializableAttributes, kwargs)
+
+
+	def __setattr__(self, name, value):
+		tracker = self.__dict__.get('_changeTracker')
+		if tracker is not None:
+			value = tracker.beforeAttributeChange(self, name, value)
+		self.__dict__[name] = value
+
+
+	def __getstate__(self):
+		#Copies of this object are not tracked:
+		state = self.__dict__.copy()
+		state.pop('_changeTracker', None)
+		state.pop('_parent', None)
+		return state
 
 
 	def getState(self):
 		return object2State(self)
 
+
+
+class ChangeTracker:
+	'''
+	Keeps track of changes made to a tree of Serializable objects, so that
+	the tree can be restored to the way it was at the start of a transaction.
+
+	Changes are recorded in a journal at the moment they are made. For each
+	object attribute and dictionary item, only the first change in a
+	transaction is recorded, together with the old value. For lists, every
+	operation is recorded, together with the items it replaced, so that e.g.
+	an append to a large list doesn't require a copy of the list. This way,
+	the cost of a transaction scales with the amount of changed data, instead
+	of with the size of the complete tree.
+
+	The journal also contains the changes made outside transactions, until
+	clearChanges is called. getStateDelta uses it to convert only the changed
+	parts of the tree to a state. For this, every tracked object and container
+	has a link to the place in the tree where it is stored.
+
+	To make this work, the dicts and lists in the tree are replaced by the
+	TrackedDict and TrackedList classes, which inform the tracker before
+	every change. Objects that are added to the tree are adopted in the same
+	way. Note that plain dicts and lists are copied when they are added to the
+	tree (see track), so changes to the original container are not tracked.
+	'''
+
+	def __init__(self):
+		#The changes since the last call to clearChanges. Each element is:
+		#(node, key, oldValue): the first change of an attribute or a
+		#                       dictionary item (see beforeItemChange)
+		#(container, start, oldItems, newItems): see beforeListChange
+		#(node, oldLink): a change of the link of a node, in a transaction
+		self.__journal = []
+		#Position in the journal where the current transaction starts, or
+		#None if no transaction is in progress:
+		self.__transactionStart = None
+		#(id(node), key) of the attributes and dictionary items whose first
+		#change is in the journal:
+		self.__changed = set()
+
+
+	def track(self, obj, parent=None, key=None):
+		'''
+		Makes sure that changes to the given object, and everything it
+		contains, are tracked by this tracker.
+
+		Arguments:
+		obj: (any)
+		parent: Serializable, TrackedDict, TrackedList or None;
+			the object or container in which obj is stored, or None if obj is
+			the root of the tree.
+		key: the attribute name or dictionary key under which obj is stored in
+			parent (None if parent is a list).
+
+		Return value:
+		(any); the object that must be stored instead of obj. Plain dicts and
+		lists are replaced by tracked copies; other objects are returned as-is.
+		Since a copy is made, a caller that keeps a reference to a plain
+		container that is stored in the tree must re-read it from the tree
+		before changing it:
+
+		x = []
+		obj.a = x   #obj.a is now a tracked copy of x
+		x.append(1) #not tracked, and not visible in obj.a
+		'''
+
+		if isinstance(obj, Serializable):
+			if obj.__dict__.get('_changeTracker') is not self:
+				obj.__dict__['_changeTracker'] = self
+				obj.__dict__['_parent'] = None
+				self.__link(obj, parent, key)
+				for name, value in obj.__dict__.items():
+					if name not in ('_changeTracker', '_parent'):
+						obj.__dict__[name] = self.track(value, obj, name)
+			else:
+				self.__link(obj, parent, key)
+			return obj
+
+		if isinstance(obj, (TrackedDict, TrackedList)) and obj.tracker is self:
+			self.__link(obj, parent, key)
+			return obj
+
+		if isinstance(obj, dict):
+			ret = TrackedDict()
+			ret.tracker = self
+			ret.parent = None
+			self.__link(ret, parent, key)
+			for k, v in obj.iteritems():
+				dict.__setitem__(ret, k, self.track(v, ret, k))
+			return ret
+
+		if isinstance(obj, list):
+			ret = TrackedList()
+			ret.tracker = self
+			ret.parent = None
+			self.__link(ret, parent, key)
+			list.extend(ret, [self.track(x, ret) for x in obj])
+			return ret
+
+		return obj
+
+
+	def __link(self, node, parent, key):
+		'''
+		Sets the link of a node to the place where it is stored.
+
+		An object can be stored in several places, e.g. in a serialized
+		attribute and in a non-serialized index. The link to the serialized
+		place is kept in that case, since that is where changes of the object
+		must be saved.
+		'''
+
+		if parent is None:
+			return
+
+		oldLink = _getLink(node)
+		persisted = _isPersistedLocation(parent, key)
+		if oldLink is not None:
+			if oldLink[0] is parent and oldLink[1] == key:
+				return
+			if oldLink[2] and not persisted:
+				return
+			if self.__transactionStart is not None:
+				self.__journal.append((node, oldLink))
+
+		_setLink(node, (parent, key, persisted))
+
+
+	def isInTransaction(self):
+		return self.__transactionStart is not None
+
+
+	def begin(self):
+		if self.isInTransaction():
+			raise Exception('A transaction is already in progress')
+		self.__transactionStart = len(self.__journal)
+		self.__changed = set()
+
+
+	def commit(self):
+		self.__transactionStart = None
+
+
+	def rollback(self):
+		'''
+		Undoes all changes made since the start of the transaction, and ends
+		the transaction.
+		'''
+
+		for entry in reversed(self.__journal[self.__transactionStart:]):
+			if len(entry) == 2:
+				node, oldLink = entry
+				_setLink(node, oldLink)
+			elif len(entry) == 3:
+				node, key, oldValue = entry
+				items = _getItems(node)
+				if oldValue is _noValue:
+					#The item may have been deleted again after it was added:
+					dict.pop(items, key, None)
+				else:
+					dict.__setitem__(items, key, oldValue)
+			else:
+				container, start, oldItems, newItems = entry
+				end = len(container) if newItems is None else start + len(newItems)
+				list.__setslice__(container, start, end, oldItems)
+
+		del self.__journal[self.__transactionStart:]
+		self.__transactionStart = None
+		self.__changed = set()
+
+
+	def clearChanges(self):
+		'''
+		Forgets the changes made since the previous call, e.g. after they have
+		been saved. This can not be done during a transaction.
+		'''
+
+		if self.isInTransaction():
+			raise Exception('A transaction is in progress')
+		self.__journal = []
+		self.__changed = set()
+
+
+	def getStateDelta(self, root):
+		'''
+		Determines the changes made to the tree since the previous call to
+		clearChanges. Only the changed parts of the tree are converted to a
+		state. Changes of non-serialized attributes, and of objects that are
+		no longer stored in the tree, are ignored.
+
+		Arguments:
+		root: Serializable; the root of the tree
+
+		Return value:
+		list; the changes, in the format of the getStateDelta function.
+		'''
+
+		#The first change of each attribute and dictionary item:
+		itemChanges = {}
+		listChanges = []
+		#Objects whose state is included in the list changes:
+		insertedItems = set()
+		replacedLists = set()
+		for entry in self.__journal:
+			if len(entry) == 3:
+				node, key, oldValue = entry
+				itemChanges.setdefault((id(node), key), entry)
+			elif len(entry) == 4:
+				container, start, oldItems, newItems = entry
+				if newItems is None:
+					replacedLists.add(id(container))
+				else:
+					insertedItems.update(id(x) for x in newItems)
+				listChanges.append(entry)
+
+		#id(node) -> path of node, or None if changes of node are not saved
+		#separately:
+		paths = {id(root): []}
+
+		def getPath(node):
+			try:
+				return paths[id(node)]
+			except KeyError:
+				pass
+
+			path = None
+			link = _getLink(node)
+			if link is not None:
+				parent, key, persisted = link
+				if isinstance(parent, TrackedList):
+					if id(parent) in replacedLists or id(node) in insertedItems:
+						#The new state of node is in a list change
+						key = _noValue
+					else:
+						key = _findItem(parent, node)
+				elif (id(parent), key) in itemChanges:
+					#The new state of node is in an item change
+					key = _noValue
+				elif not _isSerializedItem(parent, key) or \
+					_getItems(parent).get(key) is not node:
+						key = _noValue
+
+				if key is not _noValue:
+					parentPath = getPath(parent)
+					if parentPath is not None:
+						path = parentPath + [key]
+
+			paths[id(node)] = path
+			return path
+
+		ret = []
+		savedLists = set()
+		for container, start, oldItems, newItems in listChanges:
+			path = getPath(container)
+			if path is None:
+				continue
+			if id(container) in replacedLists:
+				if id(container) not in savedLists:
+					savedLists.add(id(container))
+					ret.append(['s', path, object2State(container)])
+			elif len(oldItems) > 0 or len(newItems) > 0:
+				ret.append(['r', path, start, start + len(oldItems),
+					[object2State(x) for x in newItems]])
+
+		#A list change changes the paths of the items after it, so changes
+		#of lists come first, ordered from the top of the tree downwards:
+		ret.sort(key=lambda change: len(change[1]))
+
+		for node, key, oldValue in itemChanges.itervalues():
+			path = getPath(node)
+			if path is None or not _isSerializedItem(node, key):
+				continue
+			value = _getItems(node).get(key, _noValue)
+			if value is not _noValue:
+				ret.append(['s', path + [key], object2State(value)])
+			elif oldValue is not _noValue:
+				ret.append(['d', path + [key]])
+
+		return ret
+
+
+	def beforeAttributeChange(self, obj, name, value):
+		'''
+		Records the old value of an attribute, if necessary.
+
+		Return value:
+		(any); the new value, adopted by this tracker.
+		'''
+
+		self.beforeItemChange(obj, name)
+		return self.track(value, obj, name)
+
+
+	def beforeItemChange(self, node, key):
+		'''
+		Records the old value of an attribute (if node is a Serializable) or
+		a dictionary item (if node is a TrackedDict), if necessary.
+		'''
+
+		changedKey = (id(node), key)
+		if changedKey not in self.__changed:
+			self.__changed.add(changedKey)
+			self.__journal.append((node, key, _getItems(node).get(key, _noValue)))
+
+
+	def beforeListChange(self, container, start, oldItems, newItems):
+		'''
+		Records a list operation that replaces the items
+		container[start:start+len(oldItems)] by newItems.
+
+		Arguments:
+		container: TrackedList
+		start: int; the (non-negative) index of the first replaced item
+		oldItems: list; the replaced items
+		newItems: list or None; the new items, or None if the operation
+		          replaces the entire list (in which case start must be 0
+		          and oldItems must be the entire old list).
+		'''
+
+		self.__journal.append((container, start, oldItems, newItems))
+
+
+#Marks the absence of an attribute or dictionary item in the journal of
+#ChangeTracker:
+_noValue = object()
+
+
+def _getItems(node):
+	#The dictionary that contains the attributes or items of a node:
+	return node.__dict__ if isinstance(node, Serializable) else node
+
+
+def _getLink(node):
+	#tuple (parent, key, persisted) or None; see ChangeTracker.track
+	if isinstance(node, Serializable):
+		return node.__dict__.get('_parent')
+	return node.parent
+
+
+def _setLink(node, link):
+	if isinstance(node, Serializable):
+		node.__dict__['_parent'] = link
+	else:
+		node.parent = link
+
+
+def _isSerializedItem(node, key):
+	return not isinstance(node, Serializable) or \
+		key in node.serializableAttributes
+
+
+def _isPersistedLocation(parent, key):
+	#Whether an item stored in parent under key is part of the serialized
+	#tree, as far as known when it is stored:
+	link = _getLink(parent)
+	if link is not None and not link[2]:
+		return False
+	return _isSerializedItem(parent, key)
+
+
+def _findItem(container, item):
+	#Index of item in container, compared by identity, or _noValue:
+	try:
+		index = list.index(container, item)
+	except ValueError:
+		return _noValue
+	if container[index] is item:
+		return index
+	for index, x in enumerate(container):
+		if x is item:
+			return index
+	return _noValue
+
+
+
+class TrackedDict(dict):
+	'''
+	Dictionary that informs a ChangeTracker before every change.
+	Only the changed items are journaled, so changing a large dictionary is
+	cheap. Copies of tracked dictionaries are plain dictionaries.
+	'''
+
+	__slots__ = ['tracker', 'parent']
+
+	def __copy__(self):
+		return dict(self)
+
+	def __deepcopy__(self, memo):
+		return copy.deepcopy(dict(self), memo)
+
+	def __setitem__(self, key, value):
+		self.tracker.beforeItemChange(self, key)
+		dict.__setitem__(self, key, self.tracker.track(value, self, key))
+
+	def __delitem__(self, key):
+		self.tracker.beforeItemChange(self, key)
+		dict.__delitem__(self, key)
+
+	def clear(self):
+		for key in self.keys():
+			self.tracker.beforeItemChange(self, key)
+		dict.clear(self)
+
+	def pop(self, key, *args):
+		if key in self:
+			self.tracker.beforeItemChange(self, key)
+		return dict.pop(self, key, *args)
+
+	def popitem(self):
+		if len(self) == 0:
+			raise KeyError('popitem(): dictionary is empty')
+		key = next(self.iterkeys())
+		return key, self.pop(key)
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return dict.__getitem__(self, key)
+
+	def update(self, *args, **kwargs):
+		for k, v in dict(*args, **kwargs).iteritems():
+			self[k] = v
+
+
+
+class TrackedList(list):
+	'''
+	List that informs a ChangeTracker before every change.
+	Most operations only journal the items they add or remove; only
+	operations that re-order the list (sort, reverse) journal its complete
+	contents. Copies of tracked lists are plain lists.
+	'''
+
+	__slots__ = ['tracker', 'parent']
+
+	def __copy__(self):
+		return list(self)
+
+	def __deepcopy__(self, memo):
+		return copy.deepcopy(list(self), memo)
+
+	def __getIndex(self, index, message):
+		n = len(self)
+		if index < 0:
+			index += n
+		if not (0 <= index < n):
+			raise IndexError(message)
+		return index
+
+	def __getSliceIndices(self, i, j):
+		n = len(self)
+		i = max(0, min(i, n))
+		return i, max(i, min(j, n))
+
+	def __replaceAll(self):
+		self.tracker.beforeListChange(self, 0, list(self), None)
+
+	def __setitem__(self, index, value):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(len(self))
+			if step != 1:
+				self.__replaceAll()
+				list.__setitem__(self, index, [self.tracker.track(x, self) for x in value])
+				return
+			self.__setslice__(start, stop, value)
+			return
+
+		index = self.__getIndex(index, 'list assignment index out of range')
+		value = self.tracker.track(value, self)
+		self.tracker.beforeListChange(self, index, [self[index]], [value])
+		list.__setitem__(self, index, value)
+
+	def __setslice__(self, i, j, values):
+		i, j = self.__getSliceIndices(i, j)
+		values = [self.tracker.track(x, self) for x in values]
+		self.tracker.beforeListChange(self, i, self[i:j], values)
+		list.__setslice__(self, i, j, values)
+
+	def __delitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(len(self))
+			if step != 1:
+				self.__replaceAll()
+				list.__delitem__(self, index)
+				return
+			self.__delslice__(start, stop)
+			return
+
+		index = self.__getIndex(index, 'list assignment index out of range')
+		self.tracker.beforeListChange(self, index, [self[index]], [])
+		list.__delitem__(self, index)
+
+	def __delslice__(self, i, j):
+		i, j = self.__getSliceIndices(i, j)
+		self.tracker.beforeListChange(self, i, self[i:j], [])
+		list.__delslice__(self, i, j)
+
+	def __iadd__(self, values):
+		self.extend(values)
+		return self
+
+	def __imul__(self, n):
+		self.__replaceAll()
+		return list.__imul__(self, n)
+
+	def append(self, value):
+		value = self.tracker.track(value, self)
+		self.tracker.beforeListChange(self, len(self), [], [value])
+		list.append(self, value)
+
+	def extend(self, values):
+		values = [self.tracker.track(x, self) for x in values]
+		self.tracker.beforeListChange(self, len(self), [], values)
+		list.extend(self, values)
+
+	def insert(self, index, value):
+		n = len(self)
+		if index < 0:
+			index = max(0, index + n)
+		index = min(index, n)
+		value = self.tracker.track(value, self)
+		self.tracker.beforeListChange(self, index, [], [value])
+		list.insert(self, index, value)
+
+	def pop(self, index=-1):
+		if len(self) == 0:
+			raise IndexError('pop from empty list')
+		index = self.__getIndex(index, 'pop index out of range')
+		value = self[index]
+		self.tracker.beforeListChange(self, index, [value], [])
+		list.__delitem__(self, index)
+		return value
+
+	def remove(self, value):
+		index = self.index(value)
+		self.tracker.beforeListChange(self, index, [self[index]], [])
+		list.__delitem__(self, index)
+
+	def reverse(self):
+		self.__replaceAll()
+		list.reverse(self)
+
+	def sort(self, *args, **kwargs):
+		self.__replaceAll()
+		list.sort(self, *args, **kwargs)
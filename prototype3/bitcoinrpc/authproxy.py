@@ -7,6 +7,12 @@
 
   - HTTP connections persist for the life of the AuthServiceProxy object
     (if server supports HTTP/1.1)
+  - HTTP connections are kept in a thread-safe pool, shared by the proxy
+    and all callables derived from it; connections that were closed by the
+    server are replaced automatically
+  - idempotent calls are retried after connection errors
+  - configurable timeout per call
+  - batch calls, with results matched to calls by 'id'
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
   - sends Basic HTTP authentication headers
@@ -42,6 +48,8 @@ import base64
 import decimal
 import json
 import logging
+import socket
+import threading
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -51,29 +59,48 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+# Maximum number of idle connections that are kept open
+POOL_SIZE = 4
+
+# Number of times a call is repeated after a connection error
+RETRIES = 2
+
+# Methods that can safely be called again, e.g. when the connection was lost
+# before their response was received
+IDEMPOTENT_METHODS = frozenset([
+    'decoderawtransaction', 'decodescript', 'dumpprivkey', 'estimatefee',
+    'getbalance', 'getbestblockhash', 'getblock', 'getblockchaininfo',
+    'getblockcount', 'getblockhash', 'getblockheader', 'getconnectioncount',
+    'getdifficulty', 'getinfo', 'getmempoolinfo', 'getnetworkinfo',
+    'getrawmempool', 'getrawtransaction', 'gettransaction', 'gettxout',
+    'getwalletinfo', 'help', 'listtransactions', 'listunspent',
+    'validateaddress',
+    ])
+
 log = logging.getLogger("BitcoinRPC")
 
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
         super(JSONRPCException, self).__init__(rpc_error)
+        self.error = rpc_error
 
 def EncodeDecimal(o):
     if isinstance(o, decimal.Decimal):
         return round(o, 8)
     raise TypeError(repr(o) + " is not JSON serializable")
 
-class AuthServiceProxy(object):
-    __id_count = 0
+class ConnectionPool(object):
+    """Thread-safe pool of HTTP connections to a single JSON-RPC server.
+       Also holds the request data that is the same for every call.
+    """
 
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None):
-        self.__service_url = service_url
-        self.__service_name = service_name
-        self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
+    def __init__(self, service_url, size=POOL_SIZE, connection=None):
+        self.url = urlparse.urlparse(service_url)
+        if self.url.port is None:
+            self.port = 80
         else:
-            port = self.__url.port
-        (user, passwd) = (self.__url.username, self.__url.password)
+            self.port = self.url.port
+        (user, passwd) = (self.url.username, self.url.password)
         try:
             user = user.encode('utf8')
         except AttributeError:
@@ -83,18 +110,67 @@ class AuthServiceProxy(object):
         except AttributeError:
             pass
         authpair = user + b':' + passwd
-        self.__auth_header = b'Basic ' + base64.b64encode(authpair)
+        self.headers = {'Host': self.url.hostname,
+                        'User-Agent': USER_AGENT,
+                        'Authorization': b'Basic ' + base64.b64encode(authpair),
+                        'Content-type': 'application/json'}
 
+        self.size = size
+        self.__idle = []
+        self.__lock = threading.Lock()
         if connection:
-            # Callables re-use the connection of the original proxy
-            self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  None, None, False,
-                                                  timeout)
+            self.__idle.append(connection)
+
+    def get(self, timeout):
+        """Returns (connection, is_reused).
+           The connection must be given back with put(), or closed.
+        """
+        with self.__lock:
+            conn = self.__idle.pop() if self.__idle else None
+        reused = conn is not None
+        if not reused:
+            conn = self.__connect(timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, reused
+
+    def put(self, conn):
+        with self.__lock:
+            if len(self.__idle) < self.size:
+                self.__idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+    def __connect(self, timeout):
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.hostname, self.port,
+                                           None, None, False,
+                                           timeout)
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 False, timeout)
+            return httplib.HTTPConnection(self.url.hostname, self.port,
+                                          False, timeout)
+
+class AuthServiceProxy(object):
+    __id_count = 0
+    __id_lock = threading.Lock()
+
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT,
+                 connection=None, pool=None, pool_size=POOL_SIZE,
+                 retries=RETRIES):
+        self.__service_url = service_url
+        self.__service_name = service_name
+        self.__timeout = timeout
+        self.__retries = retries
+        if pool is None:
+            pool = ConnectionPool(service_url, pool_size, connection)
+        self.__pool = pool
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -102,64 +178,111 @@ class AuthServiceProxy(object):
             raise AttributeError
         if self.__service_name is not None:
             name = "%s.%s" % (self.__service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        # Callables share the connection pool of the original proxy
+        return AuthServiceProxy(self.__service_url, name, self.__timeout,
+                                pool=self.__pool, retries=self.__retries)
+
+    def timeout_(self, timeout):
+        """Returns a proxy that uses the given timeout (in seconds) for
+           its calls, e.g. proxy.timeout_(300).getblock(blockhash)
+        """
+        return AuthServiceProxy(self.__service_url, self.__service_name,
+                                timeout, pool=self.__pool,
+                                retries=self.__retries)
+
+    def close_(self):
+        """Closes the idle connections of the pool."""
+        self.__pool.close()
 
     def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
+        request_id = AuthServiceProxy.__next_id()
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self.__service_name,
+        log.debug("-%s-> %s %s"%(request_id, self.__service_name,
                                  json.dumps(args, default=EncodeDecimal)))
         postdata = json.dumps({'version': '1.1',
                                'method': self.__service_name,
                                'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal)
-        self.__conn.request('POST', self.__url.path, postdata,
-                            {'Host': self.__url.hostname,
-                             'User-Agent': USER_AGENT,
-                             'Authorization': self.__auth_header,
-                             'Content-type': 'application/json'})
-
-        response = self._get_response()
-        if response['error'] is not None:
-            raise JSONRPCException(response['error'])
-        elif 'result' not in response:
-            raise JSONRPCException({
-                'code': -343, 'message': 'missing JSON-RPC result'})
-        else:
-            return response['result']
+                               'id': request_id}, default=EncodeDecimal)
+        response = self._request(postdata,
+                                 self.__service_name in IDEMPOTENT_METHODS)
+        return self._get_result(response)
 
     def batch_(self, rpc_calls):
         """Batch RPC call.
            Pass array of arrays: [ [ "method", params... ], ... ]
-           Returns array of results.
+           Returns array of results, in the same order as the calls.
+           All calls are sent in a single HTTP request; rpc_calls is not
+           modified.
         """
         batch_data = []
         for rpc_call in rpc_calls:
-            AuthServiceProxy.__id_count += 1
-            m = rpc_call.pop(0)
-            batch_data.append({"jsonrpc":"2.0", "method":m, "params":rpc_call, "id":AuthServiceProxy.__id_count})
+            batch_data.append({"jsonrpc": "2.0", "method": rpc_call[0],
+                               "params": list(rpc_call[1:]),
+                               "id": AuthServiceProxy.__next_id()})
+        if len(batch_data) == 0:
+            return []
 
         postdata = json.dumps(batch_data, default=EncodeDecimal)
         log.debug("--> "+postdata)
-        self.__conn.request('POST', self.__url.path, postdata,
-                            {'Host': self.__url.hostname,
-                             'User-Agent': USER_AGENT,
-                             'Authorization': self.__auth_header,
-                             'Content-type': 'application/json'})
+        responses = self._request(postdata,
+            all(call["method"] in IDEMPOTENT_METHODS for call in batch_data))
+        if not isinstance(responses, list):
+            # The server rejected the batch as a whole
+            return [self._get_result(responses)]
+
+        # Responses may be in any order
+        responses = dict((response.get('id'), response)
+                         for response in responses)
         results = []
-        responses = self._get_response()
-        for response in responses:
-            if response['error'] is not None:
-                raise JSONRPCException(response['error'])
-            elif 'result' not in response:
+        for call in batch_data:
+            response = responses.get(call["id"])
+            if response is None:
                 raise JSONRPCException({
                     'code': -343, 'message': 'missing JSON-RPC result'})
-            else:
-                results.append(response['result'])
+            results.append(self._get_result(response))
         return results
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+    def _request(self, postdata, idempotent):
+        attempt = 0
+        while True:
+            conn, reused = self.__pool.get(self.__timeout)
+            sent = False
+            try:
+                conn.request('POST', self.__pool.url.path, postdata,
+                             self.__pool.headers)
+                sent = True
+                response = self._get_response(conn)
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                # The server may have closed a pooled connection while it was
+                # idle. If the request didn't reach the server, or if it can
+                # safely be repeated, try again on a new connection.
+                if attempt < self.__retries and \
+                    (idempotent or (reused and not sent)):
+                    attempt += 1
+                    log.debug("Connection error (%s); retrying" % repr(e))
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            self.__pool.put(conn)
+            return response
+
+    def _get_result(self, response):
+        if response.get('error') is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        else:
+            return response['result']
+
+    def _get_response(self, conn):
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -171,3 +294,9 @@ class AuthServiceProxy(object):
         else:
             log.debug("<-- "+responsedata)
         return response
+
+    @staticmethod
+    def __next_id():
+        with AuthServiceProxy.__id_lock:
+            AuthServiceProxy.__id_count += 1
+            return AuthServiceProxy.__id_count
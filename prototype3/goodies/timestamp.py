@@ -35,12 +35,15 @@ sys.path.append("..")
 
 from amiko.core import bitcoind as bd
 from amiko.core import settings
-from amiko.utils import bitcoinutils, crypto, base58, bitcointransaction
+from amiko.utils import bitcoinutils, crypto, base58, bitcointransaction, merkle
 
 
 
 bitcoind = None
 
+#Number of blocks retrieved in a single request to bitcoind
+blocksPerRequest = 10
+
 def connect():
 	global bitcoind
 
@@ -65,45 +68,56 @@ def help(args):
 	if "make" in args:
 		print "Usage: %s make to_be_timestamped_file output_certificate_file" % sys.argv[0]
 
+	if "makebatch" in args:
+		print "Usage: %s makebatch to_be_timestamped_file [to_be_timestamped_file...]" % sys.argv[0]
+		print "Timestamps all files with a single transaction."
+		print "For each file, the certificate is written to file.certificate"
+
 	if "verify" in args:
 		print "Usage: %s verify timestamped_file input_certificate_file" % sys.argv[0]
 
 
-def getMerkleBranch(transactions, index):
-	ret = []
-	while len(transactions) > 1:
-		if (len(transactions) % 2) != 0:
-			transactions.append(transactions[-1]) #repeat last element to make even-length
-
-		nextIndex = index/2
-		left = transactions[2*nextIndex]
-		right = transactions[2*nextIndex+1]
-
-		ret.append((left, right))
-
-		transactions = \
-		[
-			crypto.SHA256(crypto.SHA256(
-				transactions[2*i] + transactions[2*i+1]
-				))
-
-			for i in range(len(transactions)/2)
-		]
-		index = nextIndex
-
-	return ret, transactions[0]
-
-
-def make(args):
-	if len(args) != 2:
-		help(["make"])
-		sys.exit(1)
-
-	with open(args[0], "rb") as f:
-		data = f.read()
-
-	dataHash = crypto.SHA256(crypto.SHA256(data))
-	print "Data hash: ", dataHash.encode("hex")
+def findBlock(txID, txInfo):
+	"""
+	Returns information about the block that contains the transaction, as
+	returned by getBlocksByHeightRange.
+	txInfo is the transaction information, as returned by getTransaction.
+	"""
+
+	#Normally, bitcoind tells us in which block the transaction is
+	if "blockhash" in txInfo:
+		blockInfo = bitcoind.getBlockByHash(txInfo["blockhash"])
+		if txID in blockInfo["tx"]:
+			return blockInfo
+
+	#Fall-back: search the last 1000 blocks, newest first, a few blocks per
+	#request
+	endHeight = bitcoind.getBlockCount() + 1
+	startHeight = endHeight - 1000
+	while endHeight > startHeight:
+		blocks = bitcoind.getBlocksByHeightRange(
+			max(startHeight, endHeight - blocksPerRequest), endHeight)
+		for b in blocks[::-1]:
+			if txID in b["tx"]:
+				return b
+		endHeight -= blocksPerRequest
+
+	raise Exception(
+		"Something went wrong: transaction ID not found in the last 1000 blocks")
+
+
+def readDataHash(filename):
+	#The file is hashed in chunks, so that large files fit in memory
+	with open(filename, "rb") as f:
+		return crypto.SHA256(crypto.SHA256File(f))
+
+
+def publish(dataHash):
+	"""
+	Publishes dataHash in a Bitcoin transaction, and waits until it is
+	confirmed.
+	Returns (tx, blockInfo, merkleBranch, merkleRoot).
+	"""
 
 	fee =    10000 #0.1 mBTC = 0.0001 BTC
 	connect()
@@ -121,44 +135,62 @@ def make(args):
 	confirmations = -1
 	while confirmations < 3:
 		time.sleep(5)
+		txInfo = bitcoind.getTransaction(txID)
 		try:
-			newConfirmations = bitcoind.getTransaction(txID)["confirmations"]
+			newConfirmations = txInfo["confirmations"]
 		except KeyError:
 			newConfirmations = 0
 		if newConfirmations != confirmations:
 			print "  %d confirmations" % newConfirmations
 		confirmations = newConfirmations
 
-	height = bitcoind.getBlockCount()
-	for i in range(1000):
-		transactionsInBlock = bitcoind.getTransactionHashesByBlockHeight(height)
-		if txID in transactionsInBlock:
-			break
-		height -= 1
-	if txID not in transactionsInBlock:
-		raise Exception(
-			"Something went wrong: transaction ID not found in the last 1000 blocks")
+	blockInfo = findBlock(txID, txInfo)
 
-	print "Block height: ", height
+	transactionsInBlock = blockInfo["tx"]
+	print "Block height: ", blockInfo["height"]
 
 	index = transactionsInBlock.index(txID)
 	transactionsInBlock = [binascii.unhexlify(x)[::-1] for x in transactionsInBlock]
-	merkleBranch, merkleRoot = getMerkleBranch(transactionsInBlock, index)
+	merkleTree = merkle.MerkleTree(transactionsInBlock)
+	merkleBranch, merkleRoot = merkleTree.getBranch(index), merkleTree.getRoot()
 
-	blockInfo = bitcoind.getBlockInfoByBlockHeight(height)
 	if blockInfo["merkleroot"] != merkleRoot[::-1].encode("hex"):
 		raise Exception("Something went wrong: merkle root value mismatch")
 
+	return tx, blockInfo, merkleBranch, merkleRoot
+
+
+def writeBranch(f, name, branch):
+	for i in range(len(branch)):
+		left, right = branch[i]
+		f.write("%s_%d = %s, %s\n" % (name, i, left.encode("hex"), right.encode("hex")))
+	f.write("\n")
+
+
+def writeCertificate(filename, dataFilename, dataHash,
+	documentBranch, documentRoot,
+	tx, blockInfo, merkleBranch, merkleRoot):
+
 	dt = datetime.utcfromtimestamp(blockInfo["time"])
 	timeText = dt.strftime("%A %B %d %I:%M:%S %p %Y (UTC)")
 
-	with open(args[1], "wb") as f:
-		f.write("#Timestamp certificate for the file %s\n\n" % args[0])
+	with open(filename, "wb") as f:
+		f.write("#Timestamp certificate for the file %s\n\n" % dataFilename)
 
 		f.write("#Double-SHA256 of the file contents:\n")
 		f.write("dataHash = %s\n\n" % dataHash.encode("hex"))
 
-		f.write("#The timestamping transaction, containing the above hash:\n")
+		if len(documentBranch) > 0:
+			f.write("#The Merkle-branch of the file, in the tree of all files that were\n")
+			f.write("#timestamped together:\n")
+			writeBranch(f, "document", documentBranch)
+
+			f.write("#The Merkle root of the tree of files:\n")
+			f.write("documentRoot = %s\n\n" % documentRoot.encode("hex"))
+
+			f.write("#The timestamping transaction, containing the above root:\n")
+		else:
+			f.write("#The timestamping transaction, containing the above hash:\n")
 		f.write("transaction = %s\n\n" % tx.serialize().encode("hex"))
 
 		f.write("#The double-SHA256 of the timestamping transaction:\n")
@@ -166,17 +198,14 @@ def make(args):
 		f.write("transactionHash = %s\n\n" % tx.getTransactionID().encode("hex"))
 
 		f.write("#The Merkle-branch of the timestamping transaction:\n")
-		for i in range(len(merkleBranch)):
-			left, right = merkleBranch[i]
-			f.write("merkle_%d = %s, %s\n" % (i, left.encode("hex"), right.encode("hex")))
-		f.write("\n")
+		writeBranch(f, "merkle", merkleBranch)
 
 		f.write("#The Merkle root of the block:\n")
 		f.write("#(byte order is the reverse as typically shown in Bitcoin)\n")
 		f.write("merkleRoot = %s\n\n" % merkleRoot.encode("hex"))
 
 		f.write("#The block information:\n")
-		f.write("blockHeight = %d\n" % height)
+		f.write("blockHeight = %d\n" % blockInfo["height"])
 		f.write("blockHash = %s\n" % blockInfo["hash"])
 		f.write("blockTime = %d\n\n" % blockInfo["time"])
 
@@ -184,15 +213,49 @@ def make(args):
 		f.write("timestamp = %s\n" % timeText)
 
 
+def make(args):
+	if len(args) != 2:
+		help(["make"])
+		sys.exit(1)
+
+	dataHash = readDataHash(args[0])
+	print "Data hash: ", dataHash.encode("hex")
+
+	published = publish(dataHash)
+
+	writeCertificate(args[1], args[0], dataHash, [], dataHash, *published)
+
+
+def makebatch(args):
+	if len(args) == 0:
+		help(["makebatch"])
+		sys.exit(1)
+
+	dataHashes = [readDataHash(filename) for filename in args]
+
+	#All files are timestamped with a single transaction, which contains the
+	#Merkle root of the data hashes
+	documentTree = merkle.MerkleTree(dataHashes)
+	documentRoot = documentTree.getRoot()
+	print "Number of files: ", len(args)
+	print "Document root: ", documentRoot.encode("hex")
+
+	published = publish(documentRoot)
+
+	documentBranches = documentTree.getBranches(range(len(args)))
+	for i, filename in enumerate(args):
+		writeCertificate(filename + ".certificate", filename, dataHashes[i],
+			documentBranches[i], documentRoot, *published)
+
+	print "Certificates are written to <file>.certificate"
+
+
 def verify(args):
 	if len(args) != 2:
 		help(["verify"])
 		sys.exit(1)
 
-	with open(args[0], "rb") as f:
-		data = f.read()
-
-	dataHash = crypto.SHA256(crypto.SHA256(data))
+	dataHash = readDataHash(args[0])
 
 	with open(args[1], "rb") as f:
 		certificate = f.read()
@@ -221,46 +284,55 @@ def verify(args):
 			print "Certificate is INVALID."
 			sys.exit(3)
 
+	def readBranch(name):
+		branch = []
+		while True:
+			try:
+				value = certificateValues["%s_%d" % (name, len(branch))]
+			except KeyError:
+				break
+			left, right = value.split(",")
+			branch.append((
+				binascii.unhexlify(left.strip()),
+				binascii.unhexlify(right.strip())
+				))
+		return branch
+
 	test("data hash is the same",
 		certificateValues["dataHash"] == dataHash.encode("hex"))
 
+	#Certificates of files that were timestamped together with other files
+	#contain a branch of the tree of files
+	documentBranch = readBranch("document")
+	if len(documentBranch) > 0:
+		documentRoot = binascii.unhexlify(certificateValues["documentRoot"])
+		test("Document tree connects the data hash to the document root",
+			merkle.verifyBranch(dataHash, documentBranch, documentRoot))
+
+		publishedHash = documentRoot
+	else:
+		publishedHash = dataHash
+
 	tx = bitcointransaction.Transaction.deserialize(
 		binascii.unhexlify(certificateValues["transaction"]))
 
-	test("Transaction contains data hash",
-		tx.tx_out[0].scriptPubKey.elements[1] == dataHash)
+	test("Transaction contains data hash" if len(documentBranch) == 0 else
+		"Transaction contains document root",
+		tx.tx_out[0].scriptPubKey.elements[1] == publishedHash)
 
 	test("Transaction hash is the same",
 		certificateValues["transactionHash"] == tx.getTransactionID().encode("hex"))
 
-	merkleBranch = []
-	while True:
-		try:
-			value = certificateValues["merkle_%d" % len(merkleBranch)]
-		except KeyError:
-			break
-		left, right = value.split(",")
-		merkleBranch.append((
-			binascii.unhexlify(left.strip()),
-			binascii.unhexlify(right.strip())
-			))
-
-	test("Merkle tree starts with the transaction hash",
-		tx.getTransactionID() in merkleBranch[0])
-
-	merkleSums = [crypto.SHA256(crypto.SHA256(m[0] + m[1])) for m in merkleBranch]
-
-	for i in range(len(merkleBranch)-1):
-		test("Merkle tree consistency between levels %d and %d" % (i, i+1),
-			merkleSums[i] in merkleBranch[i+1])
+	merkleBranch = readBranch("merkle")
+	merkleRoot = binascii.unhexlify(certificateValues["merkleRoot"])
 
-	test("Merkle tree ends up in Merkle root",
-		merkleSums[-1].encode("hex") == certificateValues["merkleRoot"])
+	test("Merkle tree connects the transaction hash to the Merkle root",
+		merkle.verifyBranch(tx.getTransactionID(), merkleBranch, merkleRoot))
 
 	blockInfo = bitcoind.getBlockInfoByBlockHeight(int(certificateValues["blockHeight"]))
 
 	test("Merkle root is as reported by Bitcoin",
-		merkleSums[-1][::-1].encode("hex") == blockInfo["merkleroot"])
+		merkleRoot[::-1].encode("hex") == blockInfo["merkleroot"])
 
 	test("Block hash is as reported by Bitcoin",
 		certificateValues["blockHash"] == blockInfo["hash"])
@@ -281,6 +353,7 @@ funcs = \
 {
 "help": help,
 "make": make,
+"makebatch": makebatch,
 "verify": verify
 }
 funcNames = funcs.keys()
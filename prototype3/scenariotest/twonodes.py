@@ -265,7 +265,9 @@ class Test(unittest.TestCase):
 			'payeeLinks': {},
 			'payerLink': None,
 			'transactions': [],
-			'timeoutMessages': []
+			'timeoutMessages': [],
+			'bitcoinCommands': [],
+			'lastBitcoinCommandID': 0
 			})
 		self.assertEqual(state2,
 			{'_class': 'NodeState',
@@ -319,7 +321,9 @@ class Test(unittest.TestCase):
 			'payeeLinks': {},
 			'payerLink': None,
 			'transactions': [],
-			'timeoutMessages': []
+			'timeoutMessages': [],
+			'bitcoinCommands': [],
+			'lastBitcoinCommandID': 0
 			})
 
 
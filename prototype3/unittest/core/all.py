@@ -31,6 +31,8 @@ import unittest
 
 import testenvironment
 
+from test_bitcoind             import Test as test_bitcoind
+from test_bitcoind_simulator   import Test as test_bitcoind_simulator
 from test_log                  import Test as test_log
 from test_link                 import Test as test_link
 from test_linkbase             import Test as test_linkbase
@@ -41,6 +43,7 @@ from test_payeelink            import Test as test_payeelink
 from test_payerlink            import Test as test_payerlink
 from test_paylog               import Test as test_paylog
 from test_persistentconnection import Test as test_persistentconnection
+from test_persistentobject     import Test as test_persistentobject
 from test_settings             import Test as test_settings
 from test_transaction          import Test as test_transaction
 
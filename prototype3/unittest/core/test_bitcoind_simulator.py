@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#    test_bitcoind_simulator.py
+#    Copyright (C) 2016 by CJP
+#
+#    This file is part of Amiko Pay.
+#
+#    Amiko Pay is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Amiko Pay is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Amiko Pay. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Additional permission under GNU GPL version 3 section 7
+#
+#    If you modify this Program, or any covered work, by linking or combining it
+#    with the OpenSSL library (or a modified version of that library),
+#    containing parts covered by the terms of the OpenSSL License and the SSLeay
+#    License, the licensors of this Program grant you additional permission to
+#    convey the resulting work. Corresponding Source for a non-source form of
+#    such a combination shall include the source code for the parts of the
+#    OpenSSL library used as well as that of the covered work.
+
+
+import unittest
+import time
+
+import testenvironment
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+from amiko.core import bitcoind
+from amiko.core import bitcoind_simulator
+from amiko.core import messages
+from amiko.core import settings
+from amiko.channels import iouchannel #registers its bitcoin commands
+from amiko.utils import base58
+from amiko.utils import bitcoinutils
+from amiko.utils import crypto
+from amiko.utils import merkle
+from amiko.utils.bitcointransaction import Script
+
+
+
+class Test(unittest.TestCase):
+	def setUp(self):
+		self.chain = bitcoind_simulator.SimulatedChain()
+		self.sim1 = self.makeSimulator("node1")
+		self.sim2 = self.makeSimulator("node2")
+
+
+	def tearDown(self):
+		self.chain.stopBlockTimer()
+
+
+	def makeSimulator(self, name):
+		s = settings.Settings()
+		s.name = name
+		return bitcoind_simulator.Bitcoind_Simulator(s, self.chain)
+
+
+	def newHash(self, sim):
+		return base58.decodeBase58Check(sim.getNewAddress(), 0)
+
+
+	def send(self, sim, amount, toHash, fee=10000):
+		tx = bitcoinutils.sendToStandardPubKey(
+			sim, amount, toHash, self.newHash(sim), fee)
+		sim.sendRawTransaction(tx.serialize())
+		return tx.getTransactionID()[::-1].encode("hex")
+
+
+	def test_initialState(self):
+		"Test the state of a new simulated chain"
+
+		#Genesis block, and two blocks for each wallet:
+		self.assertEqual(self.sim1.getBlockCount(), 4)
+		self.assertTrue(self.sim1.isConnected())
+
+		unspent = self.sim1.listUnspent()
+		self.assertEqual(len(unspent), 2)
+		self.assertEqual([u["amount"] for u in unspent], [5000000000]*2)
+		self.assertEqual(self.sim1.getBalance(), 10000000000)
+		self.assertEqual(self.sim2.getBalance(), 10000000000)
+
+		blocks = self.sim1.getBlocksByHeightRange(0, 5)
+		self.assertEqual([b["height"] for b in blocks], range(5))
+		for b in blocks:
+			self.assertEqual(self.sim1.getBlockByHash(b["hash"]), b)
+			leaves = [t.decode("hex")[::-1] for t in b["tx"]]
+			self.assertEqual(
+				merkle.getMerkleRoot(leaves)[::-1].encode("hex"), b["merkleroot"])
+
+		for u in unspent:
+			txInfo = self.sim1.getTransaction(u["txid"][::-1].encode("hex"))
+			self.assertTrue("coinbase" in txInfo["vin"][0])
+			self.assertTrue(txInfo["confirmations"] in [3, 4])
+
+		#The same name gives the same wallet:
+		sim1b = self.makeSimulator("node1")
+		self.assertEqual(sim1b.listUnspent(), unspent)
+		self.assertEqual(self.sim1.getBlockCount(), 4)
+
+		#Keys are reproducible:
+		chain2 = bitcoind_simulator.SimulatedChain()
+		s = settings.Settings()
+		s.name = "node1"
+		self.assertEqual(
+			[(u["address"], u["txid"]) for u in
+				bitcoind_simulator.Bitcoind_Simulator(s, chain2).listUnspent()],
+			[(u["address"], u["txid"]) for u in unspent])
+
+
+	def test_spending(self):
+		"Test sending and confirming transactions"
+
+		toHash = self.newHash(self.sim2)
+		txID = self.send(self.sim1, 100000000, toHash)
+
+		#Unconfirmed:
+		txInfo = self.sim1.getTransaction(txID)
+		self.assertFalse("confirmations" in txInfo)
+		self.assertEqual(len(self.sim1.listUnspent()), 1)
+		self.assertEqual(self.sim2.getBalance(), 10000000000)
+
+		#Sending it again has no effect:
+		self.sim1.sendRawTransaction(txInfo["hex"].decode("hex"))
+
+		blockHash = self.sim2.generate(1)[0]
+		block = self.sim1.getBlockByHash(blockHash)
+		self.assertEqual(block["tx"][1:], [txID])
+
+		txInfo = self.sim1.getTransaction(txID)
+		self.assertEqual(txInfo["confirmations"], 1)
+		self.assertEqual(txInfo["blockhash"], blockHash)
+		self.assertEqual(
+			self.sim1.getBalance(), 10000000000 - 100000000 - 10000)
+		self.assertEqual(
+			self.sim2.getBalance(), 10000000000 + 100000000 + 5000000000 + 10000)
+
+		self.sim1.generate(2)
+		self.assertEqual(self.sim1.getTransaction(txID)["confirmations"], 3)
+		self.assertEqual(self.sim1.getTransactions([txID, txID]),
+			[self.sim1.getTransaction(txID)]*2)
+
+		#Spend an unconfirmed output:
+		tx = bitcoinutils.sendToStandardPubKey(
+			self.sim1, 100000000, toHash, self.newHash(self.sim1), 10000)
+		self.sim1.sendRawTransaction(tx.serialize())
+		changeID = tx.getTransactionID()
+		tx2 = bitcoinutils.makeSpendMultiSigTransaction(
+			changeID, 1, tx.tx_out[1].amount, toHash, 10000)
+		changeKey = crypto.Key()
+		changeKey.setPrivateKey(base58.decodeBase58Check(self.sim1.getPrivateKey(
+			base58.encodeBase58Check(tx.tx_out[1].scriptPubKey.elements[2], 0)), 128))
+		tx2.signInput(0, tx.tx_out[1].scriptPubKey,
+			[None, changeKey.getPublicKey()], [changeKey])
+		self.sim1.sendRawTransaction(tx2.serialize())
+		self.sim1.generate(1)
+		block = self.sim1.getBlocksByHeightRange(
+			self.sim1.getBlockCount(), self.sim1.getBlockCount()+1)[0]
+		self.assertEqual(len(block["tx"]), 3)
+
+
+	def test_invalidTransactions(self):
+		"Test that invalid transactions are refused"
+
+		def assertRefused(txData, code):
+			try:
+				self.sim1.sendRawTransaction(txData)
+			except JSONRPCException as e:
+				self.assertEqual(e.error["code"], code)
+			else:
+				self.fail("Transaction was accepted")
+
+		assertRefused("foobar", bitcoind_simulator.RPC_DESERIALIZATION_ERROR)
+
+		tx = bitcoinutils.sendToStandardPubKey(
+			self.sim1, 100000000, "x"*20, "y"*20, 10000)
+
+		#Wrong signature:
+		scriptSig = tx.tx_in[0].scriptSig
+		sig = scriptSig.elements[0]
+		tx.tx_in[0].scriptSig = Script([sig[:10] + chr(ord(sig[10]) ^ 1) + sig[11:],
+			scriptSig.elements[1]])
+		assertRefused(tx.serialize(), bitcoind_simulator.RPC_VERIFY_REJECTED)
+
+		#Wrong public key:
+		k = crypto.Key()
+		k.makeNewKey()
+		tx.tx_in[0].scriptSig = Script([sig, k.getPublicKey()])
+		assertRefused(tx.serialize(), bitcoind_simulator.RPC_VERIFY_REJECTED)
+
+		#More output than input:
+		tx.tx_in[0].scriptSig = scriptSig
+		tx.tx_out[0].amount += 10001
+		assertRefused(tx.serialize(), bitcoind_simulator.RPC_VERIFY_REJECTED)
+		tx.tx_out[0].amount -= 10001
+
+		#Non-existing input:
+		outputHash = tx.tx_in[0].previousOutputHash
+		tx.tx_in[0].previousOutputHash = "z"*32
+		assertRefused(tx.serialize(), bitcoind_simulator.RPC_VERIFY_ERROR)
+		tx.tx_in[0].previousOutputHash = outputHash
+
+		#Double spend:
+		self.sim1.sendRawTransaction(tx.serialize())
+		tx.tx_out[0].amount -= 1
+		assertRefused(tx.serialize(), bitcoind_simulator.RPC_VERIFY_REJECTED)
+		self.sim1.generate(1)
+		assertRefused(tx.serialize(), bitcoind_simulator.RPC_VERIFY_ERROR)
+
+
+	def test_multiSig(self):
+		"Test spending a multi-signature output"
+
+		key1 = crypto.Key()
+		key1.makeNewKey()
+		key2 = crypto.Key()
+		key2.makeNewKey()
+		pubKeys = [key1.getPublicKey(), key2.getPublicKey()]
+
+		tx = bitcoinutils.sendToMultiSigPubKey(self.sim1, 100000000,
+			pubKeys[0], pubKeys[1], self.newHash(self.sim1), 10000)
+		self.sim1.sendRawTransaction(tx.serialize())
+
+		toHash = self.newHash(self.sim2)
+		spend = bitcoinutils.makeSpendMultiSigTransaction(
+			tx.getTransactionID(), 0, 100000000, toHash, 10000)
+		sig1 = bitcoinutils.signMultiSigTransaction(spend, 0, pubKeys, key1)
+		sig2 = bitcoinutils.signMultiSigTransaction(spend, 0, pubKeys, key2)
+
+		#Signatures in the wrong order are refused:
+		bitcoinutils.applyMultiSigSignatures(spend, sig2, sig1)
+		self.assertRaises(JSONRPCException,
+			self.sim1.sendRawTransaction, spend.serialize())
+
+		bitcoinutils.applyMultiSigSignatures(spend, sig1, sig2)
+		self.sim1.sendRawTransaction(spend.serialize())
+		self.sim1.generate(1)
+		self.assertEqual(self.sim2.getBalance(), 10000000000 + 100000000 - 10000)
+
+
+	def test_errors(self):
+		"Test errors of the simulated Bitcoin daemon"
+
+		self.assertRaises(JSONRPCException, self.sim1.getTransaction, "00"*32)
+		self.assertRaises(JSONRPCException, self.sim1.getBlocksByHeightRange, 3, 6)
+		self.assertRaises(JSONRPCException, self.sim1.getBlockByHash, "00"*32)
+		self.assertRaises(JSONRPCException,
+			self.sim1.getPrivateKey, self.sim2.getNewAddress())
+
+		address = self.sim2.getNewAddress()
+		self.sim1.importprivkey(self.sim2.getPrivateKey(address), "", False)
+		self.assertEqual(
+			self.sim1.getPrivateKeys([address]), self.sim2.getPrivateKeys([address]))
+
+
+	def test_blockTimer(self):
+		"Test making blocks with a timer"
+
+		s = settings.Settings()
+		s.name = "node1"
+		s.bitcoinSimulatorBlockInterval = 0.02
+		bitcoind_simulator.Bitcoind_Simulator(s, self.chain)
+
+		t0 = time.time()
+		while self.sim1.getBlockCount() < 7 and time.time() - t0 < 5.0:
+			time.sleep(0.01)
+		self.chain.stopBlockTimer()
+		count = self.sim1.getBlockCount()
+		self.assertTrue(count >= 7)
+		time.sleep(0.05)
+		self.assertEqual(self.sim1.getBlockCount(), count)
+
+
+	def test_proxy(self):
+		"Test selecting the simulator in the Bitcoind proxy class"
+
+		s = settings.Settings()
+		s.name = "node1"
+		s.bitcoinRPCURL = "simulator"
+		b = bitcoind.Bitcoind(s)
+		self.assertTrue(b.chain is bitcoind_simulator.getSimulatedChain())
+		self.assertEqual(len(b.listUnspent()), 2)
+
+
+	def test_delayedSending(self):
+		"Test making transactions that are sent later"
+
+		#The close transaction command reserves its inputs until the
+		#sendRawTransaction command is executed:
+		makeCloseTransaction = messages.bitcoinCommandFunctions[
+			'IOUChannel_makeCloseTransaction'][0]
+		sendRawTransaction = messages.bitcoinCommandFunctions[
+			'sendRawTransaction'][0]
+		address = self.sim2.getNewAddress()
+		tx1 = makeCloseTransaction(self.sim1, 100000000, address)
+		tx2 = makeCloseTransaction(self.sim1, 100000000, address)
+		sendRawTransaction(self.sim1, tx1)
+		sendRawTransaction(self.sim1, tx2)
+		self.assertEqual(bitcoinutils.reservedOutputs, set())
+
+		#Rejected transactions release their inputs too:
+		self.sim1.generate(1)
+		tx3 = makeCloseTransaction(self.sim1, 100000000, address)
+		self.assertRaises(JSONRPCException, sendRawTransaction,
+			self.sim1, tx3[:-1] + chr(1 ^ ord(tx3[-1])))
+		self.assertEqual(bitcoinutils.reservedOutputs, set())
+
+
+	@testenvironment.benchmark
+	def test_benchmark(self):
+		"Benchmark sending and confirming transactions"
+
+		N = 100
+		toHash = self.newHash(self.sim2)
+
+		t0 = time.time()
+		txIDs = []
+		for i in range(N):
+			#Only confirmed outputs are spent, so every transaction needs a
+			#block before the change can be used again:
+			txIDs.append(self.send(self.sim1, 1000000, toHash))
+			self.sim1.generate(1)
+		t = time.time() - t0
+
+		self.assertEqual(
+			[tx["confirmations"] for tx in self.sim2.getTransactions(txIDs)],
+			range(N, 0, -1))
+		print '\n%d transactions sent and confirmed: %.3f s' % (N, t)
+
+
+
+if __name__ == "__main__":
+	unittest.main(verbosity=2)
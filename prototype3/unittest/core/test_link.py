@@ -175,8 +175,14 @@ class Test(unittest.TestCase):
 	def test_msg_bitcoinReturnValue(self):
 		'test msg_bitcoinReturnValue'
 
+		self.link.channels.append(DummyChannel())
+
 		ret = self.link.handleMessage(messages.BitcoinReturnValue(
-			ID=None, value=(['foobar'], []), channelIndex=3))
+			ID=None, commandID=1, command='foo', value='bar', channelIndex=0))
+
+		channel = self.link.channels[0]
+		self.assertEqual(channel.state,
+			[('handleBitcoinReturnValue', ('foo', 'bar'), {})])
 
 		self.assertEqual(len(ret), 1)
 		msg = ret[0]
@@ -184,8 +190,26 @@ class Test(unittest.TestCase):
 		self.assertEqual(msg.localID, 'local')
 		msg = msg.message
 		self.assertTrue(isinstance(msg, messages.ChannelMessage))
-		self.assertEqual(msg.channelIndex, 3)
-		self.assertEqual(msg.message, 'foobar')
+		self.assertEqual(msg.channelIndex, 0)
+		self.assertEqual(msg.message, 'handleBitcoinReturnValue')
+
+
+	def test_msg_bitcoinCommandFailed(self):
+		'test msg_bitcoinCommandFailed'
+
+		self.link.channels.append(DummyChannel())
+
+		ret = self.link.handleMessage(messages.BitcoinCommandFailed(
+			ID=None, commandID=1, command='foo', error='bar', channelIndex=0))
+
+		channel = self.link.channels[0]
+		self.assertEqual(channel.state,
+			[('handleBitcoinCommandFailed', ('foo', 'bar'), {})])
+
+		self.assertEqual(len(ret), 1)
+		msg = ret[0].message
+		self.assertTrue(isinstance(msg, messages.ChannelMessage))
+		self.assertEqual(msg.message, 'handleBitcoinCommandFailed')
 
 
 	def test_makeRouteOutgoing(self):
@@ -688,32 +712,37 @@ class Test(unittest.TestCase):
 		self.assertEqual(msg.token, msg_in.token)
 		self.assertEqual(msg.isPayerSide, msg_in.isPayerSide)
 		msg = ret[2]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		self.assertFalse(msg.function(messages.LinkTimeout_Commit(
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID=settings.hashAlgorithm('foobar'),
 			isPayerSide=True,
 			ID='local'
 			)))
-		self.assertTrue(msg.function(messages.LinkTimeout_Commit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID='other',
 			isPayerSide=True,
 			ID='local'
 			)))
-		self.assertTrue(msg.function(messages.LinkTimeout_Commit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID=settings.hashAlgorithm('foobar'),
 			isPayerSide=False,
 			ID='local'
 			)))
-		self.assertTrue(msg.function(messages.LinkTimeout_Commit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID=settings.hashAlgorithm('foobar'),
 			isPayerSide=True,
 			ID='other'
 			)))
-		self.assertTrue(msg.function(messages.SettleCommit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Lock(
 			transactionID=settings.hashAlgorithm('foobar'),
 			isPayerSide=True,
-			ID='local'
-			)))
+			payerID='local'
+		)))
 
 		self.assertEqual(self.link.channels[0].state,
 			[expectedRouteID])
@@ -844,32 +873,37 @@ class Test(unittest.TestCase):
 		self.assertEqual(msg.channelIndex, 1)
 		self.assertEqual(msg.message, 'settleRollbackIncoming')
 		msg = ret[1]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		self.assertFalse(msg.function(messages.LinkTimeout_Commit(
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID='foobar',
 			isPayerSide=True,
 			ID='local'
 			)))
-		self.assertTrue(msg.function(messages.LinkTimeout_Commit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID='other',
 			isPayerSide=True,
 			ID='local'
 			)))
-		self.assertTrue(msg.function(messages.LinkTimeout_Commit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID='foobar',
 			isPayerSide=False,
 			ID='local'
 			)))
-		self.assertTrue(msg.function(messages.LinkTimeout_Commit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.LinkTimeout_Commit(
 			transactionID='foobar',
 			isPayerSide=True,
 			ID='other'
 			)))
-		self.assertTrue(msg.function(messages.SettleCommit(
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Lock(
 			transactionID='foobar',
 			isPayerSide=True,
-			ID='local'
-			)))
+			payerID='local'
+		)))
 
 		self.assertEqual(self.link.channels[0].state,
 			['1foobar'])
@@ -891,13 +925,11 @@ class Test(unittest.TestCase):
 			self.assertEqual(msg.channelIndex, 42)
 			self.assertEqual(msg.message, m)
 
-		dummyFunc = lambda x: x
-
 		ret = self.link.handleChannelOutput(42,
 			(
 			['x', 'y'],
 			[
-				messages.BitcoinCommand(function=dummyFunc),
+				messages.BitcoinCommand(command='foo', arguments=[1]),
 				messages.NodeState_TimeoutRollback(transactionID='1foobar'),
 				'dummy'
 			]))
@@ -905,7 +937,8 @@ class Test(unittest.TestCase):
 
 		msg = ret[0]
 		self.assertTrue(isinstance(msg, messages.BitcoinCommand))
-		self.assertEqual(msg.function, dummyFunc)
+		self.assertEqual(msg.command, 'foo')
+		self.assertEqual(msg.arguments, [1])
 		self.assertEqual(msg.returnID, 'local')
 		self.assertEqual(msg.returnChannelIndex, 42)
 		msg = ret[1]
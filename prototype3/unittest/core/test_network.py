@@ -28,6 +28,9 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import unittest
+import threading
+import time
+import struct
 
 import testenvironment
 
@@ -89,6 +92,15 @@ class Test(unittest.TestCase):
 		self.assertEqual(len(self.messages), 1)
 		self.assertEqual(self.messages[0].__class__, messages.Pay)
 
+		#Switching to binary framing:
+		self.assertEqual(c2.writeFraming, 'binary')
+		self.network.processNetworkEvents(timeout=0.01)
+		self.assertEqual(c1.readFraming, 'binary')
+		self.assertEqual(c1.writeFraming, 'binary')
+		self.network.processNetworkEvents(timeout=0.01)
+		self.assertEqual(c2.readFraming, 'binary')
+		self.assertEqual(len(self.messages), 1)
+
 		#Sending another connect message (illegal):
 		self.messages = []
 		self.network.sendOutboundMessage(0, messages.OutboundMessage(
@@ -131,7 +143,7 @@ class Test(unittest.TestCase):
 
 		#Sending an invalid message:
 		self.messages = []
-		c2.send('{"data": "Invalid"}\n')
+		c2.sendFrame('{"data": "Invalid"}')
 
 		self.network.processNetworkEvents(timeout=0.01)
 
@@ -229,6 +241,54 @@ class Test(unittest.TestCase):
 		self.network.processNetworkEvents(timeout=0.01)
 
 
+	def test_wakeup(self):
+		"Test waking up a blocking processNetworkEvents call"
+
+		#A pending wake-up makes the call return immediately:
+		self.network.wakeup()
+		t0 = time.time()
+		self.network.processNetworkEvents(timeout=None)
+		self.assertTrue(time.time() - t0 < 1.0)
+
+		#Wake-up from another thread:
+		timer = threading.Timer(0.1, self.network.wakeup)
+		timer.start()
+		t0 = time.time()
+		self.network.processNetworkEvents(timeout=None)
+		dt = time.time() - t0
+		timer.join()
+		self.assertTrue(dt >= 0.05)
+		self.assertTrue(dt < 5.0)
+
+		#Multiple wake-ups are merged into a single one:
+		for i in range(10000):
+			self.network.wakeup()
+		self.network.processNetworkEvents(timeout=None)
+		t0 = time.time()
+		self.network.processNetworkEvents(timeout=0.1)
+		self.assertTrue(time.time() - t0 >= 0.05)
+
+		self.assertEqual(len(self.messages), 0)
+
+
+	def test_remoteClose(self):
+		"Test that a remotely closed connection is removed from the channel map"
+
+		c1 = self.network.makeConnection(
+			('localhost', 4321), 'localID', messages.Pay(ID='remoteID'))
+		#Connect, and framing negotiation:
+		for i in range(4):
+			self.network.processNetworkEvents(timeout=0.01)
+		numChannels = len(self.network.channelMap)
+
+		self.network.closeInterface('remoteID')
+		self.network.processNetworkEvents(timeout=0.01)
+
+		self.assertTrue(c1.isClosed)
+		self.assertEqual(len(self.network.channelMap), numChannels-2)
+		self.assertFalse(self.network.interfaceExists('localID'))
+
+
 	def test_connectError(self):
 		"Test connect error"
 
@@ -242,6 +302,141 @@ class Test(unittest.TestCase):
 
 
 
+	def test_framing(self):
+		"Test framing negotiation and maximum message size"
+
+		#A peer that only supports newline framing:
+		network2 = network.Network('localhost', 4322, self,
+			framing='newline', maxMessageSize=1000)
+		network2.openListener()
+		try:
+			c1 = self.network.makeConnection(
+				('localhost', 4322), 'localID', messages.Pay(ID='remoteID'))
+			for i in range(4):
+				network2.processNetworkEvents(timeout=0.01)
+				self.network.processNetworkEvents(timeout=0.01)
+			c2 = network2.getInterface('remoteID')
+
+			for c in (c1, c2):
+				self.assertEqual(c.readFraming, 'newline')
+				self.assertEqual(c.writeFraming, 'newline')
+
+			#Multiple messages, split over several reads:
+			self.messages = []
+			data = ''.join([
+				'{"index": %d, "message": {"_class": "Cancel"}}\n' % i
+				for i in range(100)])
+			c1.send(data)
+			for i in range(20):
+				self.network.processNetworkEvents(timeout=0.01) #sends 512 bytes
+				network2.processNetworkEvents(timeout=0.01)
+			cancels = [m for m in self.messages if isinstance(m, messages.Cancel)]
+			self.assertEqual(len(cancels), 100)
+			self.assertEqual(c2.readPos, 0)
+			self.assertEqual(len(c2.readBuffer), 0)
+
+			#Too large message:
+			c1.send('x' * 1500)
+			for i in range(5):
+				self.network.processNetworkEvents(timeout=0.01)
+				network2.processNetworkEvents(timeout=0.01)
+			self.assertTrue(c2.isClosed)
+			self.assertFalse(network2.interfaceExists('remoteID'))
+		finally:
+			network2.closeAll()
+
+		self.assertRaises(Exception, network.Network, 'localhost', 4322, self,
+			framing='foo')
+
+
+	def test_lengthFraming(self):
+		"Test receiving length-prefixed messages"
+
+		self.network.framing = 'length'
+		self.network.maxMessageSize = 1000
+		c1 = self.network.makeConnection(
+			('localhost', 4321), 'localID', messages.Pay(ID='remoteID'))
+		for i in range(4):
+			self.network.processNetworkEvents(timeout=0.01)
+		c2 = self.network.getInterface('remoteID')
+		self.assertEqual(c2.readFraming, 'length')
+
+		self.messages = []
+		data = ''.join([
+			struct.pack('>I', len(msg)) + msg
+			for msg in [
+				'{"index": %d, "message": {"_class": "Cancel"}}' % i
+				for i in range(100)]
+			])
+		for i in range(0, len(data), 333):
+			c1.send(data[i:i+333])
+			self.network.processNetworkEvents(timeout=0.01)
+		cancels = [m for m in self.messages if isinstance(m, messages.Cancel)]
+		self.assertEqual(len(cancels), 100)
+		self.assertEqual(len(c2.readBuffer), 0)
+
+		#Processed data stays in the buffer while it is less than half of it:
+		def frame(i, padding=''):
+			msg = '{"index": %d, "message": {"_class": "Cancel"}%s}' % \
+				(i, padding)
+			return struct.pack('>I', len(msg)) + msg
+		frame1 = frame(100)
+		frame2 = frame(101, ', "padding": "%s"' % ('x' * 100))
+		c1.send(frame1 + frame2[:60])
+		self.network.processNetworkEvents(timeout=0.01)
+		self.assertEqual(c2.readPos, len(frame1))
+		self.assertEqual(len(c2.readBuffer), len(frame1) + 60)
+		c1.send(frame2[60:])
+		self.network.processNetworkEvents(timeout=0.01)
+		self.assertEqual(c2.readPos, 0)
+		self.assertEqual(len(c2.readBuffer), 0)
+		cancels = [m for m in self.messages if isinstance(m, messages.Cancel)]
+		self.assertEqual(len(cancels), 102)
+
+		#Too large message:
+		c1.send(struct.pack('>I', 1001))
+		self.network.processNetworkEvents(timeout=0.01)
+		self.assertTrue(c2.isClosed)
+
+
+	def test_binaryFraming(self):
+		"Test receiving binary messages"
+
+		c1 = self.network.makeConnection(
+			('localhost', 4321), 'localID', messages.Pay(ID='remoteID'))
+		for i in range(4):
+			self.network.processNetworkEvents(timeout=0.01)
+		c2 = self.network.getInterface('remoteID')
+		self.assertEqual(c2.readFraming, 'binary')
+		self.assertEqual(c1.writeFraming, 'binary')
+
+		self.messages = []
+		c1.sendMessage(1, messages.Receipt(ID='foo', amount=2,
+			receipt='\x00\xff', meetingPoints=['MP']))
+
+		#Received binary data is not converted to JSON for logging:
+		logged = []
+		oldLog = network.log.log
+		network.log.log = logged.append
+		try:
+			self.network.processNetworkEvents(timeout=0.01)
+		finally:
+			network.log.log = oldLog
+		received = [s for s in logged if s.startswith('Received from ')]
+		self.assertEqual(len(received), 1)
+		self.assertTrue(received[0].endswith(
+			' bytes of binary data (amiko.core.messages.Receipt)\n'))
+
+		self.assertEqual(len(self.messages), 1)
+		msg = self.messages[0]
+		self.assertEqual(msg.__class__, messages.Receipt)
+		self.assertEqual(msg.ID, 'remoteID')
+		self.assertEqual(msg.amount, 2)
+		self.assertEqual(msg.receipt, '\x00\xff')
+		self.assertEqual(msg.meetingPoints, ['MP'])
+
+
+
 if __name__ == "__main__":
 	unittest.main(verbosity=2)
 
@@ -28,13 +28,38 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import unittest
+import copy
+import time
+import os
+import random
+import heapq
 
 import testenvironment
 
 from amiko.utils.crypto import RIPEMD160, SHA256
 
+from amiko.utils import serializable
+
 from amiko.core import nodestate
+from amiko.core import persistentobject
 from amiko.core import payeelink, transaction, messages
+from amiko.core import link, meetingpoint, persistentconnection, settings
+from amiko.channels import plainchannel
+
+stateFile = "test_nodestate.dat"
+
+
+class BitcoinTestChannel(serializable.Serializable):
+	serializableAttributes = {'returnValues': [], 'failures': []}
+
+	def handleBitcoinReturnValue(self, command, value):
+		self.returnValues.append((command, value))
+		return [], []
+
+	def handleBitcoinCommandFailed(self, command, error):
+		self.failures.append((command, error))
+		return [], []
+serializable.registerClass(BitcoinTestChannel)
 
 
 
@@ -69,10 +94,382 @@ class Test(unittest.TestCase):
 		#TODO: test ret
 
 
+	def test_transactions(self):
+		"Test addTransaction, removeTransaction and findTransaction"
+
+		def makeTx(transactionID, isPayerSide, payerID):
+			return transaction.Transaction(
+				transactionID=transactionID, isPayerSide=isPayerSide,
+				payerID=payerID, payeeID='payee')
+
+		txs = [
+			makeTx('tx%d' % (i/4), i%2 == 0, 'payer%d' % (i%4))
+			for i in range(20)
+			]
+		for tx in txs:
+			self.nodeState.addTransaction(tx)
+		self.assertEqual(self.nodeState.transactions, txs)
+
+		def check(nodeState, remaining):
+			self.assertEqual(set(nodeState.transactions), set(remaining))
+			for tx in remaining:
+				self.assertEqual(nodeState.findTransaction(
+					transactionID=tx.transactionID, isPayerSide=tx.isPayerSide,
+					payerID=tx.payerID), tx)
+				self.assertEqual(set(nodeState.findMultipleTransactions(
+					transactionID=tx.transactionID, isPayerSide=tx.isPayerSide)),
+					set([x for x in remaining
+						if x.transactionID == tx.transactionID and
+						x.isPayerSide == tx.isPayerSide]))
+			self.assertEqual(len(nodeState.findMultipleTransactions(
+				transactionID=None, isPayerSide=True, payeeID='payee')),
+				len([x for x in remaining if x.isPayerSide]))
+
+		check(self.nodeState, txs)
+
+		for i in [0, 19, 5, 6, 7]:
+			self.nodeState.removeTransaction(txs[i])
+		remaining = [tx for i, tx in enumerate(txs) if i not in [0, 19, 5, 6, 7]]
+		check(self.nodeState, remaining)
+
+		self.assertRaises(nodestate.TransactionNotFound,
+			self.nodeState.findTransaction,
+			transactionID='tx0', isPayerSide=True, payerID='payer0')
+		self.assertRaises(Exception,
+			self.nodeState.findTransaction,
+			transactionID='tx2', isPayerSide=True)
+
+		#The indexes are re-created after de-serialization:
+		newState = serializable.state2Object(self.nodeState.getState())
+		self.assertEqual(
+			[x.getState() for x in newState.transactions],
+			[x.getState() for x in self.nodeState.transactions])
+		check(newState, newState.transactions)
+
+
+	def makePersistentState(self, numTransactions):
+		"""
+		Makes a NodeState with the given number of transactions, stored in a
+		PersistentObject.
+		"""
+
+		def removeFiles():
+			for ext in ['', '.new', '.old', '.wal', '.wal.new']:
+				if os.access(stateFile + ext, os.F_OK):
+					os.remove(stateFile + ext)
+		removeFiles()
+		self.addCleanup(removeFiles)
+
+		state = persistentobject.PersistentObject(
+			filename=stateFile, defaultObject=nodestate.NodeState())
+		with state:
+			for i in range(numTransactions):
+				state.addTransaction(self.makeTx(i))
+		return state
+
+
+	def makeTx(self, i):
+		return transaction.Transaction(
+			transactionID='tx%d' % i, isPayerSide=True,
+			payerID='payer', payeeID='payee')
+
+
+	def test_persistentTransactions(self):
+		"Test adding and removing transactions in a PersistentObject"
+
+		state = self.makePersistentState(1000)
+
+		#The saved changes don't depend on the number of transactions:
+		for i in range(1000, 1010):
+			walSize = os.path.getsize(stateFile + '.wal')
+			with state:
+				state.addTransaction(self.makeTx(i))
+				state.removeTransaction(state.transactions[i % 100])
+			self.assertTrue(os.path.getsize(stateFile + '.wal') - walSize < 2000)
+
+		#The transactions and their indexes are restored on an exception:
+		IDs = set(tx.transactionID for tx in state.transactions)
+		first = state.transactions[0]
+		try:
+			with state:
+				state.addTransaction(self.makeTx(2000))
+				state.removeTransaction(first)
+				raise Exception('Unit test exception')
+		except Exception:
+			pass
+		self.assertEqual(set(tx.transactionID for tx in state.transactions), IDs)
+		self.assertEqual(state.findMultipleTransactions(
+			transactionID='tx2000', isPayerSide=True), [])
+		self.assertEqual(state.findMultipleTransactions(
+			transactionID=first.transactionID, isPayerSide=True), [first])
+
+		del state
+		state = persistentobject.PersistentObject(
+			filename=stateFile, defaultObject=nodestate.NodeState())
+		self.assertEqual(set(tx.transactionID for tx in state.transactions), IDs)
+
+
+	@testenvironment.benchmark
+	def test_persistentTransactionsBenchmark(self):
+		"Benchmark adding and removing transactions in a PersistentObject"
+
+		print
+		for numTransactions in [100, 10000]:
+			state = self.makePersistentState(numTransactions)
+			N = 200
+			t0 = time.time()
+			for i in range(N):
+				with state:
+					state.addTransaction(self.makeTx(numTransactions + i))
+				with state:
+					state.removeTransaction(state.transactions[0])
+			dt = time.time() - t0
+			print '%d transactions: %.2f ms per added and removed transaction' % \
+				(numTransactions, 1000.0 * dt / N)
+			del state
+
+
+	def test_heap(self):
+		"Test heapPush and heapPop"
+
+		rnd = random.Random(1)
+		heap = []
+		reference = []
+		for i in range(1000):
+			if rnd.random() < 0.6 or len(heap) == 0:
+				x = rnd.randint(0, 100)
+				nodestate.heapPush(heap, x)
+				heapq.heappush(reference, x)
+			else:
+				self.assertEqual(nodestate.heapPop(heap), heapq.heappop(reference))
+		self.assertEqual(sorted(heap), sorted(reference))
+		while len(heap) > 0:
+			self.assertEqual(nodestate.heapPop(heap), heapq.heappop(reference))
+
+		#Only a few items of a tracked heap are changed:
+		tracker = serializable.ChangeTracker()
+		heap = tracker.track(range(1000))
+		tracker.clearChanges()
+		nodestate.heapPush(heap, -1)
+		self.assertEqual(heap[0], -1)
+		self.assertTrue(len(tracker.getStateDelta(heap)) <= 12)
+		tracker.clearChanges()
+		self.assertEqual(nodestate.heapPop(heap), -1)
+		self.assertEqual(nodestate.heapPop(heap), 0)
+		self.assertTrue(len(tracker.getStateDelta(heap)) <= 24)
+
+
+	def test_timeouts(self):
+		"Test time-out scheduling and cancelling"
+
+		def makeTimeout(timestamp, transactionID):
+			return messages.TimeoutMessage(timestamp=timestamp,
+				message=messages.NodeStateTimeout_Route(
+					transactionID=transactionID, isPayerSide=True, payerID='payer'))
+
+		self.assertEqual(self.nodeState.getNextTimeout(), None)
+		self.assertEqual(self.nodeState.popExpiredTimeout(1000.0), None)
+
+		#Sub-second ordering:
+		timestamps = [100.5, 100.1, 100.9, 100.3, 99.0, 100.3, 101.0]
+		for i, t in enumerate(timestamps):
+			self.assertEqual(self.nodeState.handleMessage(makeTimeout(t, 'tx%d' % i)), [])
+		self.assertEqual(self.nodeState.getNextTimeout(), 99.0)
+
+		ret = self.nodeState.handleMessage(messages.CancelTimeout(
+			message=messages.NodeStateTimeout_Route(
+				transactionID='tx1', isPayerSide=True, payerID='payer')))
+		self.assertEqual(ret, [])
+		#Not matching anything:
+		self.nodeState.handleMessage(messages.CancelTimeout(
+			message=messages.NodeStateTimeout_Lock(
+				transactionID='tx2', isPayerSide=True, payerID='payer')))
+
+		#The state survives serialization, without the cancelled time-out:
+		newState = serializable.state2Object(self.nodeState.getState())
+		self.assertEqual(len(newState.timeoutMessages), len(timestamps) - 1)
+
+		for nodeState in [self.nodeState, newState]:
+			popped = []
+			while True:
+				msg = nodeState.popExpiredTimeout(100.95)
+				if msg is None:
+					break
+				popped.append(msg.transactionID)
+			self.assertEqual(popped[0], 'tx4')
+			self.assertEqual(set(popped[1:3]), set(['tx3', 'tx5']))
+			self.assertEqual(popped[3:], ['tx0', 'tx2'])
+			self.assertEqual(nodeState.getNextTimeout(), 101.0)
+
+			nodeState.handleMessage(messages.CancelTimeout(
+				message=messages.NodeStateTimeout_Route(
+					transactionID='tx6', isPayerSide=True, payerID='payer')))
+			self.assertEqual(nodeState.getNextTimeout(), None)
+			self.assertEqual(nodeState.timeoutMessages, [])
+
+
 	#TODO: test many other methods
 
 
+	def routePayments(self, N):
+		"""
+		Routes N payments through a node with a meeting point.
+
+		Return value:
+		tuple (time per payment in s, deep-copied objects per payment)
+		"""
+
+		#A node with a meeting point, between a payer-side and a payee-side
+		#link:
+		def makeLink(ID):
+			return link.Link(remoteID='remote' + ID, localID=ID,
+				channels=[plainchannel.PlainChannel(
+					state='open', amountLocal=10**9, amountRemote=10**9)])
+		nodeState = nodestate.NodeState(
+			links={'A': makeLink('A'), 'B': makeLink('B')},
+			meetingPoints={'MP': meetingpoint.MeetingPoint(ID='MP')},
+			connections={
+				'A': persistentconnection.PersistentConnection(host=None, port=None),
+				'B': persistentconnection.PersistentConnection(host=None, port=None)
+				}
+			)
+		nodeState.settings = settings.Settings()
+		increment = nodeState.settings.timeoutIncrement
+
+		def process(msg):
+			queue = [msg]
+			while len(queue) > 0:
+				queue += nodeState.handleMessage(queue.pop(0))
+
+		def pay(i):
+			token = 'token%d' % i
+			transactionID = settings.hashAlgorithm(token)
+			#The payer side end time is larger by one time increment per hop:
+			for ID, isPayerSide, endTime in [
+				('A', True, 2000 + 2*increment), ('B', False, 2000)]:
+				process(messages.MakeRoute(ID=ID, isPayerSide=isPayerSide,
+					amount=1, transactionID=transactionID,
+					startTime=1000, endTime=endTime, meetingPointID='MP',
+					channelIndex=0))
+			process(messages.Lock(ID='A', isPayerSide=True,
+				transactionID=transactionID, amount=1,
+				startTime=1000, endTime=2000 + 2*increment, channelIndex=0))
+			process(messages.RequestCommit(ID='B', isPayerSide=False,
+				token=token))
+			process(messages.SettleCommit(ID='A', isPayerSide=True,
+				token=token))
+
+		#Count the objects that are deep-copied:
+		numCopies = [0]
+		oldDeepcopy = copy.deepcopy
+		def countingDeepcopy(x, memo=None, _nil=[]):
+			numCopies[0] += 1
+			return oldDeepcopy(x, memo, _nil)
+		copy.deepcopy = countingDeepcopy
+		try:
+			t0 = time.time()
+			for i in range(N):
+				pay(i)
+			dt = time.time() - t0
+		finally:
+			copy.deepcopy = oldDeepcopy
+
+		self.assertEqual(nodeState.transactions, [])
+		self.assertEqual(nodeState.links['A'].channels[0].amountLocal, 10**9 + N)
+		self.assertEqual(nodeState.links['B'].channels[0].amountLocal, 10**9 - N)
+
+		return dt / N, float(numCopies[0]) / N
+
+
+	def test_routing(self):
+		"Test that routed payments are passed on without copying them"
+
+		dt, numCopies = self.routePayments(10)
+		self.assertTrue(numCopies < 1)
+
+
+	@testenvironment.benchmark
+	def test_routingBenchmark(self):
+		"Benchmark copying of data while routing payments"
+
+		dt, numCopies = self.routePayments(100)
+		print '\nPer routed payment: %.2f ms; %.2f deep-copied objects' % \
+			(1000.0 * dt, numCopies)
+
+
+
+	def test_bitcoinCommands(self):
+		"Test queueing of bitcoin commands"
+
+		channel = BitcoinTestChannel()
+		self.nodeState.links['link'] = link.Link(channels=[channel])
+		self.nodeState.settings = settings.Settings()
+		self.nodeState.settings.bitcoinMaxRetries = 2
+
+		for i in range(3):
+			self.assertEqual(self.nodeState.handleMessage(
+				messages.BitcoinCommand(command='foo', arguments=[i],
+					returnID='link', returnChannelIndex=0)),
+				[])
+		self.assertEqual([c.ID for c in self.nodeState.bitcoinCommands],
+			[1, 2, 3])
+
+		#The queue survives serialization:
+		newState = serializable.state2Object(self.nodeState.getState())
+		self.assertEqual([c.ID for c in newState.bitcoinCommands], [1, 2, 3])
+		self.assertEqual(newState.bitcoinCommands[2].arguments, [2])
+
+		#Return values are passed to the channel:
+		ret = self.nodeState.handleMessage(messages.BitcoinReturnValue(
+			commandID=2, command='foo', value='bar', ID='link', channelIndex=0))
+		self.assertEqual(ret, [])
+		self.assertEqual(channel.returnValues, [('foo', 'bar')])
+		self.assertEqual([c.ID for c in self.nodeState.bitcoinCommands], [1, 3])
+
+		#A second return value of the same command is ignored:
+		ret = self.nodeState.handleMessage(messages.BitcoinReturnValue(
+			commandID=2, command='foo', value='bar', ID='link', channelIndex=0))
+		self.assertEqual(ret, [])
+		self.assertEqual(len(channel.returnValues), 1)
+
+		#Transient failures are retried after a time-out:
+		def fail(commandID, isTransient):
+			return self.nodeState.handleMessage(messages.BitcoinCommandFailed(
+				commandID=commandID, command='foo', error='error',
+				isTransient=isTransient, ID='link', channelIndex=0))
+		ret = fail(1, True)
+		self.assertEqual([c.ID for c in self.nodeState.bitcoinCommands], [3])
+		self.assertEqual(len(ret), 1)
+		self.assertTrue(isinstance(ret[0], messages.TimeoutMessage))
+		self.assertTrue(ret[0].timestamp > time.time() + 50.0)
+		command = ret[0].message
+		self.assertEqual(command.arguments, [0])
+		self.assertEqual(command.numRetries, 1)
+
+		self.nodeState.handleMessage(ret[0])
+		self.assertEqual(self.nodeState.popExpiredTimeout(ret[0].timestamp + 1.0),
+			command)
+		self.nodeState.handleMessage(command)
+		self.assertEqual([c.ID for c in self.nodeState.bitcoinCommands], [3, 4])
+
+		self.assertEqual(fail(1, True), [])
+		self.assertEqual(channel.failures, [])
+
+		#The number of retries is limited:
+		ret = fail(4, True)
+		self.assertEqual(ret[0].message.numRetries, 2)
+		self.nodeState.handleMessage(ret[0].message)
+		self.assertEqual([c.ID for c in self.nodeState.bitcoinCommands], [3, 5])
+		self.assertEqual(fail(5, True), [])
+		self.assertEqual(channel.failures, [('foo', 'error')])
+		self.assertEqual([c.ID for c in self.nodeState.bitcoinCommands], [3])
+
+		#Other failures are passed to the channel immediately:
+		self.assertEqual(fail(3, False), [])
+		self.assertEqual(channel.failures, [('foo', 'error')]*2)
+		self.assertEqual(self.nodeState.bitcoinCommands, [])
+
+
 
 if __name__ == "__main__":
 	unittest.main(verbosity=2)
-
@@ -88,10 +88,13 @@ class Test(unittest.TestCase):
 		self.assertEqual(len(ret), 2)
 
 		msg = ret[0]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		function = msg.function
-		self.assertFalse(function(messages.PayerTimeout()))
-		self.assertTrue(function(messages.NodeStateTimeout_Route()))
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout()))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 		msg = ret[1]
 		self.assertTrue(isinstance(msg, messages.SetEvent))
 		self.assertEqual(msg.event, messages.SetEvent.events.receiptReceived)
@@ -110,10 +113,13 @@ class Test(unittest.TestCase):
 		self.assertEqual(len(ret), 2)
 
 		msg = ret[0]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		function = msg.function
-		self.assertFalse(function(messages.PayerTimeout()))
-		self.assertTrue(function(messages.NodeStateTimeout_Route()))
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout()))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 		msg = ret[1]
 		self.assertTrue(isinstance(msg, messages.SetEvent))
 		self.assertEqual(msg.event, messages.SetEvent.events.paymentFinished)
@@ -191,10 +197,13 @@ class Test(unittest.TestCase):
 
 		self.assertEqual(len(ret), 3)
 		msg = ret[0]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		function = msg.function
-		self.assertFalse(function(messages.PayerTimeout()))
-		self.assertTrue(function(messages.NodeStateTimeout_Route()))
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout()))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 		msg = ret[1]
 		self.assertTrue(isinstance(msg, messages.OutboundMessage))
 		self.assertEqual(msg.localID, messages.payerLocalID)
@@ -220,10 +229,13 @@ class Test(unittest.TestCase):
 
 			self.assertEqual(len(ret), 3)
 			msg = ret[0]
-			self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-			function = msg.function
-			self.assertFalse(function(messages.PayerTimeout()))
-			self.assertTrue(function(messages.NodeStateTimeout_Route()))
+			self.assertTrue(isinstance(msg, messages.CancelTimeout))
+			self.assertEqual(messages.getTimeoutKey(msg.message),
+				messages.getTimeoutKey(messages.PayerTimeout()))
+			self.assertEqual(messages.getTimeoutKey(msg.message),
+				messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+			self.assertNotEqual(messages.getTimeoutKey(msg.message),
+				messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 			msg = ret[1]
 			self.assertTrue(isinstance(msg, messages.CancelRoute))
 			self.assertTrue(msg.transactionID, 'txID')
@@ -246,10 +258,13 @@ class Test(unittest.TestCase):
 
 		self.assertEqual(len(ret), 3)
 		msg = ret[0]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		function = msg.function
-		self.assertFalse(function(messages.PayerTimeout()))
-		self.assertTrue(function(messages.NodeStateTimeout_Route()))
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout()))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 		msg = ret[1]
 		self.assertTrue(isinstance(msg, messages.OutboundMessage))
 		self.assertEqual(msg.localID, messages.payerLocalID)
@@ -396,10 +411,13 @@ class Test(unittest.TestCase):
 		self.assertEqual(len(ret), 2)
 
 		msg = ret[0]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		function = msg.function
-		self.assertFalse(function(messages.PayerTimeout()))
-		self.assertTrue(function(messages.NodeStateTimeout_Route()))
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout()))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 		msg = ret[1]
 		self.assertTrue(isinstance(msg, messages.SetEvent))
 		self.assertEqual(msg.event, messages.SetEvent.events.paymentFinished)
@@ -423,10 +441,13 @@ class Test(unittest.TestCase):
 		self.assertEqual(len(ret), 3)
 
 		msg = ret[0]
-		self.assertTrue(isinstance(msg, messages.FilterTimeouts))
-		function = msg.function
-		self.assertFalse(function(messages.PayerTimeout()))
-		self.assertTrue(function(messages.NodeStateTimeout_Route()))
+		self.assertTrue(isinstance(msg, messages.CancelTimeout))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout()))
+		self.assertEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.PayerTimeout(state='foo')))
+		self.assertNotEqual(messages.getTimeoutKey(msg.message),
+			messages.getTimeoutKey(messages.NodeStateTimeout_Route()))
 		msg = ret[1]
 		self.assertTrue(isinstance(msg, messages.OutboundMessage))
 		self.assertEqual(msg.localID, messages.payerLocalID)
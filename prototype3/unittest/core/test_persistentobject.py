@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#    test_persistentobject.py
+#    Copyright (C) 2016 by CJP
+#
+#    This file is part of Amiko Pay.
+#
+#    Amiko Pay is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Amiko Pay is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Amiko Pay. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Additional permission under GNU GPL version 3 section 7
+#
+#    If you modify this Program, or any covered work, by linking or combining it
+#    with the OpenSSL library (or a modified version of that library),
+#    containing parts covered by the terms of the OpenSSL License and the SSLeay
+#    License, the licensors of this Program grant you additional permission to
+#    convey the resulting work. Corresponding Source for a non-source form of
+#    such a combination shall include the source code for the parts of the
+#    OpenSSL library used as well as that of the covered work.
+
+import unittest
+import os
+
+import testenvironment
+
+from amiko.utils import serializable
+
+from amiko.core import persistentobject
+
+stateFile = "test_persistentobject.dat"
+
+
+
+class PersistentObjectTestObject(serializable.Serializable):
+	serializableAttributes = {'x': 0, 'y': {}, 'z': []}
+serializable.registerClass(PersistentObjectTestObject)
+
+
+
+class Test(unittest.TestCase):
+	def setUp(self):
+		self.removeFiles()
+
+
+	def tearDown(self):
+		self.removeFiles()
+
+
+	def removeFiles(self):
+		for ext in ['', '.new', '.old', '.wal', '.wal.new']:
+			if os.access(stateFile + ext, os.F_OK):
+				os.remove(stateFile + ext)
+
+
+	def makeObject(self, compactionInterval=1000, stateFormat='json'):
+		return persistentobject.PersistentObject(
+			filename=stateFile,
+			defaultObject=PersistentObjectTestObject(),
+			nonserializedAttributes={'constant': 42},
+			compactionInterval=compactionInterval,
+			stateFormat=stateFormat)
+
+
+	def readFile(self, filename):
+		with open(filename, 'rb') as f:
+			return f.read()
+
+
+	def test_defaultState(self):
+		"Test starting with the default state"
+
+		obj = self.makeObject()
+
+		self.assertEqual(obj.x, 0)
+		self.assertEqual(obj.constant, 42)
+		self.assertTrue(os.access(stateFile, os.F_OK))
+		self.assertTrue(os.access(stateFile + '.wal', os.F_OK))
+
+		obj = self.makeObject()
+		self.assertEqual(obj.x, 0)
+		self.assertEqual(obj.constant, 42)
+
+
+	def test_writeAheadLog(self):
+		"Test that changes are appended to the write-ahead log"
+
+		obj = self.makeObject()
+		snapshot = self.readFile(stateFile)
+		walSize = len(self.readFile(stateFile + '.wal'))
+
+		for i in range(10):
+			with obj:
+				obj.x = i
+				obj.y[str(i)] = '\xff' * i
+				obj.z.append(i)
+
+		#Snapshot is unchanged; the log has grown:
+		self.assertEqual(self.readFile(stateFile), snapshot)
+		self.assertTrue(len(self.readFile(stateFile + '.wal')) > walSize)
+
+		#A save without changes doesn't write anything:
+		walSize = len(self.readFile(stateFile + '.wal'))
+		obj.save()
+		self.assertEqual(len(self.readFile(stateFile + '.wal')), walSize)
+
+		obj = self.makeObject()
+		self.assertEqual(obj.x, 9)
+		self.assertEqual(obj.y, {str(i): '\xff' * i for i in range(10)})
+		self.assertEqual(obj.z, range(10))
+		self.assertEqual(obj.constant, 42)
+
+		#Loading compacts the log into the snapshot:
+		self.assertNotEqual(self.readFile(stateFile), snapshot)
+		self.assertEqual(len(self.readFile(stateFile + '.wal').split('\n')), 2)
+
+
+	def test_rollback(self):
+		"Test that an exception restores the state, without writing anything"
+
+		obj = self.makeObject()
+		with obj:
+			obj.x = 1
+		wal = self.readFile(stateFile + '.wal')
+
+		try:
+			with obj:
+				obj.x = 2
+				obj.y['foo'] = 'bar'
+				raise Exception('Unit test exception')
+		except Exception:
+			pass
+
+		self.assertEqual(obj.x, 1)
+		self.assertEqual(obj.y, {})
+		self.assertEqual(obj.constant, 42)
+		self.assertEqual(self.readFile(stateFile + '.wal'), wal)
+
+		#Nested objects are restored in-place:
+		with obj:
+			obj.z.append(PersistentObjectTestObject(x=1))
+		z = obj.z
+		child = obj.z[0]
+		try:
+			with obj:
+				obj.z[0].x = 2
+				obj.z[0].z.append(3)
+				obj.z.append(PersistentObjectTestObject())
+				obj.constant = 43
+				raise Exception('Unit test exception')
+		except Exception:
+			pass
+
+		self.assertTrue(obj.z is z)
+		self.assertTrue(obj.z[0] is child)
+		self.assertEqual(len(obj.z), 1)
+		self.assertEqual(child.x, 1)
+		self.assertEqual(child.z, [])
+		self.assertEqual(obj.constant, 42)
+
+
+	def test_changedObjectsOnly(self):
+		"Test that a log record only contains the changed objects"
+
+		obj = self.makeObject()
+		with obj:
+			obj.z = [PersistentObjectTestObject(x=i, y={'data': 'x'*100})
+				for i in range(100)]
+
+		walSize = len(self.readFile(stateFile + '.wal'))
+		with obj:
+			obj.z[50].x = 'changed'
+			obj.z.append(PersistentObjectTestObject())
+			obj.constant = 43
+		record = self.readFile(stateFile + '.wal')[walSize:]
+		self.assertTrue(len(record) < 200)
+		self.assertTrue('changed' in record)
+		self.assertFalse('constant' in record)
+
+		#Changes outside a with-block are saved as well:
+		obj.z.pop(0)
+		obj.save()
+
+		state = obj.getState()
+		obj = self.makeObject()
+		self.assertEqual(obj.getState(), state)
+		self.assertEqual(obj.z[49].x, 'changed')
+		self.assertEqual(obj.constant, 42)
+
+
+	def test_incompleteRecord(self):
+		"Test recovery from an incomplete last record in the write-ahead log"
+
+		obj = self.makeObject()
+		with obj:
+			obj.x = 1
+		with obj:
+			obj.x = 2
+		del obj
+
+		#Simulate a crash while writing the last record:
+		wal = self.readFile(stateFile + '.wal')
+		for truncatedSize in [len(wal)-1, len(wal)-5]:
+			with open(stateFile + '.wal', 'wb') as f:
+				f.write(wal[:truncatedSize])
+			snapshot = self.readFile(stateFile)
+
+			obj = self.makeObject()
+			self.assertEqual(obj.x, 1)
+			del obj
+
+			#Restore the situation before loading:
+			with open(stateFile, 'wb') as f:
+				f.write(snapshot)
+
+		#Corrupted first record:
+		lines = wal.split('\n')
+		lines[1] = lines[1].replace('1', '3')
+		with open(stateFile + '.wal', 'wb') as f:
+			f.write('\n'.join(lines))
+		obj = self.makeObject()
+		self.assertEqual(obj.x, 0)
+
+
+	def test_staleLog(self):
+		"Test that a write-ahead log of another snapshot is ignored"
+
+		obj = self.makeObject()
+		with obj:
+			obj.x = 1
+		del obj
+
+		with open(stateFile, 'wb') as f:
+			f.write('{"_class": "PersistentObjectTestObject", "x": 5}')
+
+		obj = self.makeObject()
+		self.assertEqual(obj.x, 5)
+
+
+	def test_oldSnapshot(self):
+		"Test recovery from a crash while replacing the snapshot"
+
+		obj = self.makeObject()
+		with obj:
+			obj.x = 1
+		del obj
+
+		#Crash after moving the snapshot to .old:
+		os.rename(stateFile, stateFile + '.old')
+
+		obj = self.makeObject()
+		self.assertEqual(obj.x, 1)
+
+
+	def test_compaction(self):
+		"Test compaction of the write-ahead log"
+
+		obj = self.makeObject(compactionInterval=3)
+		snapshot = self.readFile(stateFile)
+
+		for i in range(1, 4):
+			with obj:
+				obj.x = i
+			self.assertEqual(self.readFile(stateFile), snapshot)
+
+		with obj:
+			obj.x = 4
+
+		self.assertNotEqual(self.readFile(stateFile), snapshot)
+		self.assertEqual(len(self.readFile(stateFile + '.wal').split('\n')), 2)
+
+		with obj:
+			obj.x = 5
+
+		obj = self.makeObject()
+		self.assertEqual(obj.x, 5)
+
+
+	def test_binaryStateFormat(self):
+		"Test storing the state in the binary format"
+
+		obj = self.makeObject(stateFormat='binary')
+		for i in range(5):
+			with obj:
+				obj.x = i
+				obj.y[str(i)] = '\xff' * i
+				obj.z.append(i)
+
+		self.assertTrue(self.readFile(stateFile).startswith(
+			serializable.binaryMagic))
+
+		#The format is detected when loading, also with a different setting:
+		obj = self.makeObject(stateFormat='json')
+		self.assertEqual(obj.x, 4)
+		self.assertEqual(obj.y, {str(i): '\xff' * i for i in range(5)})
+		self.assertEqual(obj.z, range(5))
+
+		#Compaction at load time re-writes the snapshot in the new format:
+		self.assertFalse(self.readFile(stateFile).startswith(
+			serializable.binaryMagic))
+
+
+
+
+if __name__ == "__main__":
+	unittest.main(verbosity=2)
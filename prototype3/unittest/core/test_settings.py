@@ -28,6 +28,7 @@
 #    OpenSSL library used as well as that of the covered work.
 
 import unittest
+import os
 
 import testenvironment
 
@@ -64,32 +65,76 @@ class Test(unittest.TestCase):
 
 
 	def checkDefaultValues(self, s):
+		self.assertEqual(s.walCompactionInterval, 1000)
 		self.assertEqual(s.bitcoinRPCURL, '')
+		self.assertEqual(s.bitcoinWorkers, 2)
+		self.assertEqual(s.bitcoinRPCTimeout, 30.0)
+		self.assertEqual(s.bitcoinRetryDelay, 60.0)
+		self.assertEqual(s.bitcoinMaxRetries, 10)
+		self.assertEqual(s.bitcoinSimulatorBlockInterval, 0.0)
 		self.assertEqual(s.listenHost, '')
 		self.assertEqual(s.listenPort, 4321)
 		self.assertEqual(s.advertizedHost, '')
 		self.assertEqual(s.advertizedPort, 4321)
+		self.assertEqual(s.framing, 'binary')
+		self.assertEqual(s.maxMessageSize, 1048576)
 		self.assertEqual(s.externalMeetingPoints, [])
 		self.assertEqual(s.timeoutIncrement, 86400)
 		self.assertEqual(s.stateFile, 'amikopay.dat')
 		self.assertEqual(s.payLogFile, 'payments.log')
+		self.assertEqual(s.stateFormat, 'json')
+		self.assertEqual(s.bitcoinCacheFile, 'bitcoindcache.db')
 
 		self.assertEqual(s.getAdvertizedNetworkLocation(), '')
 
 	def checkLoadedValues(self, s):
+		self.assertEqual(s.walCompactionInterval, 50)
 		self.assertEqual(s.bitcoinRPCURL, 'test_rpc_url')
+		self.assertEqual(s.bitcoinWorkers, 5)
+		self.assertEqual(s.bitcoinRPCTimeout, 2.5)
+		self.assertEqual(s.bitcoinRetryDelay, 1.5)
+		self.assertEqual(s.bitcoinMaxRetries, 3)
+		self.assertEqual(s.bitcoinSimulatorBlockInterval, 0.5)
 		self.assertEqual(s.listenHost, 'test_listen_host')
 		self.assertEqual(s.listenPort, 12345)
 		self.assertEqual(s.advertizedHost, 'test_advertized_host')
 		self.assertEqual(s.advertizedPort, 2468)
+		self.assertEqual(s.framing, 'newline')
+		self.assertEqual(s.maxMessageSize, 65536)
 		self.assertEqual(s.externalMeetingPoints, ['MP1', 'MP2'])
 		self.assertEqual(s.timeoutIncrement, 3600)
 		self.assertEqual(s.stateFile, 'test_state_file')
 		self.assertEqual(s.payLogFile, 'test_log_file')
+		self.assertEqual(s.stateFormat, 'binary')
+		self.assertEqual(s.bitcoinCacheFile, 'test_cache_file')
 
 		self.assertEqual(s.getAdvertizedNetworkLocation(), 'test_advertized_host:2468')
 
 
+	def test_invalidWorkers(self):
+		"Test rejecting a number of bitcoind workers below 1"
+
+		with open('test_settings_workers.conf', 'wb') as f:
+			f.write('[bitcoind]\nworkers = 0\n')
+		try:
+			self.assertRaises(Exception,
+				settings.Settings, 'test_settings_workers.conf')
+		finally:
+			os.remove('test_settings_workers.conf')
+
+
+	def test_bitcoinCacheFile(self):
+		"Test the location of the bitcoind cache file"
+
+		s = settings.Settings()
+		s.stateFile = '/data/node/amikopay.dat'
+		self.assertEqual(s.getBitcoinCacheFile(), '/data/node/bitcoindcache.db')
+		s.bitcoinCacheFile = '/tmp/cache.db'
+		self.assertEqual(s.getBitcoinCacheFile(), '/tmp/cache.db')
+		s.bitcoinCacheFile = ''
+		self.assertEqual(s.getBitcoinCacheFile(), '')
+
+
 
 if __name__ == "__main__":
 	unittest.main(verbosity=2)
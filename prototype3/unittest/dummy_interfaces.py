@@ -142,6 +142,13 @@ class DummyBitcoind(Tracer):
 		return base58.encodeBase58Check(address, 128)
 
 
+	def getPrivateKeys(self, addresses):
+		#Exception: this doesn't get through __getattr__
+		#But we DO want it traced:
+		self.trace.append(('getPrivateKeys', [addresses], {}))
+		return [self.getPrivateKey(a) for a in addresses]
+
+
 
 class DummyNetwork(Tracer):
 	def interfaceExists(self, *args, **kwargs):
@@ -31,10 +31,12 @@ import unittest
 
 import testenvironment
 
+from test_authproxy          import Test as test_authproxy
 from test_base58             import Test as test_base58
 from test_bitcointransaction import Test as test_bitcointransaction
 from test_bitcoinutils       import Test as test_bitcoinutils
 from test_crypto             import Test as test_crypto
+from test_merkle             import Test as test_merkle
 from test_serializable       import Test as test_serializable
 from test_utils              import Test as test_utils
 
@@ -29,6 +29,8 @@
 
 import unittest
 import binascii
+import random
+import time
 
 import testenvironment
 
@@ -36,6 +38,45 @@ from amiko.utils import base58
 
 
 
+def oldEncodeBase58(data):
+	"The implementation of encodeBase58 before the table-driven codec"
+
+	bignum = int('00' + data.encode("hex"), 16)
+	ret = ""
+	while bignum > 0:
+		bignum, remainder = divmod(bignum, 58)
+		ret = ret + base58.base58Chars[remainder]
+	for i in range(len(data)):
+		if data[i] != '\0':
+			break
+		ret = ret + base58.base58Chars[0]
+	return ret[::-1]
+
+
+def oldDecodeBase58(data):
+	"The implementation of decodeBase58 before the table-driven codec"
+
+	zeroes = ""
+	while len(data) > 0 and data[0] == base58.base58Chars[0]:
+		zeroes += '\0'
+		data = data[1:]
+	bignum = 0
+	for c in data:
+		bignum = 58*bignum + base58.base58Chars.index(c)
+	ret = "%x" % bignum
+	ret = "0"*(len(ret) & 1) + ret
+	ret = binascii.unhexlify(ret)
+	while len(ret) > 0 and ret[0] == '\0':
+		ret = ret[1:]
+	return zeroes + ret
+
+
+def randomData(rnd, n):
+	"Random data with a random number of leading zeroes"
+	return '\0'*rnd.randint(0, 3) + \
+		''.join(chr(rnd.randint(0, 255)) for i in range(rnd.randint(0, n)))
+
+
 class Test(unittest.TestCase):
 	def setUp(self):
 		#I just took some random keys from the block chain
@@ -116,6 +157,92 @@ class Test(unittest.TestCase):
 
 
 
+	def test_compareWithOldCodec(self):
+		"Compare the codec with the straightforward implementation"
+
+		rnd = random.Random(42)
+		for i in range(300):
+			data = randomData(rnd, 80)
+			encoded = base58.encodeBase58(data)
+			self.assertEqual(encoded, oldEncodeBase58(data))
+			self.assertEqual(base58.decodeBase58(encoded), data)
+
+			encoded = ''.join(
+				rnd.choice(base58.base58Chars) for j in range(rnd.randint(0, 60)))
+			self.assertEqual(base58.decodeBase58(encoded), oldDecodeBase58(encoded))
+
+
+	def test_illegalCharacters(self):
+		"Test decoding data with illegal characters"
+
+		for data in ["10", "1O", "abcIdef", "l", "2+", u"2\u20ac"]:
+			self.assertRaises(ValueError, base58.decodeBase58, data)
+
+		self.assertEqual(base58.decodeBase58(u"1ALk99MqTNc9ifW1DhbUa8g39FTiHuyr3L"),
+			base58.decodeBase58("1ALk99MqTNc9ifW1DhbUa8g39FTiHuyr3L"))
+
+
+	def test_batch(self):
+		"Test the batch encoding and decoding functions"
+
+		hashes = [h for h, a in self.testSet]
+		addresses = [a for h, a in self.testSet]
+
+		self.assertEqual(base58.encodeBase58CheckMany(hashes, 0), addresses)
+		self.assertEqual(base58.decodeBase58CheckMany(addresses, 0), hashes)
+		self.assertEqual(base58.encodeBase58CheckMany([], 0), [])
+		self.assertEqual(base58.decodeBase58CheckMany([], 0), [])
+
+		self.assertRaises(Exception, base58.decodeBase58CheckMany, addresses, 1)
+		wrongAddress = addresses[0][:5] + 'a' + addresses[0][6:]
+		self.assertRaises(Exception, base58.decodeBase58CheckMany,
+			[addresses[1], wrongAddress], 0)
+
+		data = ["", "\0", "\0\0abc", "xyz"]
+		self.assertEqual(base58.decodeBase58Many(base58.encodeBase58Many(data)), data)
+
+
+	@testenvironment.benchmark
+	def test_benchmark(self):
+		"Benchmark encoding and decoding addresses and private keys"
+
+		rnd = random.Random(1)
+		def randomBytes(n):
+			return ''.join(chr(rnd.randint(0, 255)) for j in range(n))
+		addressHashes = [('\0'*(i % 3) + randomBytes(20))[:20] for i in range(2000)]
+		privateKeys = [randomBytes(33) for i in range(2000)]
+
+		print
+		for name, dataList, version in (
+			("addresses", addressHashes, 0),
+			("private keys", privateKeys, 128)):
+
+			t0 = time.time()
+			oldEncoded = [
+				oldEncodeBase58(chr(version) + d + base58.doubleSHA256(chr(version) + d)[:4])
+				for d in dataList]
+			tOldEncode = time.time() - t0
+
+			t0 = time.time()
+			encoded = base58.encodeBase58CheckMany(dataList, version)
+			tEncode = time.time() - t0
+
+			t0 = time.time()
+			for e in encoded:
+				d = oldDecodeBase58(e)
+				base58.doubleSHA256(d[:-4])[:4] == d[-4:]
+			tOldDecode = time.time() - t0
+
+			t0 = time.time()
+			decoded = base58.decodeBase58CheckMany(encoded, version)
+			tDecode = time.time() - t0
+
+			self.assertEqual(encoded, oldEncoded)
+			self.assertEqual(decoded, dataList)
+			print '%d %s: encode %.3f s (was %.3f s), decode %.3f s (was %.3f s)' % \
+				(len(dataList), name, tEncode, tOldEncode, tDecode, tOldDecode)
+
+
 if __name__ == "__main__":
 	unittest.main(verbosity=2)
 
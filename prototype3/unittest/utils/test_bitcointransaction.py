@@ -29,6 +29,8 @@
 
 import unittest
 import struct
+import copy
+import time
 
 import testenvironment
 
@@ -38,6 +40,37 @@ from amiko.utils import bitcointransaction
 from amiko.utils.bitcointransaction import OP
 
 
+
+def oldSignatureBodyHash(tx, index, scriptPubKey, hashType):
+	"The implementation of getSignatureBodyHash before SigningSession"
+
+	txCopy = copy.deepcopy(tx)
+	for tx_in in txCopy.tx_in:
+		tx_in.scriptSig = bitcointransaction.Script()
+	txCopy.tx_in[index].scriptSig = scriptPubKey
+	signatureBody = txCopy.serialize() + struct.pack('<I', hashType)
+	return crypto.SHA256(crypto.SHA256(signatureBody))
+
+
+def makeTransaction(numInputs):
+	tx = bitcointransaction.Transaction(
+		[
+			bitcointransaction.TxIn(crypto.SHA256(str(i)), i)
+			for i in range(numInputs)
+		],
+		[
+			bitcointransaction.TxOut(
+				5000000, bitcointransaction.Script.standardPubKey("x"*20)),
+			bitcointransaction.TxOut(
+				6000000, bitcointransaction.Script.standardPubKey("y"*20))
+		],
+		4)
+	for i, tx_in in enumerate(tx.tx_in):
+		#Already signed inputs shouldn't make a difference:
+		tx_in.scriptSig = bitcointransaction.Script(["sig%d" % i])
+	return tx
+
+
 class Test(unittest.TestCase):
 
 	def test_packVarInt(self):
@@ -569,6 +602,87 @@ class Test(unittest.TestCase):
 			self.assertTrue(k.verify(bodyHash, s[:-1]))
 
 
+	def test_signingSession(self):
+		"Test the SigningSession class"
+
+		tx = makeTransaction(5)
+		session = bitcointransaction.SigningSession(tx)
+		for i in range(5):
+			scriptPubKey = bitcointransaction.Script.standardPubKey("%d" % i * 20)
+			for hashType in [1, 2]:
+				self.assertEqual(
+					session.getSignatureBodyHash(i, scriptPubKey, hashType),
+					oldSignatureBodyHash(tx, i, scriptPubKey, hashType))
+
+
+	def test_signInputs(self):
+		"Test the Transaction.signInputs method"
+
+		tx = makeTransaction(3)
+
+		keys = [crypto.Key(), crypto.Key(), crypto.Key()]
+		for k in keys:
+			k.makeNewKey()
+
+		scriptPubKeys = \
+		[
+			bitcointransaction.Script.standardPubKey(crypto.hash160(k.getPublicKey()))
+			for k in keys
+		]
+		bodyHashes = \
+		[
+			tx.getSignatureBodyHash(i, scriptPubKeys[i], 1)
+			for i in range(3)
+		]
+
+		tx.signInputs(
+			[
+			(0, scriptPubKeys[0], [None, "pk0"], [keys[0]]),
+			(2, scriptPubKeys[2], [None, "pk2"], [keys[2]])
+			])
+
+		self.assertEqual(tx.tx_in[1].scriptSig.elements, ["sig1"])
+		for i in [0, 2]:
+			e = tx.tx_in[i].scriptSig.elements
+			self.assertEqual(len(e), 2)
+			self.assertEqual(e[1], "pk%d" % i)
+			self.assertEqual(e[0][-1], "\x01")
+			self.assertTrue(keys[i].verify(bodyHashes[i], e[0][:-1]))
+
+
+	@testenvironment.benchmark
+	def test_signingBenchmark(self):
+		"Benchmark signing a transaction with many inputs"
+
+		N = 150
+		tx = makeTransaction(N)
+		key = crypto.Key()
+		key.makeNewKey()
+		scriptPubKey = bitcointransaction.Script.standardPubKey(
+			crypto.hash160(key.getPublicKey()))
+
+		t0 = time.time()
+		oldHashes = [oldSignatureBodyHash(tx, i, scriptPubKey, 1) for i in range(N)]
+		tOld = time.time() - t0
+
+		t0 = time.time()
+		session = bitcointransaction.SigningSession(tx)
+		newHashes = [session.getSignatureBodyHash(i, scriptPubKey, 1) for i in range(N)]
+		tNew = time.time() - t0
+
+		self.assertEqual(newHashes, oldHashes)
+		print '\n%d signature body hashes: %.3f s (was %.3f s)' % (N, tNew, tOld)
+
+		t0 = time.time()
+		tx.signInputs(
+			[(i, scriptPubKey, [None, key.getPublicKey()], [key]) for i in range(N)])
+		print 'Signing %d inputs: %.3f s' % (N, time.time() - t0)
+
+		for i in [0, N/2, N-1]:
+			sig = tx.tx_in[i].scriptSig.elements[0]
+			self.assertTrue(key.verify(oldHashes[i], sig[:-1]))
+
+
 	def test_getTransactionID(self):
 		"Test the Transaction.getTransactionID method"
 
@@ -589,6 +703,73 @@ class Test(unittest.TestCase):
 			"4455a9149e1e6ab19c7647dbf58378468e80ca8d1d3bb1713ba1da3825194ff4")
 
 
+	def test_deserializeOffsets(self):
+		"Test de-serialization at an offset inside a larger string"
+
+		tx = makeTransaction(3)
+		serialized = tx.serialize()
+		data = "prefix" + serialized + "suffix"
+
+		self.assertEqual(
+			bitcointransaction.unpackVarInt("ab\xfd\x02\x01", 2), (0x0102, 3))
+
+		txIn, numBytes = bitcointransaction.TxIn.deserialize(
+			data, 6 + 5)
+		self.assertEqual(txIn.previousOutputHash, tx.tx_in[0].previousOutputHash)
+		self.assertEqual(txIn.previousOutputIndex, 0)
+		self.assertEqual(txIn.scriptSig.elements, ["sig0"])
+		self.assertEqual(numBytes, len(tx.tx_in[0].serialize()))
+
+		tx2, numBytes = bitcointransaction.Transaction.deserializeFrom(data, 6)
+		self.assertEqual(numBytes, len(serialized))
+		self.assertEqual(tx2.serialize(), serialized)
+
+		self.assertEqual(
+			bitcointransaction.getTransactionSize(data, 6), len(serialized))
+		self.assertRaises(Exception, bitcointransaction.getTransactionSize,
+			serialized[:-1])
+		self.assertRaises(Exception, bitcointransaction.Transaction.deserializeFrom,
+			serialized[:-1])
+
+
+	def test_iterBlockTransactions(self):
+		"Test the block transaction iterators"
+
+		transactions = [makeTransaction(n) for n in [1, 5, 300]]
+		serialized = [tx.serialize() for tx in transactions]
+		block = "h"*80 + bitcointransaction.packVarInt(3) + "".join(serialized)
+
+		ranges = list(bitcointransaction.iterBlockTransactionRanges(block))
+		self.assertEqual([r[1] for r in ranges], [len(s) for s in serialized])
+		for (offset, size), s in zip(ranges, serialized):
+			self.assertEqual(block[offset:offset+size], s)
+
+		it = bitcointransaction.iterBlockTransactions(block)
+		self.assertEqual(it.next().serialize(), serialized[0])
+		self.assertEqual([tx.serialize() for tx in it], serialized[1:])
+
+		self.assertRaises(Exception, list,
+			bitcointransaction.iterBlockTransactions(block + "x"))
+		self.assertRaises(Exception, list,
+			bitcointransaction.iterBlockTransactions(block[:-1]))
+
+
+	@testenvironment.benchmark
+	def test_deserializeBenchmark(self):
+		"Benchmark de-serializing a transaction with many inputs"
+
+		N = 3000
+		serialized = makeTransaction(N).serialize()
+
+		t0 = time.time()
+		tx = bitcointransaction.Transaction.deserialize(serialized)
+		print '\nDe-serializing %d inputs (%d bytes): %.3f s' % \
+			(N, len(serialized), time.time() - t0)
+
+		self.assertEqual(len(tx.tx_in), N)
+		self.assertEqual(tx.serialize(), serialized)
+
+
 
 if __name__ == "__main__":
 	unittest.main(verbosity=2)
@@ -93,10 +93,38 @@ class Test(unittest.TestCase):
 				("bar_tx"   , 2, "bar_pub"   , "bar"   )
 			])
 
+		#All private keys are retrieved at once:
+		self.assertEqual(self.bitcoind.trace[-1],
+			('getPrivateKeys', [["foobar", "bar"]], {}))
+
 		self.assertRaises(Exception, bitcoinutils.getInputsForAmount,
 			self.bitcoind, 95)
 
 
+	def test_reserveInputs(self):
+		"Test reserving inputs for transactions that are not sent yet"
+
+		tx = bitcointransaction.Transaction(
+			tx_in=[bitcointransaction.TxIn("foobar_tx", 1)], tx_out=[])
+		bitcoinutils.reserveInputs(tx)
+		try:
+			#The reserved output is not used:
+			total, inputs = bitcoinutils.getInputsForAmount(self.bitcoind, 25)
+			self.assertEqual(total, 30)
+			self.assertEqual([x[:2] for x in inputs],
+				[("bar_tx", 2), ("foo_tx", 3)])
+		finally:
+			bitcoinutils.releaseInputs(tx)
+
+		self.assertEqual(bitcoinutils.reservedOutputs, set())
+		total, inputs = bitcoinutils.getInputsForAmount(self.bitcoind, 25)
+		self.assertEqual(total, 50)
+
+		#Releasing inputs that are not reserved is harmless:
+		bitcoinutils.releaseInputs(tx)
+		self.assertEqual(bitcoinutils.reservedOutputs, set())
+
+
 	def test_sendToStandardPubKey(self):
 		"Test the sendToStandardPubKey function"
 
@@ -128,17 +156,19 @@ class Test(unittest.TestCase):
 					(OP.DUP, OP.HASH160, destHash, OP.EQUALVERIFY, OP.CHECKSIG))
 
 			#Transaction signing:
-			self.assertEqual(tx.trace[1][0], "signInput")
-			self.assertEqual(len(tx.trace[1][1]), 4)
-			self.assertEqual(tx.trace[1][1][0], 0)
-			scriptPubKey = tx.trace[1][1][1]
+			self.assertEqual(tx.trace[1][0], "signInputs")
+			self.assertEqual(len(tx.trace[1][1][0]), 1)
+			signArgs = tx.trace[1][1][0][0]
+			self.assertEqual(len(signArgs), 4)
+			self.assertEqual(signArgs[0], 0)
+			scriptPubKey = signArgs[1]
 			self.assertEqual(scriptPubKey.serialize(), "foobar_pub")
 
 			key = crypto.Key()
 			key.setPrivateKey("foobar")
-			self.assertEqual(tx.trace[1][1][2], [None, key.getPublicKey()])
-			self.assertEqual(len(tx.trace[1][1][3]), 1)
-			self.assertEqual(tx.trace[1][1][3][0].getPrivateKey(), key.getPrivateKey())
+			self.assertEqual(signArgs[2], [None, key.getPublicKey()])
+			self.assertEqual(len(signArgs[3]), 1)
+			self.assertEqual(signArgs[3][0].getPrivateKey(), key.getPrivateKey())
 
 
 	def test_sendToDataPubKey(self):
@@ -180,17 +210,19 @@ class Test(unittest.TestCase):
 				(OP.DUP, OP.HASH160, "changeHash", OP.EQUALVERIFY, OP.CHECKSIG))
 
 			#Transaction signing:
-			self.assertEqual(tx.trace[1][0], "signInput")
-			self.assertEqual(len(tx.trace[1][1]), 4)
-			self.assertEqual(tx.trace[1][1][0], 0)
-			scriptPubKey = tx.trace[1][1][1]
+			self.assertEqual(tx.trace[1][0], "signInputs")
+			self.assertEqual(len(tx.trace[1][1][0]), 1)
+			signArgs = tx.trace[1][1][0][0]
+			self.assertEqual(len(signArgs), 4)
+			self.assertEqual(signArgs[0], 0)
+			scriptPubKey = signArgs[1]
 			self.assertEqual(scriptPubKey.serialize(), "foo_pub")
 
 			key = crypto.Key()
 			key.setPrivateKey("foo")
-			self.assertEqual(tx.trace[1][1][2], [None, key.getPublicKey()])
-			self.assertEqual(len(tx.trace[1][1][3]), 1)
-			self.assertEqual(tx.trace[1][1][3][0].getPrivateKey(), key.getPrivateKey())
+			self.assertEqual(signArgs[2], [None, key.getPublicKey()])
+			self.assertEqual(len(signArgs[3]), 1)
+			self.assertEqual(signArgs[3][0].getPrivateKey(), key.getPrivateKey())
 
 
 	def test_sendToMultiSigPubKey(self):
@@ -232,17 +264,19 @@ class Test(unittest.TestCase):
 				(OP.DUP, OP.HASH160, "changeHash", OP.EQUALVERIFY, OP.CHECKSIG))
 
 			#Transaction signing:
-			self.assertEqual(tx.trace[1][0], "signInput")
-			self.assertEqual(len(tx.trace[1][1]), 4)
-			self.assertEqual(tx.trace[1][1][0], 0)
-			scriptPubKey = tx.trace[1][1][1]
+			self.assertEqual(tx.trace[1][0], "signInputs")
+			self.assertEqual(len(tx.trace[1][1][0]), 1)
+			signArgs = tx.trace[1][1][0][0]
+			self.assertEqual(len(signArgs), 4)
+			self.assertEqual(signArgs[0], 0)
+			scriptPubKey = signArgs[1]
 			self.assertEqual(scriptPubKey.serialize(), "foobar_pub")
 
 			key = crypto.Key()
 			key.setPrivateKey("foobar")
-			self.assertEqual(tx.trace[1][1][2], [None, key.getPublicKey()])
-			self.assertEqual(len(tx.trace[1][1][3]), 1)
-			self.assertEqual(tx.trace[1][1][3][0].getPrivateKey(), key.getPrivateKey())
+			self.assertEqual(signArgs[2], [None, key.getPublicKey()])
+			self.assertEqual(len(signArgs[3]), 1)
+			self.assertEqual(signArgs[3][0].getPrivateKey(), key.getPrivateKey())
 
 
 	def test_makeSpendMultiSigTransaction(self):
@@ -332,6 +366,25 @@ class Test(unittest.TestCase):
 			tx, 3, ["toPubKey1", "toPubKey2"], key, signature[:-1] + "\x02")
 			)
 
+		signature2 = bitcoinutils.signMultiSigTransaction(
+			tx, 3, ["toPubKey1", "toPubKey2"], key2)
+		self.assertEqual(bitcoinutils.verifyMultiSigSignatures(
+			tx, 3, ["toPubKey1", "toPubKey2"],
+			[key, key2, key2, key],
+			[signature, signature2, signature, signature[:-1] + "\x02"]),
+			[True, True, False, False]
+			)
+
+		crypto.publicKeyCache.clear()
+		self.assertEqual(bitcoinutils.verifyMultiSigSignatures(
+			tx, 3, ["toPubKey1", "toPubKey2"],
+			[key.getPublicKey(), key2.getPublicKey(), key.getPublicKey()],
+			[signature, signature2, signature2]),
+			[True, True, False]
+			)
+		self.assertTrue(key.getPublicKey() in crypto.publicKeyCache)
+		self.assertEqual(len(crypto.publicKeyCache), 2)
+
 
 	def test_applyMultiSigSignatures(self):
 		"Test the applyMultiSigSignatures function"
@@ -30,6 +30,9 @@
 import unittest
 import binascii
 import threading
+import hashlib
+import StringIO
+import time
 
 import testenvironment
 
@@ -91,6 +94,71 @@ class Test(unittest.TestCase):
 			)
 
 
+	def test_SHA256File(self):
+		"Test the SHA256File function"
+
+		for size in [0, 1, 63, 64, 65, 1000, 100000]:
+			data = "".join(chr(i % 251) for i in range(size))
+			for chunkSize in [1, 64, 1000, 1048576]:
+				if size/chunkSize > 1000:
+					continue
+				self.assertEqual(
+					crypto.SHA256File(StringIO.StringIO(data), chunkSize),
+					crypto.SHA256(data))
+			self.assertEqual(crypto.SHA256File(StringIO.StringIO(data)),
+				hashlib.sha256(data).digest())
+
+
+	def test_doubleHashes(self):
+		"Test the doubleSHA256, hash160, SHA256Many and SHA256Chunks functions"
+
+		data = ["", "Amiko Pay", "x"*1000]
+		for d in data:
+			self.assertEqual(crypto.doubleSHA256(d),
+				crypto.SHA256(crypto.SHA256(d)))
+			self.assertEqual(crypto.hash160(d),
+				crypto.RIPEMD160(crypto.SHA256(d)))
+
+		self.assertEqual(crypto.SHA256Many(data),
+			[crypto.SHA256(d) for d in data])
+		self.assertEqual(crypto.SHA256Many(data, double=True),
+			[crypto.doubleSHA256(d) for d in data])
+		self.assertEqual(crypto.SHA256Many([]), [])
+
+		data = "".join(chr(i) for i in range(256))
+		self.assertEqual(crypto.SHA256Chunks(data, 64),
+			"".join(crypto.SHA256(data[i:i+64]) for i in range(0, 256, 64)))
+		self.assertEqual(crypto.SHA256Chunks(data, 32, double=True),
+			"".join(crypto.doubleSHA256(data[i:i+32]) for i in range(0, 256, 32)))
+		self.assertEqual(crypto.SHA256Chunks("", 64), "")
+
+
+	def test_hashContext(self):
+		"Test the incremental hash calculation objects"
+
+		for cls, f in [
+			(crypto.SHA256Context, crypto.SHA256),
+			(crypto.RIPEMD160Context, crypto.RIPEMD160)
+			]:
+			h = cls()
+			self.assertEqual(h.digest(), f(""))
+			h.update("Amiko")
+			h2 = h.copy()
+			h.update(" Pay")
+			self.assertEqual(h.digest(), f("Amiko Pay"))
+			self.assertEqual(h.digest(), f("Amiko Pay")) #digest is repeatable
+			self.assertEqual(h.hexdigest(), f("Amiko Pay").encode("hex"))
+			self.assertEqual(h2.digest(), f("Amiko"))
+			self.assertEqual(cls("Amiko Pay").digest(), f("Amiko Pay"))
+			self.assertEqual(len(h.digest()), h.digest_size)
+
+			h = cls()
+			for i in range(1000):
+				h.update(chr(i % 256))
+			self.assertEqual(h.digest(),
+				f("".join(chr(i % 256) for i in range(1000))))
+
+
 	def test_RIPEMD160(self):
 		"Test the RIPEMD160 function"
 
@@ -232,6 +300,155 @@ class Test(unittest.TestCase):
 			self.assertFalse(pub1.verify(message, sig2))
 
 
+	def test_signMany(self):
+		"Test the signMany and verifyMany methods"
+
+		key = crypto.Key()
+		key.makeNewKey()
+		pub = crypto.Key()
+		pub.setPublicKey(key.getPublicKey())
+		messages = [crypto.SHA256(str(i)) for i in range(20)]
+
+		for numThreads in (1, 3, 100):
+			signatures = key.signMany(messages, numThreads)
+			self.assertEqual(len(signatures), len(messages))
+			for m, s in zip(messages, signatures):
+				self.assertTrue(pub.verify(m, s))
+
+			self.assertEqual(
+				pub.verifyMany(zip(messages, signatures), numThreads),
+				[True]*len(messages))
+
+			self.assertEqual(
+				pub.verifyMany(zip(messages, signatures[1:] + signatures[:1]),
+					numThreads),
+				[False]*len(messages))
+
+		self.assertEqual(key.signMany([], 4), [])
+		self.assertEqual(pub.verifyMany([], 4), [])
+		self.assertRaises(Exception, pub.signMany, messages, 4)
+
+
+	def test_signManyKeys(self):
+		"Test the module-level signMany and verifyMany functions"
+
+		keys = []
+		for compressed in (False, True):
+			for i in range(3):
+				k = crypto.Key()
+				k.makeNewKey(compressed=compressed)
+				keys.append(k)
+
+		message = "foo"
+		signatures = crypto.signMany([(k, message) for k in keys], 2)
+		self.assertEqual(
+			crypto.verifyMany(
+				[(k, message, s) for k, s in zip(keys, signatures)], 2),
+			[True]*len(keys))
+		self.assertEqual(
+			crypto.verifyMany(
+				[(k, message, s) for k, s in zip(keys, reversed(signatures))], 2),
+			[False]*len(keys))
+
+
+	def test_workerPool(self):
+		"Test the WorkerPool class"
+
+		pool = crypto.WorkerPool()
+		self.assertEqual(pool.threads, [])
+
+		#A single thread doesn't need the pool:
+		self.assertEqual(pool.map(lambda c: [x+1 for x in c], range(5)),
+			range(1, 6))
+		self.assertEqual(pool.threads, [])
+
+		self.assertEqual(pool.map(lambda c: [x+1 for x in c], range(10), 4),
+			range(1, 11))
+		self.assertEqual(len(pool.threads), 3)
+
+		#Threads are re-used by later calls:
+		threads = list(pool.threads)
+		self.assertEqual(pool.map(lambda c: [len(c)], range(10), 3), [4, 4, 2])
+		self.assertEqual(pool.threads, threads)
+		self.assertTrue(all(t.daemon for t in threads))
+
+		#Exceptions in worker threads are raised in the calling thread:
+		def fail(c):
+			if c[0] == 8:
+				raise ValueError("test")
+			return c
+		self.assertRaises(ValueError, pool.map, fail, range(10), 3)
+		self.assertEqual(pool.map(fail, range(8), 3), range(8))
+
+
+	@testenvironment.benchmark
+	def test_signingThroughput(self):
+		"Benchmark signing and verification throughput"
+
+		N = 400
+		key = crypto.Key()
+		key.makeNewKey()
+		messages = [crypto.SHA256(str(i)) for i in range(N)]
+
+		t0 = time.time()
+		signatures = [key.sign(m) for m in messages]
+		tSingle = time.time() - t0
+
+		print
+		for numThreads in (1, 4):
+			t0 = time.time()
+			signatures = key.signMany(messages, numThreads)
+			tSign = time.time() - t0
+
+			t0 = time.time()
+			results = key.verifyMany(zip(messages, signatures), numThreads)
+			tVerify = time.time() - t0
+
+			self.assertEqual(results, [True]*N)
+			print '%d threads: %.0f signatures/s (%.0f with sign()), %.0f verifications/s' % \
+				(numThreads, N/tSign, N/tSingle, N/tVerify)
+
+
+	def test_publicKeyCache(self):
+		"Test the PublicKeyCache class"
+
+		keys = []
+		for i in range(4):
+			k = crypto.Key()
+			k.makeNewKey()
+			keys.append(k)
+		pubKeys = [k.getPublicKey() for k in keys]
+		message = "foo"
+		signature = keys[0].sign(message)
+
+		cache = crypto.PublicKeyCache(maxSize=3)
+		k0 = cache.getKey(pubKeys[0])
+		self.assertEqual(k0.getPublicKey(), pubKeys[0])
+		self.assertTrue(k0.verify(message, signature))
+		self.assertTrue(cache.getKey(pubKeys[0]) is k0)
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+		cache.getKey(pubKeys[1])
+		cache.getKey(pubKeys[2])
+		cache.getKey(pubKeys[0]) #now pubKeys[1] is the least recently used
+		cache.getKey(pubKeys[3])
+		self.assertEqual(len(cache), 3)
+		self.assertFalse(pubKeys[1] in cache)
+		self.assertTrue(pubKeys[0] in cache)
+		self.assertTrue(cache.getKey(pubKeys[0]) is k0)
+
+		cache.evict(pubKeys[0])
+		cache.evict(pubKeys[0]) #not present: no exception
+		self.assertFalse(pubKeys[0] in cache)
+		self.assertFalse(cache.getKey(pubKeys[0]) is k0)
+
+		cache.clear()
+		self.assertEqual(len(cache), 0)
+
+		self.assertRaises(Exception, cache.getKey, "invalid")
+		self.assertEqual(len(cache), 0)
+
+
 	def test_failures(self):
 		"Test what happens in case of libssl failures"
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#    test_merkle.py
+#    Copyright (C) 2016 by CJP
+#
+#    This file is part of Amiko Pay.
+#
+#    Amiko Pay is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Amiko Pay is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Amiko Pay. If not, see <http://www.gnu.org/licenses/>.
+#
+#    Additional permission under GNU GPL version 3 section 7
+#
+#    If you modify this Program, or any covered work, by linking or combining it
+#    with the OpenSSL library (or a modified version of that library),
+#    containing parts covered by the terms of the OpenSSL License and the SSLeay
+#    License, the licensors of this Program grant you additional permission to
+#    convey the resulting work. Corresponding Source for a non-source form of
+#    such a combination shall include the source code for the parts of the
+#    OpenSSL library used as well as that of the covered work.
+
+
+import unittest
+import binascii
+
+import testenvironment
+
+from amiko.utils import merkle
+from amiko.utils.crypto import SHA256
+
+
+
+def naiveMerkleBranch(leaves, index):
+	ret = []
+	while len(leaves) > 1:
+		if (len(leaves) % 2) != 0:
+			leaves = leaves + [leaves[-1]]
+
+		nextIndex = index/2
+		ret.append((leaves[2*nextIndex], leaves[2*nextIndex+1]))
+
+		leaves = \
+		[
+			SHA256(SHA256(leaves[2*i] + leaves[2*i+1]))
+			for i in range(len(leaves)/2)
+		]
+		index = nextIndex
+
+	return ret, leaves[0]
+
+
+
+class Test(unittest.TestCase):
+	def test_bitcoinBlock(self):
+		"Test the Merkle root of a Bitcoin block"
+
+		#Block 100000:
+		txIDs = \
+		[
+		"8c14f0db3df150123e6f3dbbf30f8b955a8249b62ac1d1ff16284aefa3d06d87",
+		"fff2525b8931402dd09222c50775608f75787bd2b87e56995a7bdd30f79702c4",
+		"6359f0868171b1d194cbee1af2f16ea598ae8fad666d9b012c8ed2b79a236ec4",
+		"e9a66845e05d5abc0ad04ec80f774a7e585c6e8db975962d069a522137b80c1d"
+		]
+		leaves = [binascii.unhexlify(x)[::-1] for x in txIDs]
+		self.assertEqual(merkle.getMerkleRoot(leaves)[::-1].encode("hex"),
+			"f3e94742aca4b5ef85488dc37c06c3282295ffec960994b2c0d5ac2a25a95766")
+
+
+	def test_tree(self):
+		"Test the MerkleTree class"
+
+		self.assertRaises(Exception, merkle.MerkleTree, [])
+
+		for n in range(1, 20):
+			leaves = [SHA256(str(i)) for i in range(n)]
+			tree = merkle.MerkleTree(leaves)
+			self.assertEqual(len(leaves), n) #not modified
+
+			branches = tree.getBranches(range(n))
+			for i in range(n):
+				branch, root = naiveMerkleBranch(leaves, i)
+				self.assertEqual(tree.getRoot(), root)
+				self.assertEqual(tree.getBranch(i), branch)
+				self.assertEqual(branches[i], branch)
+
+		tree = merkle.MerkleTree([SHA256("foo")])
+		self.assertEqual(tree.getRoot(), SHA256("foo"))
+		self.assertEqual(tree.getBranch(0), [])
+
+		#Leaf indices must be in range:
+		tree = merkle.MerkleTree([SHA256(str(i)) for i in range(5)])
+		for i in (-1, 5, 6, 8):
+			self.assertRaises(IndexError, tree.getBranch, i)
+			self.assertRaises(IndexError, tree.getBranches, [0, i])
+
+		#Leaves must be 32-byte hashes:
+		self.assertRaises(Exception, merkle.MerkleTree, ["foo"])
+		self.assertRaises(Exception, merkle.MerkleTree,
+			[SHA256("foo"), SHA256("bar") + "x"])
+
+
+	def test_verifyBranch(self):
+		"Test the verifyBranch function"
+
+		leaves = [SHA256(str(i)) for i in range(11)]
+		tree = merkle.MerkleTree(leaves)
+		root = tree.getRoot()
+
+		for i in range(11):
+			branch = tree.getBranch(i)
+			self.assertTrue(merkle.verifyBranch(leaves[i], branch, root))
+			self.assertFalse(merkle.verifyBranch(SHA256("x"), branch, root))
+			self.assertFalse(merkle.verifyBranch(leaves[i], branch, SHA256("x")))
+
+			#Modified branch:
+			left, right = branch[2]
+			branch[2] = (SHA256("x"), right) if i & 4 else (left, SHA256("x"))
+			self.assertFalse(merkle.verifyBranch(leaves[i], branch, root))
+
+		self.assertTrue(merkle.verifyBranch(root, [], root))
+		self.assertFalse(merkle.verifyBranch(leaves[0], [], root))
+
+
+
+if __name__ == "__main__":
+	unittest.main(verbosity=2)
@@ -29,17 +29,114 @@
 
 import unittest
 import json
+import copy
+import time
 
 import testenvironment
 
 from amiko.utils import serializable
 
+from amiko.core import nodestate
+from amiko.core import link
+from amiko.core import transaction
+from amiko.core import messages
+from amiko.channels import plainchannel
+
 
 class C(serializable.Serializable):
 	serializableAttributes = {'x':1, 'y':2}
 
 
 
+#The implementation before the single-pass encoder/decoder, for comparison
+#in the benchmark:
+
+def applyRecursively(selectFunction, transformFunction, obj):
+	if isinstance(obj, dict):
+		obj = \
+		{
+		applyRecursively(selectFunction, transformFunction, k):
+			applyRecursively(selectFunction, transformFunction, v)
+		for k,v in obj.iteritems()
+		}
+	if isinstance(obj, list):
+		obj = \
+		[
+		applyRecursively(selectFunction, transformFunction, x)
+		for x in obj
+		]
+	if selectFunction(obj):
+		return transformFunction(obj)
+	return obj
+
+
+def oldObject2State(s):
+	def transformFunction(obj):
+		className = obj.__class__.__name__
+		c = serializable.registeredClasses[className]
+		obj = \
+		{
+			name: oldObject2State(getattr(obj, name))
+			for name in c.serializableAttributes.keys()
+		}
+		obj["_class"] = className
+		return obj
+
+	return applyRecursively(
+		lambda obj: isinstance(obj, serializable.Serializable),
+		transformFunction,
+		s)
+
+
+def oldState2Object(s):
+	def transformFunction(attribs):
+		c = serializable.registeredClasses[attribs["_class"]]
+		return c(**attribs)
+
+	return applyRecursively(
+		lambda obj: type(obj) == dict and "_class" in obj.keys(),
+		transformFunction,
+		s)
+
+
+def oldEncodeStrings(s):
+	def transformFunction(obj):
+		nonReadableChars = [c for c in obj if ord(c) < 32 or ord(c) >= 128]
+		if len(nonReadableChars) == 0:
+			if len(obj) > 0 and obj[0] == '!':
+				obj = '!' + obj
+		else:
+			obj = '!x' + obj.encode('hex')
+		return obj
+
+	return applyRecursively(lambda obj: type(obj) == str, transformFunction, s)
+
+
+def oldDecodeStrings(s):
+	def transformFunction(obj):
+		obj = str(obj)
+		if len(obj) >= 2 and obj[0] == '!':
+			if obj[1] == 'x':
+				return obj[2:].decode('hex')
+			elif obj[1] == '!':
+				return obj[1:]
+			else:
+				raise Exception('Formatting error')
+		return obj
+
+	return applyRecursively(
+		lambda obj: type(obj) in (unicode, str), transformFunction, s)
+
+
+def oldSerialize(obj):
+	return json.dumps(oldEncodeStrings(oldObject2State(obj)))
+
+
+def oldDeserialize(s):
+	return oldState2Object(oldDecodeStrings(json.loads(s)))
+
+
+
 class Test(unittest.TestCase):
 	def setUp(self):
 		self.registeredClassesBackup = serializable.registeredClasses
@@ -51,6 +148,30 @@ class Test(unittest.TestCase):
 		serializable.registeredClasses = self.registeredClassesBackup
 
 
+	def test_construction(self):
+		"Test construction of Serializable objects"
+
+		x = {'a': [1, 2]}
+		obj = C(x=x)
+		#The object takes ownership of the given values:
+		self.assertTrue(obj.x is x)
+		self.assertEqual(obj.y, 2)
+
+		class D(serializable.Serializable):
+			serializableAttributes = {'x': [], 'y': {'a': []}, 'z': 'foo'}
+		serializable.registerClass(D)
+
+		#Mutable default values are copied:
+		obj1 = D()
+		obj2 = D()
+		obj1.x.append(1)
+		obj1.y['a'].append(1)
+		self.assertEqual(obj2.x, [])
+		self.assertEqual(obj2.y, {'a': []})
+		self.assertEqual(D.serializableAttributes['y'], {'a': []})
+		self.assertEqual(obj2.z, 'foo')
+
+
 	def test_registerClassNameCollision(self):
 		"Test registerClass name collision"
 
@@ -143,6 +264,344 @@ class Test(unittest.TestCase):
 			)
 
 
+	def test_binary(self):
+		"Test the binary data format"
+
+		state = {
+			'_class': 'C',
+			'x': {'a': '\xff\x00', 'b': u'\u20ac', 3: None, 'c': True},
+			'y': [0, -1, 300, -300, 2**70, 1.5, False, [], {},
+				{'_class': 'C', 'x': 1, 'y': 2}]
+			}
+
+		data = serializable.serializeState(state, 'binary')
+		self.assertTrue(data.startswith(serializable.binaryMagic))
+		self.assertEqual(serializable.decodeBinary(data), state)
+		self.assertEqual(serializable.deserializeState(data), state)
+
+		#Auto-detection of the format:
+		obj = C(x={'a': '\xff\x00'}, y=[C(), 4])
+		for dataFormat in serializable.dataFormats:
+			obj2 = serializable.deserialize(serializable.serialize(obj, dataFormat))
+			self.assertEqual(obj2.__class__, C)
+			self.assertEqual(obj2.x, {'a': '\xff\x00'})
+			self.assertEqual(obj2.y[0].__class__, C)
+			self.assertEqual(obj2.y[1], 4)
+
+		#Invalid data:
+		self.assertRaises(Exception, serializable.decodeBinary, data[:-1])
+		self.assertRaises(Exception, serializable.decodeBinary, data + 'N')
+		self.assertRaises(Exception, serializable.decodeBinary, 'N')
+		self.assertRaises(Exception, serializable.decodeBinary,
+			serializable.binaryMagic + 'x')
+		self.assertRaises(Exception, serializable.serializeState, state, 'xml')
+		self.assertRaises(Exception, serializable.serializeState, set(), 'binary')
+
+
+	@testenvironment.benchmark
+	def test_benchmark(self):
+		"Benchmark serialization of a large NodeState"
+
+		serializable.registeredClasses = self.registeredClassesBackup
+
+		links = {}
+		for i in range(100):
+			channel = plainchannel.PlainChannel(
+				state='open', amountLocal=1000, amountRemote=1000,
+				transactionsIncomingLocked={
+					'\x01' + '\xab' * 31 + str(j):
+						plainchannel.PlainChannel_Transaction(
+							startTime=1000.0, endTime=2000.0, amount=j)
+					for j in range(10)
+					})
+			links['link%d' % i] = link.Link(
+				remoteID='remote%d' % i, localID='local%d' % i,
+				channels=[channel])
+		state = nodestate.NodeState(
+			links=links,
+			transactions=[transaction.Transaction(
+				isPayerSide=True, payeeID='link%d' % (i % 100),
+				payerID='payer', initialLinkIDs=['link1', 'link2'],
+				remainingLinkIDs=['link2'], meetingPointID='MP',
+				amount=i, transactionID='\xff' * 32 + str(i),
+				startTime=1000, endTime=2000)
+				for i in range(2000)],
+			timeoutMessages=[messages.TimeoutMessage(timestamp=float(i),
+				message=messages.NodeStateTimeout_Route(
+					transactionID='\xff' * 32 + str(i), isPayerSide=True,
+					payerID='payer'))
+				for i in range(1000)]
+			)
+
+		def measure(function, *args):
+			t0 = time.time()
+			ret = function(*args)
+			return ret, time.time() - t0
+
+		data, tNew = measure(serializable.serialize, state)
+		oldData, tOld = measure(oldSerialize, state)
+		self.assertEqual(json.loads(data), json.loads(oldData))
+		print '\nserialize: %.3f s (was %.3f s)' % (tNew, tOld)
+
+		newState, tNew = measure(serializable.deserialize, data)
+		oldState, tOld = measure(oldDeserialize, data)
+		self.assertEqual(
+			serializable.object2State(newState),
+			serializable.object2State(oldState))
+		print 'deserialize: %.3f s (was %.3f s)' % (tNew, tOld)
+
+		objState, tNew = measure(serializable.object2State, state)
+		oldObjState, tOld = measure(oldObject2State, state)
+		self.assertEqual(objState, oldObjState)
+		print 'object2State: %.3f s (was %.3f s)' % (tNew, tOld)
+
+
+	def test_getStateDelta(self):
+		"Test getStateDelta and applyStateDelta"
+
+		def check(old, new):
+			delta = serializable.getStateDelta(old, new)
+			#Make sure the delta survives serialization:
+			delta = serializable.deserializeState(serializable.serializeState(delta))
+			state = json.loads(json.dumps(old))
+			state = serializable.applyStateDelta(state, delta)
+			self.assertEqual(state, new)
+			return delta
+
+		old = {'_class': 'C', 'x': {'a': 1, 'b': [1, 2, 3, 4]}, 'y': 'foo'}
+
+		self.assertEqual(check(old, old), [])
+		self.assertEqual(check(old, {'_class': 'C', 'x': {'a': 1, 'b': [1, 2, 3, 4]}, 'y': 'bar'}),
+			[['s', ['y'], 'bar']])
+		self.assertEqual(check(old, {'_class': 'C', 'x': {'b': [1, 2, 3, 4]}, 'y': 'foo'}),
+			[['d', ['x', 'a']]])
+		self.assertEqual(check(old, {'_class': 'C', 'x': {'a': 1, 'b': [1, 2, 5, 4, 6]}, 'y': 'foo'}),
+			[['s', ['x', 'b', 2], 5], ['s', ['x', 'b', 4], 6]])
+		self.assertEqual(check(old, {'_class': 'C', 'x': {'a': 1, 'b': [1, 2, 3]}, 'y': 'foo'}),
+			[['t', ['x', 'b'], 3]])
+		self.assertEqual(check(old, {'_class': 'C', 'x': {'a': 1, 'b': [4, 3, 2, 1]}, 'y': 'foo'}),
+			[['s', ['x', 'b'], [4, 3, 2, 1]]])
+		self.assertEqual(sorted(check(old, {'_class': 'C', 'x': {'a': True, 'b': []}, 'y': None})),
+			sorted([['s', ['y'], None], ['s', ['x', 'a'], True], ['t', ['x', 'b'], 0]]))
+		self.assertEqual(check(old, [1, 2]), [['s', [], [1, 2]]])
+		check(old, {'_class': 'C', 'x': {'a': {'c': '\xff'}, 'b': [1, [2], 3, 4]}, 'z': 3})
+
+		self.assertEqual(serializable.applyStateDelta(json.loads(json.dumps(old)),
+			[['r', ['x', 'b'], 1, 3, [5]]]),
+			{'_class': 'C', 'x': {'a': 1, 'b': [1, 5, 4]}, 'y': 'foo'})
+
+		self.assertRaises(Exception, serializable.applyStateDelta, {}, [['x', ['a']]])
+		self.assertRaises(Exception, serializable.applyStateDelta, {}, [['d', []]])
+
+
+	def test_changeTracker(self):
+		"Test ChangeTracker"
+
+		tracker = serializable.ChangeTracker()
+		obj = tracker.track(C(x={'a':C(), 'b':[1, 2]}, y=[C(), 4]))
+		self.assertTrue(isinstance(obj.x, serializable.TrackedDict))
+		self.assertTrue(isinstance(obj.x['b'], serializable.TrackedList))
+		self.assertTrue(isinstance(obj.y, serializable.TrackedList))
+		oldState = obj.getState()
+		a, b, y0 = obj.x['a'], obj.x['b'], obj.y[0]
+
+		#Changes outside a transaction are not recorded, but are tracked:
+		obj.y[0].x = {'c': []}
+		self.assertTrue(isinstance(obj.y[0].x, serializable.TrackedDict))
+		obj.y[0].x = 1
+
+		tracker.begin()
+		self.assertRaises(Exception, tracker.begin)
+		obj.x['a'].x = 5
+		obj.x['a'].x = 6
+		obj.x['a'].z = 7
+		obj.x['b'].append({'d': [3]})
+		obj.x['b'][2]['d'].append(4)
+		obj.x['b'].sort(reverse=True)
+		obj.x['b'][1:] = []
+		del obj.x['b'][0]
+		obj.x['b'] += [5, 6]
+		obj.x['c'] = [C()]
+		obj.x['c'][0].y = 8
+		del obj.x['a']
+		obj.x.update({'d': 9})
+		obj.x.setdefault('e', []).append(10)
+		obj.y.pop()
+		obj.y.insert(0, 11)
+		obj.y = []
+		tracker.rollback()
+
+		self.assertFalse(tracker.isInTransaction())
+		self.assertEqual(obj.getState(), oldState)
+		self.assertTrue(obj.x['a'] is a)
+		self.assertTrue(obj.x['b'] is b)
+		self.assertTrue(obj.y[0] is y0)
+		self.assertFalse(hasattr(a, 'z'))
+
+		#Committed changes are kept:
+		tracker.begin()
+		obj.x['b'].append(3)
+		obj.x['a'].y = 4
+		tracker.commit()
+		tracker.begin()
+		obj.x['a'].y = 5
+		tracker.rollback()
+		self.assertEqual(obj.x['b'], [1, 2, 3])
+		self.assertEqual(obj.x['a'].y, 4)
+
+		#Copies are not tracked:
+		objCopy = copy.deepcopy(obj)
+		self.assertEqual(type(objCopy.x), dict)
+		self.assertEqual(type(objCopy.x['b']), list)
+		self.assertEqual(type(copy.copy(obj.y)), list)
+		self.assertEqual(objCopy.getState(), obj.getState())
+		tracker.begin()
+		objCopy.x['a'].y = 6
+		tracker.rollback()
+		self.assertEqual(objCopy.x['a'].y, 6)
+
+		#Plain containers are copied when they are added:
+		x = []
+		obj.y = x
+		x.append(1)
+		self.assertEqual(obj.y, [])
+
+
+	def test_listJournal(self):
+		"Test rolling back list operations"
+
+		tracker = serializable.ChangeTracker()
+		items = [C(x=i) for i in range(10)]
+		obj = tracker.track(C(y=list(items)))
+
+		operations = \
+		[
+		lambda l: l.append(C()),
+		lambda l: l.extend([C(), C()]),
+		lambda l: l.insert(-100, C()),
+		lambda l: l.insert(2, C()),
+		lambda l: l.insert(100, C()),
+		lambda l: l.pop(),
+		lambda l: l.pop(0),
+		lambda l: l.pop(-3),
+		lambda l: l.remove(l[4]),
+		lambda l: l.__setitem__(-1, C()),
+		lambda l: l.__setitem__(slice(2, 4), [C(), C(), C()]),
+		lambda l: l.__setitem__(slice(None, None, 2), [C()] * len(l[::2])),
+		lambda l: l.__setslice__(-2, 100, []),
+		lambda l: l.__setslice__(5, 3, [C()]),
+		lambda l: l.__delitem__(1),
+		lambda l: l.__delitem__(slice(-3, None)),
+		lambda l: l.__delitem__(slice(None, None, 3)),
+		lambda l: l.__delslice__(1, 2),
+		lambda l: l.__iadd__([C()]),
+		lambda l: l.__imul__(2),
+		lambda l: l.reverse(),
+		lambda l: l.sort(key=lambda c: c.x),
+		]
+
+		for i in range(len(operations)):
+			tracker.begin()
+			for op in operations[i:] + operations[:i]:
+				if len(obj.y) < 5:
+					obj.y += [C() for j in range(5)]
+				op(obj.y)
+				self.assertTrue(isinstance(obj.y, serializable.TrackedList))
+			tracker.rollback()
+			self.assertEqual(len(obj.y), len(items))
+			for a, b in zip(obj.y, items):
+				self.assertTrue(a is b)
+
+		#Invalid operations don't change the list, or the journal:
+		tracker.begin()
+		self.assertRaises(IndexError, obj.y.pop, 10)
+		self.assertRaises(IndexError, obj.y.__setitem__, -11, 1)
+		self.assertRaises(IndexError, obj.y.__delitem__, 10)
+		self.assertRaises(ValueError, obj.y.remove, C())
+		self.assertRaises(IndexError, serializable.TrackedList().pop)
+		obj.y.pop()
+		tracker.rollback()
+		self.assertEqual(len(obj.y), len(items))
+		self.assertTrue(obj.y[-1] is items[-1])
+
+
+
+	def test_changeTrackerDelta(self):
+		"Test ChangeTracker.getStateDelta"
+
+		tracker = serializable.ChangeTracker()
+		obj = tracker.track(C(x={'a':C(), 'b':[1, 2]}, y=[C(x=i) for i in range(100)]))
+		obj.index = [obj.y[5]] #non-serialized attribute
+		tracker.clearChanges()
+
+		def check(expectedDelta=None):
+			newState = obj.getState()
+			delta = tracker.getStateDelta(obj)
+			if expectedDelta is not None:
+				self.assertEqual(delta, expectedDelta)
+			#Make sure the delta survives serialization:
+			delta = serializable.deserializeState(serializable.serializeState(delta))
+			state = serializable.applyStateDelta(check.state, delta)
+			self.assertEqual(state, newState)
+			check.state = newState
+			tracker.clearChanges()
+		check.state = obj.getState()
+
+		check([])
+
+		#Only the changed items are in the delta:
+		obj.y[5].x = 6
+		check([['s', ['y', 5, 'x'], 6]])
+		obj.y.append(C())
+		obj.y.append(C())
+		obj.y[-1].y = 3
+		check([['r', ['y'], 100, 100, [C().getState()]],
+			['r', ['y'], 101, 101, [C(y=3).getState()]]])
+		obj.y.pop(0)
+		obj.y[4].x = 7
+		obj.x['b'].append(3)
+		check([['r', ['y'], 0, 1, []], ['r', ['x', 'b'], 2, 2, [3]],
+			['s', ['y', 4, 'x'], 7]])
+		del obj.x['a']
+		obj.x['c'] = C()
+		obj.x['c'].x = 8
+		self.assertEqual(sorted(tracker.getStateDelta(obj)),
+			[['d', ['x', 'a']], ['s', ['x', 'c'], C(x=8).getState()]])
+		check()
+
+		#Non-serialized attributes, and objects that are no longer in the
+		#tree, are ignored:
+		obj.index.append(obj.y[0])
+		obj.index[0].y = 9
+		removed = obj.y.pop()
+		check([['r', ['y'], 100, 101, []], ['s', ['y', 4, 'y'], 9]])
+		removed.x = 10
+		obj.index = []
+		check([])
+
+		#Moved objects:
+		moved = obj.y.pop(10)
+		obj.y.insert(20, moved)
+		moved.x = 11
+		obj.x['b'] = [obj.y.pop()]
+		obj.x['b'][0].y = 12
+		obj.y.sort(key=lambda c: -c.x)
+		obj.y[-1].x = 13
+		check()
+
+		#Rolled back changes are not in the delta:
+		obj.y[1].x = 14
+		tracker.begin()
+		obj.y[1].x = 15
+		obj.y.append(C())
+		obj.x['b'][0] = C()
+		tracker.rollback()
+		check([['s', ['y', 1, 'x'], 14]])
+
+		tracker.begin()
+		self.assertRaises(Exception, tracker.clearChanges)
+		tracker.commit()
+
 
 if __name__ == "__main__":
 	unittest.main(verbosity=2)
@@ -27,9 +27,17 @@
 #    such a combination shall include the source code for the parts of the
 #    OpenSSL library used as well as that of the covered work.
 
+import os
 import sys
+import unittest
 
 sys.path.append("..")
 sys.path.append("../..")
 
 
+#Benchmarks are slow and print their results, so they are skipped unless
+#the AMIKO_BENCHMARK environment variable is set (e.g. by 'make benchmark'):
+benchmark = unittest.skipUnless(os.environ.get('AMIKO_BENCHMARK'),
+	'benchmark; set AMIKO_BENCHMARK=1 to run it')
+
+